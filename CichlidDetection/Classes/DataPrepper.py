@@ -1,7 +1,8 @@
-import os, shutil
+import os, shutil, ast
 from os.path import join, basename, exists
 from CichlidDetection.Classes.FileManager import FileManager, ProjectFileManager
-from CichlidDetection.Utilities.utils import xywh_to_xyminmax
+from CichlidDetection.Utilities.box_utils import xywh_to_xyminmax
+from CichlidDetection.Utilities.detection_store import save_detections
 from shapely.geometry import Polygon
 import numpy as np
 import pandas as pd
@@ -44,7 +45,7 @@ class DataPrepper:
             self.download_all()
         good_images = self.prep_labels()
         self.prep_images(good_images)
-        self.generate_ground_truth_csv()
+        self.generate_ground_truth()
 
     def prep_labels(self):
         """generate a label file for each valid image
@@ -115,8 +116,8 @@ class DataPrepper:
         with open(self.file_manager.local_files['test_list'], 'w') as f:
             f.writelines('{}\n'.format(f_) for f_ in sorted(test_files))
 
-    def generate_ground_truth_csv(self):
-        """generate a csv of testing targets for comparison with the output of Trainers.Trainer._evaluate_epoch()"""
+    def generate_ground_truth(self):
+        """generate a detection store of testing targets for comparison with the output of Trainer._evaluate_epoch()"""
         # load the boxed fish csv and narrow to valid images
         df = pd.read_csv(self.file_manager.local_files['boxed_fish_csv'])
         # parse the test list from test_list.txt
@@ -127,12 +128,17 @@ class DataPrepper:
         df = df[['Framefile', 'Box', 'Sex']]
         # coerce the values into the correct form
         df.Sex = df.Sex.apply(lambda x: [1] if x is 'f' else [2] if x is 'm' else [])
-        df['Box'] = df['Box'].apply(lambda x: list(eval(x)) if type(x) is str else [])
-        df['Box'] = df['Box'].apply(lambda x: xywh_to_xyminmax(*x) if x else x)
+        df['Box'] = df['Box'].apply(lambda x: list(ast.literal_eval(x)) if type(x) is str else [])
         df.rename(columns={'Box': 'boxes', 'Sex': 'labels'}, inplace=True)
         df = df.groupby('Framefile').agg({'boxes': list, 'labels': 'sum'})
         df.boxes = df.boxes.apply(lambda x: [] if x == [[]] else x)
-        df.to_csv(self.file_manager.local_files['ground_truth_csv'])
+        counts = df.boxes.apply(len)
+        boxes = np.array([box for boxes in df.boxes for box in boxes], dtype=np.float32).reshape(-1, 4)
+        save_detections(self.file_manager.local_files['ground_truth_file'], {
+            'frames': np.arange(len(df), dtype=np.int64), 'framefiles': df.index.to_numpy(dtype=str),
+            'offsets': np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+            'boxes': xywh_to_xyminmax(boxes).astype(np.float32),
+            'labels': np.array([label for labels in df.labels for label in labels], dtype=np.int64)})
 
     def _inject_empties(self, test_files, target_ratio=0.2):
         """add empty frames to the test set
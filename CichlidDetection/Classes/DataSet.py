@@ -1,12 +1,16 @@
 from PIL import Image
 from CichlidDetection.Classes.FileManager import FileManager
 from CichlidDetection.Utilities.utils import make_dir
+from CichlidDetection.Utilities.gates import GateChain
+from CichlidDetection.Utilities.decoders import DECODERS, probe_video
+from CichlidDetection.Utilities.ml_utils import resolution_kwargs, scaled_size
 import torch
 from torch import tensor
 import os
 import cv2
-import sys
+import math
 import numpy as np
+from torch.utils.data import IterableDataset, get_worker_info
 from os.path import join, basename
 
 
@@ -32,6 +36,28 @@ def read_label_file(path):
     return {'boxes': boxes, 'labels': labels}
 
 
+def tank_region(points, width, height):
+    """find the part of a frame covered by the tank polygon
+
+    Args:
+        points (array-like): [N, 2] array of (x, y) polygon vertices, as stored in the video points numpy file
+        width (int): frame width
+        height (int): frame height
+
+    Returns:
+        tuple: (xmin, ymin, xmax, ymax) bounding rectangle of the polygon, clipped to the frame
+        np.ndarray: uint8 mask with the shape of the bounding rectangle, 255 inside the polygon and 0 outside
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    xmin, ymin = np.floor(points.min(axis=0)).astype(int)
+    xmax, ymax = np.ceil(points.max(axis=0)).astype(int)
+    xmin, ymin = max(xmin, 0), max(ymin, 0)
+    xmax, ymax = min(xmax, width), min(ymax, height)
+    mask = np.zeros((ymax - ymin, xmax - xmin), dtype=np.uint8)
+    cv2.fillPoly(mask, [np.round(points - [xmin, ymin]).astype(np.int32)], 255)
+    return (xmin, ymin, xmax, ymax), mask
+
+
 class DataSet(object):
     """Class to handle loading of training or testing data"""
 
@@ -100,50 +126,213 @@ class DetectDataSet:
         return len(self.img_files)
 
 
-class DetectVideoDataSet:
+class FrameFiles:
+    """lightweight sequence mapping global frame numbers to frame file names, e.g. 5 -> 'Frame_5.jpg'"""
+
+    def __init__(self, start, stop):
+        self.start = start
+        self.stop = stop
+
+    def __getitem__(self, frame):
+        return 'Frame_{}.jpg'.format(frame)
+
+    def __len__(self):
+        return self.stop - self.start
+
+
+class DetectVideoDataSet(IterableDataset):
+    """Class to stream frames from a shard of a video file for detection
 
-    def __init__(self, transforms, video_file, *args):
+    A shard is the range of frames [start_frame, end_frame) of the original video. Frames are decoded lazily as the
+    dataset is iterated, so memory use does not depend on the length of the shard. When used with a multi-worker
+    DataLoader, the shard is split into contiguous blocks, one per worker, and each block is read with a single seek
+    followed by sequential reads.
 
+    With stride > 1, only every stride-th frame (plus the last frame of each block) is decoded as a keyframe. The
+    frames in between are yielded as image-less placeholders that point to the keyframes on either side, so their
+    detections can be interpolated once the keyframes have been run through the model.
+
+    Keyframes can also be passed through a chain of gates (see CichlidDetection.Utilities.gates). A keyframe rejected by
+    a gate is yielded as an image-less placeholder naming the gate, and either the last frame that was run through the
+    model (for gates that reuse detections) or no source frame (for gates that record the frame as empty).
+
+    If a tank polygon is given, each frame is cropped to the polygon's bounding rectangle (and optionally masked to the
+    polygon) before gating and inference, and if min_size is given, frames are scaled down as they are decoded. Targets
+    then carry a 'box_scale' and/or 'box_offset' that map predicted boxes back to native full-frame coordinates.
+
+    Decoding goes through one of the backends in CichlidDetection.Utilities.decoders, which apply the crop and scale.
+    """
+
+    def __init__(self, transforms, video_file, *args, start_frame=0, end_frame=None, stride=1, gates=None,
+                 roi=None, mask=False, min_size=None, decoder='opencv', decoder_threads=0, max_frames=64):
+        """initialize the dataset
+
+        Args:
+            transforms: Composition of Pytorch transformations to apply to each frame when loading
+            video_file (str): path to the video file
+            *args: Project File Manager object
+            start_frame (int): first frame of the shard, counted from the beginning of the video
+            end_frame (int): frame after the last frame of the shard. Defaults to None, which reads to the end
+            stride (int): run the model on every stride-th frame only, and interpolate the frames in between
+            gates (list): FrameGate objects, or names of gates in gates.GATES, checked against each keyframe
+            roi (array-like): optional [N, 2] array of tank polygon vertices, from the video points numpy file
+            mask (bool): if True and roi is given, also blank out the pixels outside the polygon
+            min_size (int): if given, scale frames so the shorter side is min_size (see ml_utils.resolution_kwargs)
+            decoder (str): name of the decoding backend in decoders.DECODERS, 'opencv' (default) or 'ffmpeg'
+            decoder_threads (int): number of threads for the decoding backend. 0 (default) lets the backend decide
+            max_frames (int): maximum number of decoded frames that should be in flight at once. See frame_loader_kwargs
+        """
+        self.video_file = video_file
         self.video_name = video_file.split('/')[-1].split('.')[0]
-        start = int(self.video_name.split('_')[-1])
-        self.fm = FileManager()
         for i in args:
             self.pfm = i
         self.pid = self.pfm.pid
         self.transforms = transforms
-        self.img_files = []
+        self.stride = stride
+        self.gates = gates
+        self.max_frames = max_frames
 
-        cap = cv2.VideoCapture(video_file)
-        self.height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        self.width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        self.len = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.decoder = decoder
+        self.decoder_threads = decoder_threads
+        self.width, self.height, self.video_len, _ = probe_video(video_file)
 
-        self.frames = []
-
-        count = start
-        for i in range(self.len):
-            ret, frame = cap.read()
-            if not ret:
-                print("Couldn't read frame " + str(i) in video_file + ". Using last good frame", file=sys.stderr)
-                break
-            else:
-                name = 'Frame_{}.jpg'.format(count)
-                self.img_files.append(name)
-                self.frames.append(frame)
+        self.region, self.mask = None, None
+        if roi is not None:
+            self.region, region_mask = tank_region(roi, self.width, self.height)
+            self.mask = region_mask if mask else None
 
-            count += 1
-            print('video: ', self.video_name, '\tFrame: ', count)
+        # size of the decoded frames, and the box_scale that maps boxes predicted on them back to the cropped frame
+        self.size, self.box_scale = None, None
+        if min_size is not None:
+            crop_width, crop_height = (self.region[2] - self.region[0], self.region[3] - self.region[1]) if \
+                self.region is not None else (self.width, self.height)
+            size = resolution_kwargs(min_size)
+            self.size = scaled_size(crop_width, crop_height, size['min_size'], size['max_size'])
+            sx, sy = self.size[0] / crop_width, self.size[1] / crop_height
+            self.box_scale = tensor([sx, sy, sx, sy], dtype=torch.float32)
+            if self.mask is not None:
+                self.mask = cv2.resize(self.mask, self.size, interpolation=cv2.INTER_NEAREST)
 
-        cap.release()
+        self.start = start_frame
+        self.stop = self.video_len if end_frame is None else min(end_frame, self.video_len)
+        self.len = max(self.stop - self.start, 0)
+        self.img_files = FrameFiles(self.start, self.stop)
 
-    def __getitem__(self, idx):
-        # if torch.is_tensor(idx):
-        #     idx = idx.tolist()
-        img = Image.fromarray(self.frames[idx], 'RGB')
-        target = {'image_id': tensor(idx)}
-        if self.transforms is not None:
-            img, target = self.transforms(img, target)
-        return img, target
+    def __iter__(self):
+        start, stop = self.start, self.stop
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            # split on the keyframe grid, so every block starts with a keyframe
+            per_worker = int(math.ceil(self.len / self.stride / worker_info.num_workers)) * self.stride
+            start = self.start + worker_info.id * per_worker
+            stop = min(start + per_worker, self.stop)
+        return self._read_frames(start, stop)
 
     def __len__(self):
         return self.len
+
+    @property
+    def frame_shape(self):
+        """(height, width) of the frames this dataset yields, after cropping and scaling"""
+        if self.size is not None:
+            return self.size[1], self.size[0]
+        if self.region is not None:
+            return self.region[3] - self.region[1], self.region[2] - self.region[0]
+        return self.height, self.width
+
+    def frame_loader_kwargs(self, batch_size, num_workers):
+        """DataLoader keyword arguments that bound the number of decoded frames held in memory to self.max_frames
+
+        Args:
+            batch_size (int): DataLoader batch size
+            num_workers (int): number of DataLoader worker processes
+
+        Returns:
+            dict: keyword arguments for torch.utils.data.DataLoader
+        """
+        if num_workers == 0:
+            return {}
+        return {'prefetch_factor': max(1, self.max_frames // (batch_size * num_workers))}
+
+    def _read_frames(self, start, stop, max_bad_frames=30):
+        """decode the frames in [start, stop) with one seek followed by sequential reads
+
+        Frames that cannot be decoded are skipped: the reader seeks past them and yields a placeholder with a None image
+        and 'skipped' set in the target, so the caller can report them. If max_bad_frames consecutive frames fail, the
+        rest of the range is assumed to be unreadable and reported the same way.
+
+        When self.stride > 1, non-keyframes are grabbed without being decoded to an image, and yielded after the next
+        keyframe as placeholders with 'interpolated' set and 'source_frames' holding the surrounding keyframes. Either
+        source frame is None when there is no keyframe on that side, in which case the other one should be copied.
+
+        Keyframes rejected by self.gates are yielded as placeholders with 'gate' set to the name of the gate, and
+        'source_frame' set to the frame whose detections should be copied, or None if the frame should be left empty.
+
+        Every target also holds 'block', the (start, stop) range being read, and 'keep_from', the oldest frame that
+        later targets of the range may name as a source frame, so that the reader of the detections knows which
+        earlier frames it can forget.
+
+        Yields:
+            tuple: img, a tensor image (or None), and target, a dictionary containing the global frame number as
+                'image_id'
+        """
+        decoder = DECODERS[self.decoder](self.video_file, crop=self.region, size=self.size,
+                                         threads=self.decoder_threads)
+        if 0 < start < stop:
+            decoder.seek(start)
+        gates = GateChain(self.gates) if self.gates else None
+        bad_frames = 0
+        prev_keyframe = None
+        last_detected = None
+        pending = []
+
+        def tag(target):
+            sources = [f for f in (prev_keyframe, last_detected) if f is not None]
+            target.update(block=(start, stop), keep_from=min(sources) if sources else start)
+            return target
+
+        for i in range(start, stop):
+            if bad_frames >= max_bad_frames:
+                yield None, tag({'image_id': tensor(i), 'skipped': True})
+                continue
+            keyframe = (i - start) % self.stride == 0 or i == stop - 1
+            if keyframe:
+                frame = decoder.read()
+                ret = frame is not None
+            else:
+                ret, frame = decoder.grab(), None
+            if not ret:
+                bad_frames += 1
+                decoder.seek(i + 1)
+                yield None, tag({'image_id': tensor(i), 'skipped': True})
+                continue
+            bad_frames = 0
+            if not keyframe:
+                pending.append(i)
+                continue
+            img = cv2.bitwise_and(frame, frame, mask=self.mask) if self.mask is not None else frame
+            gate = gates(img) if gates is not None else None
+            if gate is None:
+                target = tag({'image_id': tensor(i)})
+                if self.box_scale is not None:
+                    target['box_scale'] = self.box_scale
+                if self.region is not None:
+                    target['box_offset'] = tensor([self.region[0], self.region[1]] * 2, dtype=torch.float32)
+                if self.transforms is not None:
+                    img, target = self.transforms(img, target)
+                yield img, target
+                last_detected = i
+            else:
+                source = last_detected if gate.on_reject == 'reuse' else None
+                yield None, tag({'image_id': tensor(i), 'gate': gate.name, 'source_frame': source})
+            for j in pending:
+                yield None, tag({'image_id': tensor(j), 'interpolated': True, 'source_frames': (prev_keyframe, i)})
+            pending = []
+            prev_keyframe = i
+        for j in pending:
+            if prev_keyframe is None:
+                yield None, tag({'image_id': tensor(j), 'skipped': True})
+            else:
+                yield None, tag({'image_id': tensor(j), 'interpolated': True,
+                                 'source_frames': (prev_keyframe, None)})
+        decoder.release()
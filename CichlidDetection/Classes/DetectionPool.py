@@ -0,0 +1,81 @@
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import torch
+from CichlidDetection.Classes.Detector import Detector
+
+# the Detector owned by each worker process, loaded once by _init_worker and reused for every video the worker runs
+_detector = None
+
+
+def _init_worker(detector_kwargs, torch_threads):
+    """load the model in a worker process and pin its torch thread count"""
+    global _detector
+    _detector = Detector(**detector_kwargs)
+    torch.set_num_threads(torch_threads)
+
+
+def _detect_video(pfm, video_path, shard_size, detect_kwargs):
+    """run Detector.video_detect on one video in a worker process
+
+    Returns:
+        tuple: video path, merged detection archive name (None on failure), elapsed seconds, and a traceback string on
+            failure
+    """
+    start = time.time()
+    try:
+        _detector.pfm = pfm
+        store_name = _detector.video_detect(pfm.pid, video_path, shard_size, **detect_kwargs)
+        return video_path, store_name, time.time() - start, None
+    except Exception:
+        return video_path, None, time.time() - start, traceback.format_exc()
+
+
+class DetectionPool:
+    """run video detection on many videos at once, using a pool of worker processes that each hold a loaded model
+
+    Each worker pins torch to a fixed number of threads, so that n_processes * torch_threads roughly matches the cores
+    available, and runs whole videos through Detector.video_detect, writing one merged detection archive per video.
+    """
+
+    def __init__(self, n_processes=4, torch_threads=None, **detector_kwargs):
+        """
+        Args:
+            n_processes (int): number of videos to process at once
+            torch_threads (int): torch threads per worker. Defaults to None, which splits os.cpu_count() evenly
+            **detector_kwargs: keyword arguments for each worker's Detector, e.g. min_size, quantize or backend
+        """
+        self.n_processes = n_processes
+        self.torch_threads = torch_threads or max(1, (os.cpu_count() or 1) // n_processes)
+        self.detector_kwargs = detector_kwargs
+
+    def run(self, jobs, shard_size=18000, **detect_kwargs):
+        """detect every video in jobs
+
+        Args:
+            jobs (list of tuple): (ProjectFileManager, video path) pairs
+            shard_size (int): maximum number of frames in each shard
+            **detect_kwargs: keyword arguments passed on to Detector.frame_detect, e.g. stride, gates or roi
+
+        Returns:
+            dict: merged detection archive name keyed by video path. Videos that failed map to None
+        """
+        print('Running {} videos on {} processes with {} torch threads each'.format(
+            len(jobs), self.n_processes, self.torch_threads))
+        results = {}
+        # spawn rather than fork, so workers do not inherit the parent's torch thread pools
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(self.n_processes, mp_context=context, initializer=_init_worker,
+                                 initargs=(self.detector_kwargs, self.torch_threads)) as executor:
+            futures = [executor.submit(_detect_video, pfm, path, shard_size, detect_kwargs) for pfm, path in jobs]
+            for future in as_completed(futures):
+                path, store_name, elapsed, error = future.result()
+                results[path] = store_name
+                if error is None:
+                    print('{} done in {:.1f}s: {}'.format(path, elapsed, store_name))
+                else:
+                    print('detection failed for {}:\n{}'.format(path, error), file=sys.stderr)
+        return results
@@ -0,0 +1,366 @@
+import os
+import copy
+import time
+import queue
+import threading
+import traceback
+from concurrent.futures import Future
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+import torch
+from PIL import Image
+from CichlidDetection.Classes.Detector import Detector
+from CichlidDetection.Classes.FileManager import ProjectFileManager
+
+#: Detector methods that clients may run on the service's loaded model
+DETECTOR_METHODS = ('test', 'detect', 'frame_detect', 'video_detect')
+
+
+def default_address():
+    """default socket of the detection service, in FileManager's data_dir
+
+    The path is built directly rather than read from FileManager.local_files, so that clients can connect without the
+    rclone calls made when a FileManager is initialized.
+    """
+    return os.path.join(os.getenv('HOME'), 'scratch', 'CichlidDetection', 'detection_service.sock')
+
+
+def key_file(address):
+    """file holding the authentication key of the service listening on address, next to its socket"""
+    return os.path.splitext(address)[0] + '.key'
+
+
+def create_authkey(address):
+    """write a new random authentication key for the service listening on address, readable only by its owner
+
+    Returns:
+        bytes: the key
+    """
+    authkey = os.urandom(32)
+    path = key_file(address)
+    if os.path.exists(path):
+        os.remove(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(authkey)
+    return authkey
+
+
+def read_authkey(address):
+    """authentication key of the service listening on address, as written by create_authkey"""
+    with open(key_file(address), 'rb') as f:
+        return f.read()
+
+
+class _BatchedModel:
+    """stand-in for Detector.model that sends each image through the service's batching queue
+
+    Detector methods run by the service use it in place of the model, so that their frames are batched together with
+    those of every other client.
+    """
+
+    def __init__(self, service):
+        self.service = service
+
+    def __call__(self, images):
+        futures = [self.service.submit(image) for image in images]
+        return [future.result() for future in futures]
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
+
+
+class DetectionService:
+    """long-running detection server that keeps a Detector loaded and batches the frames of all its clients
+
+    Clients (see DetectionClient) connect over a Unix socket, and can send image paths, raw frames, or the arguments of
+    a Detector method such as frame_detect or video_detect. Each connection is handled in its own thread. Every image
+    that needs the model is put on a single queue, from which one batching thread runs the model on up to
+    max_batch_size images at a time. A batch is started as soon as it is full, or max_latency seconds after its first
+    image arrived.
+
+    Requests are pickled, so only clients that can read the service's authentication key are accepted. A new key is
+    written next to the socket (see key_file) each time the service starts, and both files are readable only by the
+    user running the service.
+    """
+
+    def __init__(self, address=None, max_batch_size=None, max_latency=0.05, inside_tank=False, **detector_kwargs):
+        """
+        Args:
+            address (str): path of the Unix socket to listen on. Defaults to None, which uses default_address()
+            max_batch_size (int): maximum number of images per model call. Defaults to None, which uses the batch size
+                of the Detector's cpu profile
+            max_latency (float): maximum time in seconds an image waits for its batch to fill
+            inside_tank (bool): if True, drop the boxes centred outside the tank in every video request, as if each
+                client had asked for it (see Detector.frame_detect)
+            **detector_kwargs: keyword arguments for the Detector, e.g. min_size, quantize, backend, architecture or
+                postprocess
+        """
+        self.address = address or default_address()
+        self.detector = Detector(**detector_kwargs)
+        self.model = self.detector.model.eval()
+        self.max_batch_size = max_batch_size or self.detector.profile['batch_size']
+        self.max_latency = max_latency
+        self.inside_tank = inside_tank
+        self.transform = self.detector._get_transform()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.started = time.time()
+        self.counters = {'requests': 0, 'active_requests': 0, 'images': 0, 'batches': 0, 'busy_time': 0.0,
+                         'latency': 0.0, 'max_queue_depth': 0}
+
+    def submit(self, image):
+        """queue an image tensor for the next batch
+
+        Args:
+            image (Tensor): [3, H, W] image, already transformed
+
+        Returns:
+            Future: resolves to the model output for the image, with tensors on the cpu
+        """
+        future = Future()
+        self.queue.put((image, future, time.time()))
+        with self.lock:
+            self.counters['max_queue_depth'] = max(self.counters['max_queue_depth'], self.queue.qsize())
+        return future
+
+    def stats(self):
+        """throughput and queue statistics since the service started
+
+        Returns:
+            dict: counters, plus images_per_second, mean_batch_size, mean_latency (seconds from an image being
+                queued to its result), model_utilisation (fraction of the uptime spent in the model) and the current
+                queue_depth
+        """
+        with self.lock:
+            stats = dict(self.counters)
+        uptime = time.time() - self.started
+        stats.update({'uptime': uptime, 'queue_depth': self.queue.qsize(),
+                      'images_per_second': stats['images'] / uptime,
+                      'mean_batch_size': stats['images'] / stats['batches'] if stats['batches'] else 0.0,
+                      'mean_latency': stats['latency'] / stats['images'] if stats['images'] else 0.0,
+                      'model_utilisation': stats['busy_time'] / uptime})
+        return stats
+
+    def serve_forever(self):
+        """accept connections until a client sends a shutdown request, then finish the running requests and exit"""
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        batcher = threading.Thread(target=self._batch_loop, daemon=True)
+        batcher.start()
+        self.authkey = create_authkey(self.address)
+        # create the socket readable and writable by its owner only, rather than restricting it once it exists
+        umask = os.umask(0o177)
+        try:
+            listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+        finally:
+            os.umask(umask)
+        print('Detection service listening on {} (max batch size {}, max latency {}s)'.format(
+            self.address, self.max_batch_size, self.max_latency))
+        try:
+            while not self.stopping.is_set():
+                try:
+                    connection = listener.accept()
+                except (AuthenticationError, EOFError, ConnectionError):
+                    # the peer did not know the key, or hung up during the handshake
+                    continue
+                threading.Thread(target=self._handle_connection, args=(connection,), daemon=True).start()
+        finally:
+            listener.close()
+            while self.stats()['active_requests'] > 0:
+                time.sleep(0.1)
+            self.queue.put(None)
+            batcher.join()
+            for path in (self.address, key_file(self.address)):
+                if os.path.exists(path):
+                    os.remove(path)
+        print('Detection service stopped: {}'.format(self.stats()))
+
+    def _batch_loop(self):
+        """take images off the queue in batches and run the model on them, until a None is queued"""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.time() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)
+                    break
+                batch.append(item)
+            start = time.time()
+            try:
+                with torch.no_grad():
+                    outputs = self.model([image.to(self.detector.device) for image, _, _ in batch])
+                outputs = [{k: v.to('cpu') for k, v in output.items()} for output in outputs]
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            end = time.time()
+            with self.lock:
+                self.counters['images'] += len(batch)
+                self.counters['batches'] += 1
+                self.counters['busy_time'] += end - start
+                self.counters['latency'] += sum(end - queued for _, _, queued in batch)
+            for (_, future, _), output in zip(batch, outputs):
+                future.set_result(output)
+
+    def _handle_connection(self, connection):
+        """answer the requests sent on one client connection until the client disconnects"""
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except (EOFError, OSError):
+                    return
+                with self.lock:
+                    self.counters['requests'] += 1
+                    self.counters['active_requests'] += 1
+                try:
+                    response = {'ok': True, 'result': self._handle_request(request)}
+                except Exception:
+                    response = {'ok': False, 'error': traceback.format_exc()}
+                finally:
+                    with self.lock:
+                        self.counters['active_requests'] -= 1
+                connection.send(response)
+                if request.get('op') == 'shutdown':
+                    return
+
+    def _handle_request(self, request):
+        op = request['op']
+        if op == 'images':
+            return self._detect_images([Image.open(path).convert('RGB') for path in request['paths']])
+        elif op == 'frames':
+            return self._detect_images([Image.fromarray(frame) for frame in request['frames']])
+        elif op == 'stats':
+            return self.stats()
+        elif op == 'shutdown':
+            self.stopping.set()
+            # wake the listener, which is blocked in accept()
+            Client(self.address, family='AF_UNIX', authkey=self.authkey).close()
+            return None
+        elif op in DETECTOR_METHODS:
+            return self._run_detector_method(op, request.get('pid'), request.get('args', ()),
+                                             request.get('kwargs', {}))
+        raise ValueError('unknown request {}'.format(op))
+
+    def _detect_images(self, images):
+        """run the model on PIL images, and return their detections in native image coordinates, filtered by the
+        detector's postprocessor
+
+        Returns:
+            list of dict: 'boxes', 'labels' and 'scores' numpy arrays for each image
+        """
+        transformed = [self.transform(image, {}) for image in images]
+        futures = [self.submit(tensor) for tensor, _ in transformed]
+        results = []
+        for (_, target), future in zip(transformed, futures):
+            output = future.result()
+            if 'box_scale' in target:
+                output['boxes'] /= target['box_scale']
+            if self.detector.postprocessor is not None:
+                output = dict(zip(['boxes', 'labels', 'scores'], self.detector.postprocessor(
+                    output['boxes'], output['labels'], output['scores'])))
+            results.append({k: v.numpy() for k, v in output.items()})
+        return results
+
+    def _run_detector_method(self, method, pid, args, kwargs):
+        """run a Detector method on a copy of the service's detector, whose model calls go through the batch queue"""
+        detector = copy.copy(self.detector)
+        detector.model = _BatchedModel(self)
+        if method == 'test':
+            # the test set is scored against the raw model output, as in Runner.detect
+            detector.postprocessor = None
+        elif method in ('frame_detect', 'video_detect'):
+            kwargs = dict(kwargs, inside_tank=kwargs.get('inside_tank', False) or self.inside_tank)
+        if pid is not None:
+            detector.pfm = ProjectFileManager(pid, self.detector.fm)
+        return getattr(detector, method)(*args, **kwargs)
+
+
+class DetectionClient:
+    """connection to a running DetectionService"""
+
+    def __init__(self, address=None):
+        """
+        Args:
+            address (str): socket of the service. Defaults to None, which uses default_address(). The service's
+                authentication key is read from the key file next to it
+        """
+        address = address or default_address()
+        self.connection = Client(address, family='AF_UNIX', authkey=read_authkey(address))
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def detect_images(self, paths):
+        """run detection on image files
+
+        Args:
+            paths (list of str): image files, readable by the service
+
+        Returns:
+            list of dict: 'boxes', 'labels' and 'scores' numpy arrays for each image, in native image coordinates
+        """
+        return self._request({'op': 'images', 'paths': list(paths)})
+
+    def detect_frames(self, frames):
+        """run detection on raw frames
+
+        Args:
+            frames (list of np.ndarray): [H, W, 3] uint8 RGB frames
+
+        Returns:
+            list of dict: 'boxes', 'labels' and 'scores' numpy arrays for each frame, in native frame coordinates
+        """
+        return self._request({'op': 'frames', 'frames': list(frames)})
+
+    def call(self, method, *args, pid=None, **kwargs):
+        """run a Detector method in the service, e.g. call('frame_detect', pid, path, 0, 1000, pid=pid)
+
+        Args:
+            method (str): one of DETECTOR_METHODS
+            *args: positional arguments of the method
+            pid (str): project id, required by methods that read project files, e.g. frame_detect with an roi
+            **kwargs: keyword arguments of the method
+
+        Returns:
+            the return value of the method, e.g. the name of the detection archive or store written to detection_dir
+        """
+        return self._request({'op': method, 'pid': pid, 'args': args, 'kwargs': kwargs})
+
+    def video_detect(self, pid, path, **kwargs):
+        """run Detector.video_detect in the service (see Detector.video_detect for the arguments)"""
+        return self.call('video_detect', pid, path, pid=pid, **kwargs)
+
+    def stats(self):
+        """throughput and queue statistics of the service (see DetectionService.stats)"""
+        return self._request({'op': 'stats'})
+
+    def shutdown(self):
+        """stop the service once its running requests finish"""
+        self._request({'op': 'shutdown'})
+
+    def _request(self, request):
+        self.connection.send(request)
+        response = self.connection.recv()
+        if not response['ok']:
+            raise RuntimeError('detection service request failed:\n{}'.format(response['error']))
+        return response['result']
@@ -1,24 +1,83 @@
 import os
+import sys
+import shutil
+import hashlib
+import inspect
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import time
 from time import ctime
 import pandas as pd
 import numpy as np
 import torch
-import torchvision
 from CichlidDetection.Classes.DataSet import DataSet, DetectDataSet, DetectVideoDataSet
 from CichlidDetection.Classes.FileManager import FileManager
-from CichlidDetection.Utilities.ml_utils import collate_fn, Compose, ToTensor
+from CichlidDetection.Classes.TrackingFish import FishTracker
+from CichlidDetection.Utilities.ml_utils import collate_fn, Compose, ToTensor, Resize, resolution_kwargs, build_model, \
+    load_model_config
+from CichlidDetection.Utilities.box_utils import interpolate_detections, frame_iou
+from CichlidDetection.Utilities.frame_ring import FrameRing
+from CichlidDetection.Utilities.detection_buffer import DetectionBuffer, OrderedFlusher
+from CichlidDetection.Utilities.pipeline import Pipeline
+from CichlidDetection.Utilities.gates import GATES
+from CichlidDetection.Utilities.postprocess import Postprocessor
+from CichlidDetection.Utilities.detection_store import STORE_EXTENSION, save_detections, load_detections, \
+    concatenate_detections, to_dataframe
+from CichlidDetection.Utilities.detection_archive import ARCHIVE_EXTENSION, DetectionArchive, merge_archives
+from CichlidDetection.Utilities.decoders import probe_video
+from CichlidDetection.Utilities.utils import make_dir, file_hash
+from CichlidDetection.Utilities.cpu_profile import load_profile, save_profile, apply_profile, available_cpus, \
+    peak_rss_mb
+from CichlidDetection.Utilities.quantization import quantize_model, quantized_skeleton
+from CichlidDetection.Utilities.onnx_backend import export_onnx, read_metadata, OnnxModel
 from torch.utils.data.sampler import SubsetRandomSampler
 from torch.utils.data.dataloader import DataLoader
 
+#: variants of the model compared by the Detector benchmarks, as (quantize, backend)
+MODEL_MODES = {'fp32': (False, 'torch'), 'int8': (True, 'torch'), 'onnx': (False, 'onnx')}
+
 
 class Detector:
 
-    def __init__(self, *args):
-        # initialize detector
+    def __init__(self, *args, min_size=None, quantize=False, backend='torch', architecture=None, postprocess=None):
+        """initialize detector
+
+        Args:
+            *args: Project File Manager object, required for video detection
+            min_size (int): inference resolution, as the length of the shorter image side. Frames are downsampled on
+                uint8 data before tensor conversion, and boxes are rescaled to native coordinates. Defaults to None,
+                which uses the resolution the weights were trained at, as recorded in their config, or the
+                architecture's default if none was recorded
+            quantize (bool): if True, run an int8 quantized copy of the model on the CPU (see _quantize_model)
+            backend (str): 'torch' (default) runs the model in pytorch. 'onnx' runs an ONNX export of the same weights
+                with ONNX Runtime on the CPU, exporting it first if there is no up to date export (see export_onnx)
+            architecture (str): load the most recent weights trained with this architecture (see Trainer._save_model).
+                Defaults to None, which loads last.weights. Either way, the model is rebuilt from the config stored
+                next to the weights
+            postprocess (dict): Postprocessor settings applied to the model output before it is stored, e.g.
+                {'min_score': 0.5, 'max_detections': 10} (see Utilities/postprocess.py). Defaults to None, which uses
+                the default settings. False stores the raw model output
+        """
         for i in args:
             self.pfm = i
         self.fm = FileManager()
+        self.min_size = min_size
+        self.quantize = quantize
+        self.backend = backend
+        self.postprocessor = None if postprocess is False else Postprocessor(**(postprocess or {}))
+        if architecture is None:
+            self.weights_file = self.fm.local_files['weights_file']
+        else:
+            self.weights_file = os.path.join(self.fm.local_files['weights_dir'], '{}.weights'.format(architecture))
+        config = load_model_config(self.weights_file)
+        self.architecture = config['architecture']
+        if self.min_size is None:
+            self.min_size = config['min_size']
+        # batch size, DataLoader workers and torch threads tuned for this machine by tune_cpu(), if available
+        self.profile = load_profile(self.fm.local_files['cpu_profile'])
+        apply_profile(self.profile)
         self._initiate_model()
 
     def test(self, n_imgs):
@@ -30,7 +89,7 @@ class Detector:
         """
         num = 'test_{}'.format(n_imgs)
         print("Start Time: ", ctime(time.time()))
-        test_dataset = DataSet(Compose([ToTensor()]), 'test')
+        test_dataset = DataSet(self._get_transform(), 'test')
         indices = list(range(len(test_dataset)))
         np.random.shuffle(indices)
         idx = indices[:n_imgs]
@@ -50,61 +109,598 @@ class Detector:
         img_dir = os.path.join(self.fm.local_files['data_dir'], img_dir)
         assert os.path.exists(img_dir)
         img_files = [os.path.join(img_dir, img_file) for img_file in os.listdir(img_dir)]
-        dataset = DetectDataSet(Compose([ToTensor()]), img_files)
-        dataloader = DataLoader(dataset, batch_size=5, shuffle=False, num_workers=8, pin_memory=True,
-                                collate_fn=collate_fn)
+        dataset = DetectDataSet(self._get_transform(), img_files)
+        dataloader = DataLoader(dataset, batch_size=self.profile['batch_size'], shuffle=False,
+                                num_workers=self.profile['num_workers'], pin_memory=True, collate_fn=collate_fn)
         self.evaluate(dataloader, pid)
 
-    def frame_detect(self, pid, path):
-        """run detection on the frame
+    def frame_detect(self, pid, path, start_frame=0, end_frame=None, stride=1, gates=None, roi=None, decoder='opencv',
+                     decoder_threads=0, max_frames=64, ingest='dataloader', num_workers=None, tracker=None,
+                     inside_tank=False):
+        """run detection on every frame of a video, or of the shard [start_frame, end_frame) of a video
+
+        Frames are streamed from the original video as detection runs, so no clips need to be cut beforehand. Frames
+        that cannot be decoded are skipped, and their numbers are stored in self.skipped_frames.
 
         Args:
-            path (str): path to the video directory (see ProjectFileManager)
+            pid (str): project id
+            path (str): path to the video file (see ProjectFileManager)
+            start_frame (int): first frame of the shard
+            end_frame (int): frame after the last frame of the shard. Defaults to None, which runs to the end
+            stride (int): run the model on every stride-th frame only. Detections for the frames in between are
+                interpolated from the surrounding keyframes and flagged in the 'interpolated' column
+            gates (list): FrameGate objects, or gate names ('motion', 'brightness'), used to skip keyframes that do not
+                need a forward pass. The 'gate' column records 'pass' for frames run through the model, the name of
+                the rejecting gate for gated frames, and '' for interpolated frames
+            roi (str): None (default) runs the model on the full frame. 'crop' runs it on the bounding rectangle of the
+                project's tank polygon, and 'mask' additionally blanks the pixels outside the polygon. Boxes are always
+                written in full-frame coordinates
+            decoder (str): video decoding backend, 'opencv' (default) or 'ffmpeg' (see Utilities/decoders.py)
+            decoder_threads (int): number of decoding threads per DataLoader worker. 0 lets the backend decide
+            max_frames (int): maximum number of decoded frames held in memory at once
+            ingest (str): how decoded frames reach the model. 'dataloader' (default) decodes in DataLoader workers,
+                which pickle each frame tensor back to the main process. 'ring' decodes in a single process that writes
+                uint8 frames into a shared-memory ring of max_frames slots, which the model reads in place (see
+                Utilities/frame_ring.py)
+            num_workers (int): number of DataLoader worker processes decoding frames when ingest is 'dataloader'.
+                Defaults to None, which uses the machine's cpu profile (see tune_cpu)
+            tracker (FishTracker): if given, track the fish as the frames are written, continuing from the tracker's
+                current state, and store the track id of every box in the archive (see evaluate)
+            inside_tank (bool): if True, drop boxes whose centre lies outside the project's tank polygon. Requires the
+                postprocessor (see __init__)
+
+        Returns:
+            str: file name of the detection archive, relative to detection_dir (see Utilities/detection_archive.py)
         """
         video_name = path.split('/')[-1].split('.')[0]
-        print('beginning loading')
-        dataset = DetectVideoDataSet(Compose([ToTensor()]), path, self.pfm)
-        dataloader = DataLoader(dataset, batch_size=5, shuffle=False, num_workers=8, pin_memory=True,
-                                collate_fn=collate_fn)
-        print('done loading')
-        self.evaluate(dataloader, "{}_{}".format(pid, video_name))
+        tank_points = np.load(self.pfm.download_video_crop()) if roi is not None or inside_tank else None
+        # frames are scaled by the decoder, so only the tensor conversion is left to the transforms. The ring converts
+        # frames itself, straight from shared memory
+        transforms = Compose([ToTensor()]) if ingest == 'dataloader' else None
+        dataset = DetectVideoDataSet(transforms, path, self.pfm, start_frame=start_frame,
+                                     end_frame=end_frame, stride=stride, gates=gates,
+                                     roi=tank_points if roi is not None else None,
+                                     mask=roi == 'mask', min_size=self.min_size, decoder=decoder,
+                                     decoder_threads=decoder_threads, max_frames=max_frames)
+        batch_size = self.profile['batch_size']
+        num_workers = self.profile['num_workers'] if num_workers is None else num_workers
+        if ingest == 'ring':
+            dataloader = FrameRing(dataset, batch_size=batch_size, n_slots=max_frames)
+        else:
+            dataloader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True,
+                                    collate_fn=collate_fn, **dataset.frame_loader_kwargs(batch_size, num_workers))
+        name = "{}_{}".format(pid, video_name) if start_frame == 0 and end_frame is None else \
+            "{}_{}_{}".format(pid, video_name, start_frame)
+        store_name = self.evaluate(dataloader, name, tracker=tracker, region=tank_points if inside_tank else None)
+        if self.skipped_frames:
+            print('{} unreadable frame(s) skipped in {}: {}'.format(
+                len(self.skipped_frames), path, self.skipped_frames), file=sys.stderr)
+        return store_name
+
+    def video_detect(self, pid, path, shard_size=18000, keep_checkpoints=False, tracking=None, **kwargs):
+        """run detection on a full video shard by shard, and merge the shards into a single detection archive
+
+        Each finished shard is saved as a checkpoint in detection_dir/checkpoints, named by its frame range and a key
+        derived from the video, the model weights and the detection settings. If the run is interrupted, rerunning it
+        with the same weights and settings skips the shards that already have a checkpoint, and produces the same
+        merged archive as an uninterrupted run. The merge streams the checkpoints in frame order and checks that every
+        frame of the video is accounted for exactly once, so a stale or partial checkpoint cannot leave a silent gap.
+        Only the checkpoints and output of this video are read, written or deleted.
+
+        Fish are tracked while detection runs, so the merged archive holds the track id of every box. Each checkpoint
+        records the tracker state at the end of its shard, and the next shard continues from it, so track ids carry
+        over between shards and are the same whether or not the run was interrupted.
+
+        Args:
+            pid (str): project id
+            path (str): path to the video file (see ProjectFileManager)
+            shard_size (int): maximum number of frames in each shard
+            keep_checkpoints (bool): if False (default), delete the shard checkpoints once the merged archive is
+                written
+            tracking (dict): FishTracker settings, e.g. {'min_hits': 5}. Defaults to None, which uses the default
+                settings. False turns tracking off
+            **kwargs: keyword arguments passed on to frame_detect, e.g. stride, gates, roi, decoder or inside_tank
+
+        Returns:
+            str: file name of the merged detection archive, relative to detection_dir
+        """
+        video_name = path.split('/')[-1].split('.')[0]
+        detection_dir = self.fm.local_files['detection_dir']
+        checkpoint_dir = make_dir(os.path.join(detection_dir, 'checkpoints', '{}_{}'.format(pid, video_name)))
+        key = self._checkpoint_key(path, dict(kwargs, tracking=tracking))
+        tracker = None if tracking is False else FishTracker(**(tracking or {}))
+        length = probe_video(path)[2]
+        intervals = list(range(0, length, shard_size)) + [length]
+        checkpoints = []
+        for start, stop in zip(intervals[:-1], intervals[1:]):
+            checkpoint = os.path.join(checkpoint_dir, '{}_{}_{}{}'.format(start, stop, key, ARCHIVE_EXTENSION))
+            checkpoints.append((checkpoint, start, stop))
+            if os.path.exists(checkpoint):
+                print('Frames {}-{} of {} were already processed, skipping'.format(start, stop, video_name))
+                if tracker is not None:
+                    tracker.load_state(DetectionArchive(checkpoint).meta['tracker'])
+                continue
+            print('Attempting detection for frames {}-{} of {}'.format(start, stop, video_name))
+            print("Start Detect Time: ", ctime(time.time()))
+            shard_store = self.frame_detect(pid, path, start, stop, tracker=tracker, **kwargs)
+            # renaming is atomic, so a checkpoint only exists once its shard is complete
+            os.replace(os.path.join(detection_dir, shard_store), checkpoint)
+            print("End Detect Time: ", ctime(time.time()))
+        print('{} was processed in {} shards'.format(video_name, len(checkpoints)))
+
+        # create a consolidated detection archive
+        store_name = '{}_{}_detections{}'.format(pid, video_name, ARCHIVE_EXTENSION)
+        archive = merge_archives(os.path.join(detection_dir, store_name), checkpoints)
+        print('merged {} frames of {} ({} with detections, {} unreadable)'.format(
+            archive.meta['stop_frame'], video_name, len(archive), len(archive.skipped_frames)))
+        if not keep_checkpoints:
+            for checkpoint, _, _ in checkpoints:
+                shutil.rmtree(checkpoint)
+        return store_name
+
+    def _checkpoint_key(self, path, kwargs):
+        """derive a short key identifying the video, the model weights and the frame_detect settings that affect the
+        detections, so that checkpoints are only reused for identical runs
+
+        Gates are identified by their names and parameters, since the repr of a FrameGate holds its memory address.
+        With stride > 1 or gates, the detections also depend on how the shard is split between DataLoader workers,
+        since each worker's block ends on its own keyframe and keeps its own gate state, so the number of decoding
+        workers is part of the key too.
+
+        Args:
+            path (str): path to the video file
+            kwargs (dict): keyword arguments passed to frame_detect
+
+        Returns:
+            str: 16 character hexadecimal key
+        """
+        defaults = inspect.signature(self.frame_detect).parameters
+        settings = {k: kwargs.get(k, defaults[k].default) for k in ['stride', 'roi', 'decoder', 'inside_tank']}
+        settings['tracking'] = kwargs.get('tracking')
+        gates = kwargs.get('gates') or []
+        settings['gates'] = [(GATES[g]() if isinstance(g, str) else g).settings() for g in gates]
+        if settings['stride'] > 1 or gates:
+            # the ring decodes the whole shard in one process, as a single block
+            if kwargs.get('ingest', defaults['ingest'].default) == 'ring':
+                settings['num_workers'] = 0
+            else:
+                num_workers = kwargs.get('num_workers')
+                settings['num_workers'] = self.profile['num_workers'] if num_workers is None else num_workers
+        postprocess = None if self.postprocessor is None else sorted(self.postprocessor.settings().items())
+        identity = [os.path.basename(path), os.path.getsize(path), self.weights_hash, self.min_size, self.quantize,
+                    self.backend, postprocess, sorted(settings.items())]
+        return hashlib.sha256(repr(identity).encode()).hexdigest()[:16]
+
+    def benchmark_resolutions(self, sizes, n_imgs=None):
+        """measure detection throughput and accuracy on the test set at several inference resolutions
+
+        Args:
+            sizes (list of int): inference resolutions (min_size values) to compare
+            n_imgs (int): number of test images to use. Defaults to None, which uses the full test set
+
+        Returns:
+            Pandas DataFrame: frames/s and average iou against the ground truth, indexed by min_size
+        """
+        gt = self._read_boxes(self.fm.local_files['ground_truth_file'])
+        rows = []
+        for size in sizes:
+            self.min_size = size
+            self._initiate_model()
+            fps, predicted = self.time_test_set('test_resolution_{}'.format(size), n_imgs)
+            rows.append({'min_size': size, 'frames_per_second': fps, 'average_iou': self._average_iou(gt, predicted)})
+            print('min_size {min_size}: {frames_per_second:.2f} frames/s, average iou {average_iou:.3f}'.format(
+                **rows[-1]))
+        summary = pd.DataFrame(rows).set_index('min_size')
+        summary.to_csv(os.path.join(self.fm.local_files['figure_data_dir'], 'resolution_benchmark.csv'))
+        return summary
+
+    def benchmark_quantization(self, n_imgs=None):
+        """compare the latency and accuracy of the fp32 and int8 quantized models on the test set
+
+        Args:
+            n_imgs (int): number of test images to use. Defaults to None, which uses the full test set
+
+        Returns:
+            Pandas DataFrame: frames/s, average iou against the ground truth, and average iou against the fp32
+                detections, indexed by model
+        """
+        return self._benchmark_models(['fp32', 'int8'], n_imgs, 'quantization')
+
+    def benchmark_onnx(self, n_imgs=None):
+        """compare the latency and accuracy of the torch and ONNX Runtime backends on the test set
+
+        Args:
+            n_imgs (int): number of test images to use. Defaults to None, which uses the full test set
+
+        Returns:
+            Pandas DataFrame: frames/s, average iou against the ground truth, and average iou against the fp32
+                torch detections, indexed by model
+        """
+        return self._benchmark_models(['fp32', 'onnx'], n_imgs, 'onnx')
+
+    def _benchmark_models(self, modes, n_imgs, name):
+        """run the test set through several variants of the model, and compare their speed and accuracy
+
+        Args:
+            modes (list of str): model variants from MODEL_MODES. The first is the reference for 'iou_vs_fp32'
+            n_imgs (int): number of test images to use. None uses the full test set
+            name (str): name of the benchmark, used for the detection stores and the summary csv in figure_data_dir
+
+        Returns:
+            Pandas DataFrame: frames/s, average iou against the ground truth, and average iou against the
+                detections of the first mode, indexed by model
+        """
+        gt = self._read_boxes(self.fm.local_files['ground_truth_file'])
+        quantize, backend = self.quantize, self.backend
+        rows, detections = [], {}
+        for mode in modes:
+            self.quantize, self.backend = MODEL_MODES[mode]
+            self._initiate_model()
+            fps, detections[mode] = self.time_test_set('test_{}_{}'.format(name, mode), n_imgs)
+            rows.append({'model': mode, 'frames_per_second': fps,
+                         'average_iou': self._average_iou(gt, detections[mode]),
+                         'iou_vs_fp32': self._average_iou(detections[modes[0]], detections[mode])})
+            print('{model}: {frames_per_second:.2f} frames/s, average iou {average_iou:.3f}, '
+                  'iou vs fp32 {iou_vs_fp32:.3f}'.format(**rows[-1]))
+        self.quantize, self.backend = quantize, backend
+        self._initiate_model()
+        summary = pd.DataFrame(rows).set_index('model')
+        summary.to_csv(os.path.join(self.fm.local_files['figure_data_dir'], '{}_benchmark.csv'.format(name)))
+        return summary
+
+    def export_onnx(self, path=None):
+        """export the fp32 model to ONNX, for the 'onnx' backend or for use outside this package
+
+        The hash of the source weights and the min_size are stored in the ONNX metadata, so that a stale export can be
+        detected.
+
+        Args:
+            path (str): destination .onnx file. Defaults to None, which writes it next to the weights file, e.g.
+                last.onnx for last.weights
+
+        Returns:
+            str: path to the exported model
+        """
+        path = path or os.path.splitext(self.weights_file)[0] + '.onnx'
+        model = build_model(self.architecture, self.min_size)
+        model.load_state_dict(torch.load(self.weights_file, map_location='cpu'))
+        export_onnx(model, path, {'weights_hash': self.weights_hash, 'min_size': self.min_size})
+        print('exported model to {}'.format(path))
+        return path
+
+    def tune_cpu(self, batch_sizes=(1, 2, 5, 8), worker_counts=(0, 2, 4, 8), thread_counts=None, n_imgs=40):
+        """find the fastest batch size, DataLoader worker count and torch thread count for inference on this machine
+
+        Each configuration runs evaluate() on the same n_imgs test images in a fresh process, so that peak memory can be
+        measured per configuration. The fastest configuration is saved to the cpu profile (see FileManager), from which
+        Detector and Trainer load their settings.
+
+        Args:
+            batch_sizes (tuple of int): batch sizes to try
+            worker_counts (tuple of int): DataLoader worker counts to try
+            thread_counts (tuple of int): torch thread counts to try. Defaults to None, which tries 1, half and all of
+                the available cores
+            n_imgs (int): number of test images to run per configuration
+
+        Returns:
+            Pandas DataFrame: frames/s and peak rss of the main process and of the largest worker, per configuration
+        """
+        cpus = available_cpus()
+        if thread_counts is None:
+            thread_counts = sorted({1, max(1, cpus // 2), cpus})
+        context = multiprocessing.get_context('spawn')
+        rows = []
+        for batch_size, num_workers, torch_threads in itertools.product(batch_sizes, worker_counts, thread_counts):
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                fps, rss_main, rss_worker = executor.submit(_benchmark_config, self.min_size, batch_size, num_workers,
+                                                            torch_threads, n_imgs).result()
+            rows.append({'batch_size': batch_size, 'num_workers': num_workers, 'torch_threads': torch_threads,
+                         'frames_per_second': fps, 'peak_rss_mb': rss_main, 'peak_worker_rss_mb': rss_worker})
+            print('batch_size {batch_size}, num_workers {num_workers}, torch_threads {torch_threads}: '
+                  '{frames_per_second:.2f} frames/s, peak rss {peak_rss_mb:.0f} MB '
+                  '(+{peak_worker_rss_mb:.0f} MB per worker)'.format(**rows[-1]))
+        summary = pd.DataFrame(rows)
+        summary.to_csv(os.path.join(self.fm.local_files['figure_data_dir'], 'cpu_tuning.csv'), index=False)
+        best = summary.loc[summary.frames_per_second.idxmax()]
+        self.profile = {'batch_size': int(best.batch_size), 'num_workers': int(best.num_workers),
+                        'torch_threads': int(best.torch_threads), 'frames_per_second': float(best.frames_per_second),
+                        'min_size': self.min_size}
+        save_profile(self.fm.local_files['cpu_profile'], self.profile)
+        apply_profile(self.profile)
+        print('saved cpu profile: {}'.format(self.profile))
+        return summary
+
+    def time_test_set(self, name, n_imgs=None):
+        """run the current model on the test set, timing evaluate()
+
+        The detections are filtered by self.postprocessor, if there is one. The benchmarks run by Runner use a Detector
+        built with postprocess=False, so that they time and score the raw model output.
+
+        Args:
+            name (str): name passed to evaluate(), which determines the detection store name
+            n_imgs (int): number of test images to use. Defaults to None, which uses the full test set
+
+        Returns:
+            tuple: frames/s, and a Pandas Series of the predicted boxes for each frame (see _read_boxes)
+        """
+        test_dataset = DataSet(self._get_transform(), 'test')
+        if n_imgs is not None:
+            test_dataset.img_files = test_dataset.img_files[:n_imgs]
+        loader = DataLoader(test_dataset, batch_size=self.profile['batch_size'], shuffle=False,
+                            num_workers=self.profile['num_workers'], collate_fn=collate_fn)
+        start = time.time()
+        store_name = self.evaluate(loader, name)
+        elapsed = time.time() - start
+        return len(test_dataset) / elapsed, self._read_boxes(store_name)
+
+    def _read_boxes(self, store_name):
+        """read the boxes of a detection or ground truth store
+
+        Args:
+            store_name (str): path to the store, or file name relative to detection_dir
+
+        Returns:
+            Pandas Series: list of boxes for each frame, indexed by Framefile
+        """
+        path = os.path.join(self.fm.local_files['detection_dir'], store_name)
+        return to_dataframe(load_detections(path)).boxes
+
+    @staticmethod
+    def _average_iou(actual, predicted):
+        """average frame iou of predicted boxes against reference boxes, over the frames present in both
+
+        Args:
+            actual (Pandas Series): reference boxes for each frame, e.g. from _read_boxes()
+            predicted (Pandas Series): predicted boxes for each frame
+
+        Returns:
+            float: average iou, weighted by the number of predicted boxes as in Plotter._calc_epoch_iou
+        """
+        df = pd.DataFrame({'actual': actual, 'predicted': predicted}).dropna()
+        frame_ious = [frame_iou(a, p) for a, p in zip(df.actual, df.predicted)]
+        n_predicted = df.predicted.apply(len)
+        return np.average(frame_ious, weights=n_predicted) if n_predicted.sum() else np.mean(frame_ious)
+
+    def _get_transform(self):
+        """get the transforms applied to each image before inference, downsampling first if min_size is set"""
+        if self.min_size is None:
+            return Compose([ToTensor()])
+        size = resolution_kwargs(self.min_size)
+        return Compose([Resize(size['min_size'], size['max_size']), ToTensor()])
 
     def _initiate_model(self):
         """initiate the model, optimizer, and scheduler."""
-        self.model = torchvision.models.detection.fasterrcnn_resnet50_fpn(num_classes=3)
-        if torch.cuda.is_available():
+        self.weights_hash = file_hash(self.weights_file)
+        if self.backend == 'onnx':
+            if self.quantize:
+                raise ValueError('the onnx backend runs the fp32 model, and cannot be combined with quantize')
+            self.device = torch.device('cpu')
+            onnx_file = os.path.splitext(self.weights_file)[0] + '.onnx'
+            expected = {'weights_hash': self.weights_hash, 'min_size': str(self.min_size)}
+            if not os.path.exists(onnx_file) or read_metadata(onnx_file) != expected:
+                self.export_onnx(onnx_file)
+            self.model = OnnxModel(onnx_file)
+            return
+        self.model = build_model(self.architecture, self.min_size)
+        if torch.cuda.is_available() and not self.quantize:
             self.device = torch.device('cuda')
-            self.model.load_state_dict(torch.load(self.fm.local_files['weights_file']))
+            self.model.load_state_dict(torch.load(self.weights_file))
             self.model.to(self.device)
         else:
             self.device = torch.device('cpu')
-            self.model.load_state_dict(torch.load(self.fm.local_files['weights_file'], map_location=self.device))
+            self.model.load_state_dict(torch.load(self.weights_file, map_location=self.device))
+            if self.quantize:
+                self._quantize_model()
+
+    def _quantize_model(self, n_imgs=50, batch_size=5):
+        """replace self.model with an int8 quantized copy (see Utilities/quantization.py)
+
+        The quantized model is calibrated on a random sample of test images, and cached next to the weights file (e.g.
+        last_int8.weights for last.weights) together with the hash of the fp32 weights and the min_size it was
+        calibrated at. The cache is reused as long as both still match.
+
+        Args:
+            n_imgs (int): number of test images to calibrate on
+            batch_size (int): number of images per calibration batch
+        """
+        cache_file = os.path.splitext(self.weights_file)[0] + '_int8.weights'
+        if os.path.exists(cache_file):
+            cache = torch.load(cache_file)
+            if cache['weights_hash'] == self.weights_hash and cache['min_size'] == self.min_size:
+                self.model = quantized_skeleton(self.model)
+                self.model.load_state_dict(cache['state_dict'])
+                return
+        print('calibrating int8 model on {} test images'.format(n_imgs))
+        test_dataset = DataSet(self._get_transform(), 'test')
+        idx = np.random.RandomState(0).permutation(len(test_dataset))[:n_imgs]
+        loader = DataLoader(test_dataset, sampler=idx.tolist(), batch_size=batch_size, collate_fn=collate_fn)
+        self.model = quantize_model(self.model, (list(images) for images, _ in loader))
+        torch.save({'weights_hash': self.weights_hash, 'min_size': self.min_size,
+                    'state_dict': self.model.state_dict()}, cache_file)
+
+    def evaluate(self, dataloader: DataLoader, name, chunk_size=10000, tracker=None, region=None):
+        """evaluate the model on the detect set of images
+
+        Detection runs as a Pipeline of threads connected by bounded queues, so that the model never waits on
+        decoding, postprocessing or writing:
 
-    @torch.no_grad()
-    def evaluate(self, dataloader: DataLoader, name):
-        """evaluate the model on the detect set of images"""
+        * 'decode' pulls batches from the dataloader
+        * 'preprocess' separates the frames that need the model from the placeholders, and moves them to the device
+        * 'forward' runs the model
+        * 'postprocess' maps boxes back to native coordinates, filters them with the Postprocessor (score threshold,
+          region, class-agnostic NMS and a cap on their number) and resolves placeholders, collecting the detections
+          in a DetectionBuffer of flat numpy arrays rather than in per-frame python lists
+        * 'write' collects finished frames in frame order, chunk_size frames at a time, for the output, and then drops
+          them from the buffer unless later frames may still be interpolated or copied from them. Video frames
+          are appended to a DetectionArchive as they finish, so the archive can be read while detection runs. The
+          detections of image sets are written to a detection store at the end. If a tracker is given, each video
+          chunk is run through it on the way to the archive, so tracking finishes together with detection
+
+        The utilisation of each stage is printed and kept in self.stage_report.
+
+        Args:
+            dataloader (DataLoader): loader of a DataSet, DetectDataSet or DetectVideoDataSet, or a FrameRing
+            name (str): prefix of the output store
+            chunk_size (int): number of frames passed to the writer at once
+            tracker (FishTracker): tracker that assigns the boxes of video frames their track ids, continuing from its
+                current state. Its state at the end is recorded in the archive. Defaults to None, no tracking
+            region (array-like): rectangle or polygon, in native coordinates, outside of which boxes are dropped by the
+                postprocessor (see Postprocessor.__call__). Defaults to None, which keeps boxes anywhere in the frame
+
+        Returns:
+            str: name of the detection archive (video) or store (image set) written to the detection directory (see
+                Utilities/detection_archive.py and Utilities/detection_store.py)
+        """
         cpu_device = torch.device("cpu")
         self.model.eval()
-        results = {}
-        for i, (images, targets) in enumerate(dataloader):
-            images = list(img.to(self.device) for img in images)
-            targets = [{k: v.to(self.device) for k, v in t.items()} for t in targets]
-            outputs = self.model(images)
-            outputs = [{k: v.to(cpu_device).numpy().tolist() for k, v in t.items()} for t in outputs]
-            results.update({target["image_id"].item(): output for target, output in zip(targets, outputs)})
-        df = pd.DataFrame.from_dict(results, orient='index')
-        index_list = df.index.tolist()
-        detect_framefiles = []
-        for i in index_list:
-            detect_framefiles.append(dataloader.dataset.img_files[i])
-        df['Framefile'] = [os.path.basename(path) for path in detect_framefiles]
-        df = df[['Framefile', 'boxes', 'labels', 'scores']].set_index('Framefile')
-
-        if 'test' in name:
-            df.to_csv(os.path.join(self.fm.local_files['detection_dir'], '{}_detections.csv'.format(name)))
-        elif 'vid' in name:
-            df.to_csv(os.path.join(self.fm.local_files['detection_dir'], '{}_detections.csv'.format(name)))
+        columns = {'interpolated': bool, 'gate': '<U16'}
+        buffer = DetectionBuffer(columns=columns)
+        self.skipped_frames = []
+
+        first_frame = getattr(dataloader.dataset, 'start', 0)
+        if isinstance(dataloader.dataset, DetectVideoDataSet):
+            store_name = '{}_detections{}'.format(name, ARCHIVE_EXTENSION)
+            archive = DetectionArchive.create(os.path.join(self.fm.local_files['detection_dir'], store_name), columns,
+                                              first_frame, track_ids=tracker is not None)
+            sink = archive.append if tracker is None else lambda chunk: archive.append(tracker.track_chunk(chunk))
+        else:
+            store_name = '{}_detections{}'.format(name, STORE_EXTENSION)
+            chunks = []
+            sink = chunks.append
+        # oldest frame each block of a video dataset may still read as a source, by block (see
+        # DetectVideoDataSet._read_frames), so that the flusher can discard the frames before it
+        holds = {}
+        holds_lock = threading.Lock()
+
+        def keep_from():
+            with holds_lock:
+                active = [keep for (start, stop), keep in holds.items() if stop > flusher.next_frame]
+            return min(active, default=None)
+
+        flusher = OrderedFlusher(buffer, lambda chunk: sink(self._store_chunk(chunk, dataloader.dataset)),
+                                 first_frame, chunk_size, keep_from)
+
+        def preprocess(batch):
+            images, targets = batch
+            inputs = [img.to(self.device) for img in images if img is not None]
+            decoded = [t for img, t in zip(images, targets) if img is not None]
+            placeholders = [t for img, t in zip(images, targets) if img is None]
+            return inputs, decoded, placeholders
+
+        def forward(batch):
+            inputs, decoded, placeholders = batch
+            # no_grad is thread-local, so it is set here rather than on evaluate
+            with torch.no_grad():
+                outputs = self.model(inputs) if inputs else []
+            return outputs, decoded, placeholders
+
+        def postprocess(batch):
+            outputs, decoded, placeholders = batch
+            # claim the sources of the batch before its frames reach the buffer and can be flushed
+            with holds_lock:
+                for target in decoded + placeholders:
+                    if 'block' in target:
+                        holds[target['block']] = max(holds.get(target['block'], target['keep_from']),
+                                                     target['keep_from'])
+            for target, output in zip(decoded, outputs):
+                boxes = output['boxes'].to(cpu_device)
+                labels = output['labels'].to(cpu_device)
+                scores = output['scores'].to(cpu_device)
+                # map boxes predicted on a resized and/or cropped frame back to native full-frame coordinates
+                if 'box_scale' in target:
+                    boxes /= target['box_scale']
+                if 'box_offset' in target:
+                    boxes += target['box_offset']
+                if self.postprocessor is not None:
+                    boxes, labels, scores = self.postprocessor(boxes, labels, scores, region)
+                buffer.append(target['image_id'].item(), boxes.numpy(), labels.numpy(), scores.numpy(), gate='pass')
+            # placeholders carry no image: the frame could not be decoded, was rejected by a gate, or lies between two
+            # keyframes
+            for target in placeholders:
+                frame = target['image_id'].item()
+                if target.get('skipped'):
+                    self.skipped_frames.append(frame)
+                elif 'gate' in target:
+                    source = target['source_frame']
+                    detections = buffer[source] if source is not None else (np.empty((0, 4)), [], [])
+                    buffer.append(frame, *detections, gate=target['gate'])
+                else:
+                    buffer.append(frame, *self._interpolate(frame, *target['source_frames'], buffer), interpolated=True)
+            return [t['image_id'].item() for t in decoded + placeholders]
+
+        stages = [('preprocess', preprocess), ('forward', forward), ('postprocess', postprocess),
+                  ('write', flusher.finish)]
+        self.stage_report = Pipeline(dataloader, stages).run()
+        flusher.close()
+        self.skipped_frames.sort()
+        if isinstance(dataloader.dataset, DetectVideoDataSet):
+            archive.finish(dataloader.dataset.stop, self.skipped_frames, None if tracker is None else tracker.state())
         else:
-            df.to_csv(os.path.join(self.fm.local_files['detection_dir'], '{}_detections.csv'.format(name)))
+            save_detections(os.path.join(self.fm.local_files['detection_dir'], store_name),
+                            concatenate_detections(chunks))
+        print('stage utilisation for {}:\n{}'.format(name, self.stage_report.round(3).to_string()))
+        return store_name
+
+    @staticmethod
+    def _store_chunk(chunk, dataset):
+        """select the arrays of a DetectionBuffer chunk that belong in a detection store
+
+        Args:
+            chunk (dict): frames, as returned by DetectionBuffer.chunk
+            dataset: the dataset the frames came from. Image sets store the file name of each frame, and video
+                datasets the interpolated and gate columns
+
+        Returns:
+            dict: arrays for save_detections or DetectionArchive.append
+        """
+        keys = ['frames', 'offsets', 'boxes', 'labels', 'scores']
+        if isinstance(dataset, DetectVideoDataSet):
+            keys.extend(['interpolated', 'gate'])
+        stored = {key: chunk[key] for key in keys}
+        if not isinstance(dataset, DetectVideoDataSet):
+            names = [os.path.basename(dataset.img_files[f]) for f in chunk['frames']]
+            stored['framefiles'] = np.array(names, dtype=str)
+        return stored
+
+    def _interpolate(self, frame, prev_keyframe, next_keyframe, buffer):
+        """estimate the detections for a frame that was skipped by a strided DetectVideoDataSet
+
+        Args:
+            frame (int): frame number to estimate
+            prev_keyframe (int): nearest earlier frame that was run through the model, or None
+            next_keyframe (int): nearest later frame that was run through the model, or None
+            buffer (DetectionBuffer): detections so far
+
+        Returns:
+            tuple of np.ndarray: boxes, labels and scores for the frame
+        """
+        if prev_keyframe is None or next_keyframe is None:
+            return buffer[next_keyframe if prev_keyframe is None else prev_keyframe]
+        t = (frame - prev_keyframe) / (next_keyframe - prev_keyframe)
+        prev, nxt = ({k: v for k, v in zip(['boxes', 'labels', 'scores'], buffer[f])}
+                     for f in (prev_keyframe, next_keyframe))
+        estimate = interpolate_detections(prev, nxt, t)
+        return estimate['boxes'], estimate['labels'], estimate['scores']
+
+
+def _benchmark_config(min_size, batch_size, num_workers, torch_threads, n_imgs):
+    """time Detector.evaluate on the first n_imgs test images with one loader and threading configuration
+
+    Runs in a fresh process started by Detector.tune_cpu, so the peak rss reflects this configuration only.
 
-        return '{}_detections.csv'.format(name)
+    Returns:
+        tuple: frames/s, peak rss of the process in MB, and peak rss of the largest DataLoader worker in MB
+    """
+    detector = Detector(min_size=min_size, postprocess=False)
+    torch.set_num_threads(torch_threads)
+    dataset = DataSet(detector._get_transform(), 'test')
+    dataset.img_files = dataset.img_files[:n_imgs]
+    # warm up on a single batch, so one-off allocations are not timed
+    warmup = list(range(min(batch_size, len(dataset))))
+    detector.evaluate(DataLoader(dataset, sampler=warmup, batch_size=batch_size, collate_fn=collate_fn), 'test_tune')
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, collate_fn=collate_fn)
+    start = time.time()
+    detector.evaluate(loader, 'test_tune')
+    elapsed = time.time() - start
+    rss_main, rss_worker = peak_rss_mb()
+    return len(dataset) / elapsed, rss_main, rss_worker if num_workers > 0 else 0.0
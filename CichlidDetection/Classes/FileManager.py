@@ -58,8 +58,10 @@ class FileManager:
             self.local_files.update({name: join(self.local_files['log_dir'], fname)})
         for name, fname in [('weights_file', 'last.weights')]:
             self.local_files.update({name: join(self.local_files['weights_dir'], fname)})
-        for name, fname in [('ground_truth_csv', 'ground_truth.csv')]:
+        for name, fname in [('ground_truth_file', 'ground_truth.npz')]:
             self.local_files.update({name: join(self.local_files['predictions_dir'], fname)})
+        for name, fname in [('cpu_profile', 'cpu_profile.json')]:
+            self.local_files.update({name: join(self.local_files['data_dir'], fname)})
         # determine the unique project ID's from boxed_fish.csv
         self.unique_pids = pd.read_csv(self.local_files['boxed_fish_csv'], index_col=0)['ProjectID'].unique()
 
@@ -179,6 +181,29 @@ class ProjectFileManager(FileManager):
                             self._download(name, file, self.local_files['{}_dir'.format(self.pid)])
                             print('downloaded video!')
 
+    def download_video_crop(self):
+        """download the video points and video crop numpy files for the project, if they are not already local
+
+        Returns:
+            str: path to the local video points numpy file, which holds the corners of the tank polygon
+        """
+        for name, file in self._locate_cloud_files().items():
+            if name in ['video_points_numpy', 'video_crop_numpy'] and name not in self.local_files:
+                self._download(name, file, self.local_files['{}_dir'.format(self.pid)])
+        return self.local_files['video_points_numpy']
+
+    def list_videos(self, pattern='*.mp4'):
+        """list the videos in the project's cloud Videos directory
+
+        Args:
+            pattern (str): rclone filter pattern that the video names must match. Default '*.mp4'
+
+        Returns:
+            list of str: names of the matching videos, e.g. ['0001_vid.mp4', '0002_vid.mp4']
+        """
+        cloud_video_dir = join(self.cloud_master_dir, self.pid, 'Videos')
+        return sorted(run(['rclone', 'lsf', cloud_video_dir, '--include', pattern]).split())
+
     def _locate_cloud_files(self):
         """track down project-specific files in Dropbox.
 
@@ -1,6 +1,8 @@
 from CichlidDetection.Classes.FileManager import FileManager
-from CichlidDetection.Utilities.utils import xyminmax_to_xywh
-from os.path import join, exists
+from CichlidDetection.Utilities.box_utils import xyminmax_to_xywh
+from CichlidDetection.Utilities.detection_store import STORE_EXTENSION, convert_csv
+from CichlidDetection.Utilities.detection_table import DetectionTable
+from os.path import join, exists, splitext
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -70,8 +72,8 @@ class Plotter:
     @plotter_decorator
     def n_boxes_vs_epoch(self, fig: Figure):
         """plot the average number of boxes predicted per frame vs the epoch"""
-        predicted = pd.Series([df.boxes.apply(len).agg('mean') for df in self.epoch_predictions])
-        actual = pd.Series([self.ground_truth.boxes.apply(len).agg('mean')] * len(predicted))
+        predicted = pd.Series([table.counts.mean() for table in self.epoch_predictions])
+        actual = pd.Series([self.ground_truth.counts.mean()] * len(predicted))
         ax = fig.add_subplot(111)
         ax.set(xlabel='epoch', ylabel='avg # detections', title='Average Number of Detections vs. Epoch')
         sns.lineplot(data=predicted, ax=ax, label='predicted')
@@ -84,11 +86,12 @@ class Plotter:
         """for a single frame, successively plot the predicted boxes and labels at each epoch to create an animation"""
 
         # find a frame with a good balance of number of fish and final-epoch score for each box, and load that image
-        final_epoch = self.epoch_predictions[-1].copy()
-        final_epoch['n_detections'] = final_epoch['labels'].apply(len)
-        final_epoch['min_score'] = final_epoch['scores'].apply(lambda x: 0 if len(x) is 0 else min(x))
-        final_epoch = final_epoch[final_epoch.min_score > 0.95]
-        frame = final_epoch.sort_values(by=['n_detections', 'min_score'], ascending=False).iloc[0].name
+        final_epoch = self.epoch_predictions[-1]
+        n_detections = final_epoch.counts
+        min_score = final_epoch.reduce(final_epoch.scores, np.minimum, empty=0)
+        candidates = np.flatnonzero(min_score > 0.95)
+        best = candidates[np.lexsort((-min_score[candidates], -n_detections[candidates]))[0]]
+        frame = final_epoch.framefiles[best]
         im = np.array(Image.open(join(self.fm.local_files['test_image_dir'], frame)), dtype=np.uint8)
 
         # build up the animation
@@ -104,11 +107,10 @@ class Plotter:
             return boxes
 
         def animate(i):
-            label_preds = self.epoch_predictions[i].loc[frame, 'labels']
-            label_preds = (label_preds + ([0] * max_detections))[:5]
-            box_preds = self.epoch_predictions[i].loc[frame, 'boxes']
-            box_preds = [xyminmax_to_xywh(*p) for p in box_preds]
-            box_preds = (box_preds + ([[0, 0, 0, 0]] * max_detections))[:5]
+            table = self.epoch_predictions[i]
+            box_preds, label_preds, _ = table[table.locate(frame)]
+            label_preds = (label_preds.tolist() + ([0] * max_detections))[:5]
+            box_preds = (xyminmax_to_xywh(box_preds).tolist() + ([[0, 0, 0, 0]] * max_detections))[:5]
             color_lookup = {0: 'None', 1: '#FF1493', 2: '#00BFFF'}
             for j in range(5):
                 boxes[j].set_xy([box_preds[j][0], box_preds[j][1]])
@@ -169,17 +171,17 @@ class Plotter:
     def _load_data(self):
         """load and parse all relevant data. Automatically syncs training dir with cloud if any files are missing"""
         required_files = [self.fm.local_files[x] for x in ['boxed_fish_csv', 'train_log']]
-        required_files.append(join(self.fm.local_files['predictions_dir'], '0.csv'))
+        required_files.append(join(self.fm.local_files['predictions_dir'], '0'))
         for f in required_files:
-            if not exists(f):
+            if not any(exists(f + ext) for ext in ['', STORE_EXTENSION, '.csv']):
                 self.fm.sync_training_dir(exclude=['labels/**', 'train_images/**'])
                 break
         self.train_log = self._parse_train_log()
         self.num_epochs = len(self.train_log)
-        self.ground_truth = self._parse_epoch_csv()
+        self.ground_truth = self._parse_epoch_predictions()
         self.epoch_predictions = []
         for epoch in range(self.num_epochs):
-            self.epoch_predictions.append(self._parse_epoch_csv(epoch))
+            self.epoch_predictions.append(self._parse_epoch_predictions(epoch))
 
     def _parse_train_log(self):
         """parse the logfile that tracked overall loss and learning rate at each epoch
@@ -189,40 +191,48 @@ class Plotter:
         """
         return pd.read_csv(self.fm.local_files['train_log'], sep='\t', index_col='epoch')
 
-    def _parse_epoch_csv(self, epoch=-1):
-        """parse the csv file of predictions produced when Trainer.train() is run with compare_annotations=True
+    def _parse_epoch_predictions(self, epoch=-1):
+        """load the detection store of predictions produced when Trainer.train() is run with compare_annotations=True
 
         Notes:
-            if the epoch arg is left at the default value of -1, this function will instead parse 'ground_truth.csv'
+            if the epoch arg is left at the default value of -1, this function will instead load 'ground_truth.npz'.
+            Csv files from runs that predate the detection store are converted on first use
 
         Args:
             epoch(int): epoch number, where 0 refers to the first epoch. Defaults to -1, which parses the
-                ground truth csv
+                ground truth store
 
         Returns:
-            Pandas DataFrame of epoch data
+            DetectionTable: detections of the epoch
         """
         if epoch == -1:
-            path = self.fm.local_files['ground_truth_csv']
-            usecols = ['Framefile', 'boxes', 'labels']
+            path = self.fm.local_files['ground_truth_file']
         else:
-            path = join(self.fm.local_files['predictions_dir'], '{}.csv'.format(epoch))
-            usecols = ['Framefile', 'boxes', 'labels', 'scores']
-        return pd.read_csv(path, usecols=usecols).set_index('Framefile').applymap(lambda x: eval(x))
+            path = join(self.fm.local_files['predictions_dir'], '{}{}'.format(epoch, STORE_EXTENSION))
+        csv_file = splitext(path)[0] + '.csv'
+        if not exists(path) and exists(csv_file):
+            convert_csv(csv_file, path)
+        return DetectionTable.load(path)
 
     def _full_epoch_eval(self, epoch):
-        ep = self.epoch_predictions[epoch]
         gt = self.ground_truth
-        df = gt.join(ep, lsuffix='_actual', rsuffix='_predicted')
-        df['n_boxes_actual'] = df.boxes_actual.apply(len)
-        df['n_boxes_predicted'] = df.boxes_predicted.apply(len)
+        ep = gt.align(self.epoch_predictions[epoch])
+        average_iou, act_to_pred = gt.frame_iou(ep)
+        # each predicted box is mapped to the first ground truth box whose best match it is, and its label is correct
+        # if it agrees with that box's label
+        pred_to_act = np.full(ep.n_boxes, -1, dtype=np.int64)
+        matched = np.flatnonzero(act_to_pred >= 0)
+        predictions, first = np.unique(act_to_pred[matched], return_index=True)
+        pred_to_act[predictions] = matched[first]
+        correct = np.zeros(ep.n_boxes)
+        mapped = pred_to_act >= 0
+        correct[mapped] = ep.labels[mapped] == gt.labels[pred_to_act[mapped]]
+        n_predicted = ep.counts
+        df = pd.DataFrame({'n_boxes_actual': gt.counts, 'n_boxes_predicted': n_predicted},
+                          index=pd.Index(gt.framefiles, name='Framefile'))
         df['n_boxes_predicted_error'] = df.n_boxes_predicted - df.n_boxes_actual
-        df['average_iou'], df['act_to_pred_map'] = zip(*df.apply(
-            lambda x: self._calc_frame_iou(x.boxes_actual, x.boxes_predicted, map_boxes=True), axis=1))
-        df['pred_to_act_map'] = df.apply(lambda x: self._flip_mapping(x.act_to_pred_map, x.n_boxes_predicted), axis=1)
-        df['pred_accuracy'] = df.apply(
-            lambda x: self._compare_labels(x.labels_actual, x.labels_predicted, x.pred_to_act_map), axis=1)
-        df['avg_accuracy'] = df.pred_accuracy.apply(lambda x: sum(x)/len(x) if len(x) > 0 else 1.0)
+        df['average_iou'] = average_iou
+        df['avg_accuracy'] = np.where(n_predicted > 0, ep.reduce(correct) / np.maximum(n_predicted, 1), 1.0)
         df.to_csv(join(self.fig_data_dir, 'epoch_{}_eval.csv'.format(epoch)))
 
         summary = pd.Series()
@@ -235,45 +245,12 @@ class Plotter:
 
         return df, summary
 
-    def _compare_labels(self, labels_actual, labels_predicted, pred_to_act_map):
-        """determine whether the label for each predicted box matches the label of the corresponding ground-truth box
-
-        Args:
-            labels_actual (list of ints): ground-truth label for each ground-truth box
-            labels_predicted (list of ints): predicted label for each predicted box
-            pred_to_act_map (list of ints): list mapping each predicted box to the ground truth box with the max iou
-
-        Returns:
-            list: outcomes, where outcomes[i] = 1 if labels_predicted[i] is correct, and 0 if it's incorrect
-        """
-        outcomes = []
-        for i, pred in enumerate(labels_predicted):
-            # append 0 if the predicted box does not overlap a ground truth box
-            if pred_to_act_map[i] is None:
-                outcomes.append(0)
-            # else, append 1 if the predicted label was correct, or 0 if it was incorrect
-            else:
-                outcomes.append(1 if pred == labels_actual[pred_to_act_map[i]] else 0)
-        return outcomes
-
     def _calc_precision(self):
         pass
 
     def _calc_recall(self):
         pass
 
-    def _flip_mapping(self, a_to_b, len_b):
-        if len_b == 0:
-            return []
-        else:
-            mapping = []
-            for i in range(len_b):
-                try:
-                    mapping.append(a_to_b.index(i))
-                except ValueError:
-                    mapping.append(None)
-            return mapping
-
     def _calc_epoch_iou(self, epoch):
         """calculate the average iou across all test frames for a given epoch
 
@@ -284,85 +261,6 @@ class Plotter:
             float: average iou value per predicted box for the epoch
         """
         gt = self.ground_truth
-        ep = self.epoch_predictions[epoch]
-        combo = gt.join(ep, lsuffix='_gt', rsuffix='_ep')
-        combo['frame_iou'] = combo.apply(lambda x: self._calc_frame_iou(x.boxes_gt, x.boxes_ep), axis=1)
-        combo['n_boxes_ep'] = combo.boxes_ep.apply(len)
-        return np.average(combo.frame_iou, weights=combo.n_boxes_ep)
-
-    def _calc_frame_iou(self, actual_boxes, predicted_boxes, map_boxes=False):
-        """calculate the average iou for a frame
-
-        Args:
-            actual_boxes (list of lists of 4 ints): list of ground truth bounding boxes
-            predicted_boxes (list of lists of 4 ints): list of predicted bounding boxes
-            map_boxes: if True, also return a list of ints mapping the ground truth boxes to the
-                predicted box with the highest iou value
-
-        Returns:
-            if map_boxes is False, returns:
-                float: mean iou value for the given frame
-            if map_boxes is True, returns:
-                float: mean iou value for the given frame
-                list of ints: if map_boxes is True, also returns a list mapping the actual boxes to the
-                    the predicted boxes, where actual_box[i] maps to predicted_boxes[mapping_list[i]]
-                    (and predicted_box[j] maps to actual_boxes[mapping_list.index(j)]
-                    if the actual_boxes list is empty, returns an empty list. for ground truth boxes that do not
-                    intersect a predicted box, the list will contain a None element
-        """
-        a_bs = actual_boxes
-        p_bs = predicted_boxes
-        # if the model predicts no boxes for an empty frame, return a perfect score of 1.0 (and an empty mapping list)
-        if (len(a_bs) == 0) and (len(p_bs) == 0):
-            return (1.0, []) if map_boxes else 1.0
-
-        # elif the model predicts no boxes for a frame with one or more fish, return a score of 0.0 (and mapping list of
-        # null values with the same length as the number of actual boxes)
-        elif (len(a_bs) > 0) and (len(p_bs) == 0):
-            return (0.0, [None] * len(a_bs)) if map_boxes else 0.0
-
-        # elif the model predicts 1 or more boxes for a frame with no fish, return a score of 0 (and an empty mapping
-        # list)
-        elif (len(a_bs) == 0) and (len(p_bs) > 0):
-            return (0.0, []) if map_boxes else 0.0
-
-        # elif the model predicted 1 or more boxes for a frame with 1 or more fish, calculate the iou for each
-        # ground truth box with its best match, and average those values for the frame
-        elif (len(a_bs) > 0) and (len(p_bs) > 0):
-            ious = []
-            mapping = []
-            # for each actual box, find the largest iou score of that box with a one of the predicted boxes
-            for a_b in a_bs:
-                max_iou = 0.0
-                max_iou_mapping = None
-                for i, p_b in enumerate(p_bs):
-                    iou = self._calc_iou(a_b, p_b)
-                    if iou > max_iou:
-                        max_iou = iou
-                        max_iou_mapping = i
-                ious.append(max_iou)
-                mapping.append(max_iou_mapping)
-            # if the model predicted more boxes than there are objects, penalize by scoring the remaining boxes 0.0
-            if len(a_bs) < len(p_bs):
-                ious.extend([0.0] * (len(p_bs) - len(a_bs)))
-            # return the mean
-            return (np.mean(ious), mapping) if map_boxes else np.mean(ious)
-
-    def _calc_iou(self, box_a, box_b):
-        """calculate the iou between box_a and box_b"""
-        a = box_a
-        b = box_b
-        if (len(box_a) == 0) and (len(box_b) == 0):
-            return 1.0
-        # find area of the box formed by the intersection of box_a and box_b
-        xa, ya, xb, yb = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
-        intersection = max(0, xb - xa + 1) * max(0, yb - ya + 1)
-        # if the boxes do not intersect, short-circuit and return 0.0
-        if intersection == 0:
-            return 0.0
-        # else, calculate the area of the union of box_a and box_b, and return intersection/union
-        else:
-            a_area = (a[2] - a[0] + 1) * (a[3] - a[1] + 1)
-            b_area = (b[2] - b[0] + 1) * (b[3] - b[1] + 1)
-            union = float(a_area + b_area - intersection)
-            return intersection/union
+        ep = gt.align(self.epoch_predictions[epoch])
+        frame_ious, _ = gt.frame_iou(ep)
+        return np.average(frame_ious, weights=ep.counts)
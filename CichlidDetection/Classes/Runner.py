@@ -1,8 +1,12 @@
 import os
+import numpy as np
+import pandas as pd
 from CichlidDetection.Classes.DataPrepper import DataPrepper
 from CichlidDetection.Classes.FileManager import FileManager
 from CichlidDetection.Classes.Trainer import Trainer
 from CichlidDetection.Classes.Detector import Detector
+from CichlidDetection.Classes.Plotter import Plotter
+from CichlidDetection.Classes.DetectionService import DetectionService
 # from CichlidDetection.Classes.DetectDownload import DetectDownload
 
 
@@ -25,24 +29,29 @@ class Runner:
         """prep downloaded data"""
         self.dp.prep()
 
-    def train(self, num_epochs, upload_results=True):
+    def train(self, num_epochs, upload_results=True, min_size=None, architecture='resnet50_fpn'):
         """initiate a Trainer object and train the model.
 
         Args:
             num_epochs (int): number of epochs to train
             upload_results(bool): if True, automatically upload the results (weights, logs, etc.) after training
+            min_size (int): training resolution, as the length of the shorter image side. Default None, the
+                architecture's default
+            architecture (str): detection architecture to train, from ml_utils.ARCHITECTURES
         """
-        self.tr = Trainer(num_epochs, upload_results)
+        self.tr = Trainer(num_epochs, upload_results, min_size=min_size, architecture=architecture)
         self.tr.train()
 
     def sync(self):
         self.fm.sync_training_dir()
 
-    def detect(self, img_dir):
+    def detect(self, img_dir, min_size=None, quantize=False, backend='torch', architecture=None):
         # self.down = DetectDownload()
         # master, i_dir, files = self.down._locate_cloud_files()
         # self.down.download(i_dir, files)
-        self.de = Detector()
+        # the test set is scored against the raw model output, so it is not postprocessed
+        self.de = Detector(min_size=min_size, quantize=quantize, backend=backend, architecture=architecture,
+                           postprocess=False if img_dir == 'test' else None)
         if img_dir == 'test':
             self.de.test(5)
         elif img_dir == 'fullvideo':
@@ -50,3 +59,107 @@ class Runner:
             self.de.frame_detect(path)
         else:
             self.de.detect(img_dir)
+
+    def serve(self, address=None, max_batch_size=None, max_latency=0.05, min_size=None, quantize=False,
+              backend='torch', architecture=None, postprocess=None, inside_tank=False):
+        """start a DetectionService, which keeps the model loaded and runs detection for clients until stopped
+
+        Args:
+            address (str): Unix socket to listen on. Default None, which uses detection_service.sock in data_dir
+            max_batch_size (int): maximum number of images per model call. Default None uses the cpu profile
+            max_latency (float): maximum time in seconds an image waits for its batch to fill
+            min_size (int): inference resolution. Default None, the min_size in the architecture's model config
+            quantize (bool): if True, run an int8 quantized model on the cpu
+            backend (str): 'torch' or 'onnx'
+            architecture (str): use the most recent weights trained with this architecture. Default: last.weights
+            postprocess (dict): Postprocessor settings applied to the detections of every client, e.g.
+                {'min_score': 0.5}. Default None uses the default settings
+            inside_tank (bool): if True, drop boxes centred outside the tank in every video request
+        """
+        DetectionService(address, max_batch_size, max_latency, inside_tank, min_size=min_size, quantize=quantize,
+                         backend=backend, architecture=architecture, postprocess=postprocess).serve_forever()
+
+    def benchmark_resolutions(self, sizes, n_imgs=None):
+        """compare detection throughput and accuracy on the test set at several inference resolutions
+
+        Args:
+            sizes (list of int): inference resolutions (min_size values) to compare
+            n_imgs (int): number of test images to use. Default None, which uses the full test set
+        """
+        self.de = Detector(postprocess=False)
+        print(self.de.benchmark_resolutions(sizes, n_imgs))
+
+    def benchmark_quantization(self, n_imgs=None, min_size=None):
+        """compare the latency and accuracy of the fp32 and int8 quantized models on the test set
+
+        Args:
+            n_imgs (int): number of test images to use. Default None, which uses the full test set
+            min_size (int): inference resolution. Default None, the min_size in the architecture's model config
+        """
+        self.de = Detector(min_size=min_size, postprocess=False)
+        print(self.de.benchmark_quantization(n_imgs))
+
+    def export_onnx(self, path=None, min_size=None):
+        """export the trained model to ONNX
+
+        Args:
+            path (str): destination .onnx file. Default None, which uses weights/last.onnx
+            min_size (int): inference resolution built into the exported model. Default None, the min_size in the
+                architecture's model config
+        """
+        self.de = Detector(min_size=min_size)
+        self.de.export_onnx(path)
+
+    def benchmark_onnx(self, n_imgs=None, min_size=None):
+        """compare the latency and accuracy of the torch and ONNX Runtime backends on the test set
+
+        Args:
+            n_imgs (int): number of test images to use. Default None, which uses the full test set
+            min_size (int): inference resolution. Default None, the min_size in the architecture's model config
+        """
+        self.de = Detector(min_size=min_size, postprocess=False)
+        print(self.de.benchmark_onnx(n_imgs))
+
+    def tune_cpu(self, batch_sizes, worker_counts, thread_counts=None, n_imgs=40, min_size=None):
+        """find and save the fastest inference batch size, DataLoader worker count and torch thread count
+
+        Args:
+            batch_sizes (list of int): batch sizes to try
+            worker_counts (list of int): DataLoader worker counts to try
+            thread_counts (list of int): torch thread counts to try. Default None tries 1, half and all cores
+            n_imgs (int): number of test images to run per configuration
+            min_size (int): inference resolution to tune at. Default None, the min_size in the architecture's model
+                config
+        """
+        self.de = Detector(min_size=min_size, postprocess=False)
+        print(self.de.tune_cpu(batch_sizes, worker_counts, thread_counts, n_imgs))
+
+    def compare_architectures(self, architectures, num_epochs, min_size=None, n_imgs=None):
+        """train each architecture in turn, and compare training time, inference speed and final-epoch accuracy
+
+        Args:
+            architectures (list of str): architectures to compare, from ml_utils.ARCHITECTURES
+            num_epochs (int): number of epochs to train each architecture
+            min_size (int): training and inference resolution. Default None, which keeps each architecture's default
+            n_imgs (int): number of test images used to measure inference speed. Default None, which uses all of them
+
+        Returns:
+            Pandas DataFrame: mean epoch time, inference frames/s, and final-epoch iou and classification accuracy
+                (see Plotter._full_epoch_eval), indexed by architecture
+        """
+        rows = []
+        for architecture in architectures:
+            self.tr = Trainer(num_epochs, True, min_size=min_size, architecture=architecture)
+            self.tr.train()
+            summary = Plotter()._full_epoch_eval(num_epochs - 1)[1]
+            self.de = Detector(min_size=min_size, architecture=architecture, postprocess=False)
+            fps, _ = self.de.time_test_set('test_architecture_{}'.format(architecture), n_imgs)
+            rows.append({'architecture': architecture, 'epoch_time': np.mean(self.tr.epoch_times),
+                         'frames_per_second': fps, 'average_iou': summary['average_iou'],
+                         'classification_accuracy': summary['classification_accuracy']})
+            print('{architecture}: {epoch_time:.1f} s/epoch, {frames_per_second:.2f} frames/s, '
+                  'average iou {average_iou:.3f}, accuracy {classification_accuracy:.3f}'.format(**rows[-1]))
+        comparison = pd.DataFrame(rows).set_index('architecture')
+        comparison.to_csv(os.path.join(self.fm.local_files['figure_data_dir'], 'architecture_comparison.csv'))
+        print(comparison)
+        return comparison
@@ -1,255 +1,163 @@
-import pandas as pd
 import numpy as np
-import itertools
-from CichlidDetection.Classes.FileManager import FileManager
-from os.path import join
+from CichlidDetection.Utilities.box_utils import iou_matrix
+from scipy.optimize import linear_sum_assignment
 
-pd.set_option('display.expand_frame_repr', False)
 
+class FishTracker:
+    """assign persistent identities to fish as the detections of successive frames come in
 
-def mapper(elements):
-    """ Create order of elements
+    Each frame, the detections are matched to the live tracks by optimal (Hungarian) assignment on a cost matrix that
+    combines the iou and the centre distance of every track/detection pair, computed for all pairs at once. A pair is
+    only allowed if the boxes overlap by at least min_iou or their centres are within max_distance pixels. Unmatched
+    detections start tentative tracks, which are given an id once they have been matched in min_hits consecutive
+    frames (birth). A track that goes unmatched for more than max_missed consecutive frames is dropped (death), and its
+    id is never reused.
 
+    The tracker is online: update() takes one frame at a time and returns the ids of its detections straight away, and
+    only the live tracks are kept, so memory does not grow with the length of the video. Its state can be saved with
+    state() and restored with load_state(), e.g. to continue tracking in the next shard of a video.
     """
-    if len(elements) == 0:
-        return []
-    else:
-        mapping = []
-        for i in range(len(elements)):
-            try:
-                mapping.append(i)
-            except ValueError:
-                mapping.append([])
 
-    return mapping
-
-
-def calc_iou(combination):
-    """ Calculate intersection / union between two different sets of coordinates
-
-    """
-    a = combination[0]
-    b = combination[1]
-    if (len(a) == 0) and (len(b) == 0):
-        iou = 1.0
-    # find area of the box formed by the intersection of a and b
-    xa, ya, xb, yb = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
-    intersection = max(0, xb - xa + 1) * max(0, yb - ya + 1)
-    # if the boxes do not intersect, short-circuit and return 0.0
-    if intersection == 0:
-        iou = 0.0
-    # else, calculate the area of the union of box_a and box_b, and return intersection/union
-    else:
-        a_area = (a[2] - a[0] + 1) * (a[3] - a[1] + 1)
-        b_area = (b[2] - b[0] + 1) * (b[3] - b[1] + 1)
-        union = float(a_area + b_area - intersection)
-        iou = intersection / union
-
-    return iou
-
-
-def combos(box):
-    if len(box) == 0 or len(box) == 1:
-        return []
-    else:
-        mapped = mapper(box)
-        combo = list(itertools.combinations(mapped, 2))
-
-    return combo
-
-
-def iou(box, frame):
-    """ Calculate IOU between box_a and box_b
-
-    """
-    iou = []
-    sets = list(itertools.combinations(box, 2))
-    for i in range(len(sets)):
-        val = calc_iou(sets[i])
-        iou.append(val)
-
-    return iou
-
-
-def update_lists(comb, iou_score, map_index, scores):
-    new_map = map_index.copy()
-    same = []
-    remove_el = []
-    score_comparison = []
-
-    for i in range(len(map_index)):
-        if scores[i] < 0.4:
-            remove_el.append(i)
-
-    for i in remove_el:
-        new_map.remove(i)
-
-    for i in range(len(comb)):
-        if iou_score[i] > 0.4:
-            same.append(comb[i])
-
-    for i in range(len(same)):
-        score_comparison.append((scores[same[i][0]], scores[same[i][1]]))
-
-    for i in range(len(new_map)):
-        for j in range(len(same)):
-            if new_map[i] in same[j]:
-                max_val = max(score_comparison[j])
-                max_el = scores.index(max_val)
-                new_map[i] = same[j][same[j].index(max_el)]
-
-    return new_map
-
-
-def num_fish(comb, iou_score, map_index, scores):
-    """ Calculate the actual number of fish within a frame
-
-    """
-    edit_elements = update_lists(comb, iou_score, map_index, scores)
-    return len(set(edit_elements))
-
-
-def update_boxes(comb, iou_score, map_index, scores, boxes, frame):
-    """ Update the actual list of box coordinates in a frame
-
-    """
-    edit_elements = update_lists(comb, iou_score, map_index, scores)
-    edit_elements = set(edit_elements)
-    update_box = []
-    for i in edit_elements:
-        update_box.append(boxes[i])
-
-    return update_box
-
-
-def update_labels(comb, iou_score, map_index, scores, labels):
-    """ Update the actual list of labels in a frame
-
-    """
-    edit_elements = update_lists(comb, iou_score, map_index, scores)
-    edit_elements = set(edit_elements)
-    update_label = []
-    for i in edit_elements:
-        update_label.append(labels[i])
-
-    return update_label
-
-
-def update_scores(comb, iou_score, map_index, scores):
-    """ Update the actual list of scores of detections present in a frame
-
-    """
-    edit_elements = update_lists(comb, iou_score, map_index, scores)
-    edit_elements = set(edit_elements)
-    update_score = []
-    for i in edit_elements:
-        update_score.append(scores[i])
-
-    return update_score
-
-
-def iou_list(box1, box2, calc_iou_score=False):
-    """ Calculate the iou between boxes between two different frames
-    """
-
-    if len(box1) == 0 or len(box2) == 0:
-        combo = []
-    else:
-        combo = list(itertools.product(box1, box2))
-
-    if calc_iou_score:
-        ious = []
-        for i in range(len(combo)):
-            val = calc_iou(combo[i])
-            ious.append(val)
-        return ious
-    else:
-        return combo
-
-
-def index_combos(box1, box2):
-    map1 = mapper(box1)
-    map2 = mapper(box2)
-
-    index_combo = iou_list(map1, map2, calc_iou_score=False)
-
-    return index_combo
-
-
-def track_id(combo, n_fish, iou_score):
-    new_map = combo
-    same_fish = []
-    sorted_map=[]
-    f_id = []
-
-    if len(iou_score) == 0 and n_fish == 0:
-        return f_id
-    elif len(iou_score) == 0 and n_fish != 0:
-        for i in range(n_fish):
-            f_id.append(i + 1)
-        return f_id
-    elif len(iou_score) > 0:
-        sorted_map = [x for _,x in sorted(zip(iou_score, new_map), reverse=True)]
-        for i in range(len(iou_score)):
-            if iou_score[i] > 0.5 and len(same_fish) < n_fish:
-                same_fish.append(sorted_map[i])
-
-    for i in range(len(same_fish)):
-        if same_fish[i][0] == same_fish[i][1]:
-            if len(f_id) < n_fish:
-                f_id.append(i + 1)
-        else:
-            if len(f_id) < n_fish:
-                f_id.insert(0, i + 1)
-
-    return f_id
+    def __init__(self, min_iou=0.1, max_distance=50.0, distance_weight=0.5, min_hits=3, max_missed=15):
+        """
+        Args:
+            min_iou (float): minimum iou for a detection to continue a track, unless their centres are close enough
+            max_distance (float): maximum centre distance in pixels for a detection to continue a track, unless their
+                boxes overlap enough
+            distance_weight (float): weight of the centre distance, as a fraction of max_distance, against 1 - iou in
+                the assignment cost
+            min_hits (int): number of consecutive matched frames before a track is given an id. 1 gives every
+                detection an id immediately
+            max_missed (int): number of consecutive unmatched frames after which a track is dropped
+        """
+        self.min_iou = min_iou
+        self.max_distance = max_distance
+        self.distance_weight = distance_weight
+        self.min_hits = min_hits
+        self.max_missed = max_missed
+        self.next_id = 1
+        self.last_frame = None
+        # state of the live tracks, one row per track. ids are 0 until a track is confirmed, and labels and scores are
+        # those of the track's latest detection
+        self.boxes = np.empty((0, 4))
+        self.ids = np.empty(0, dtype=np.int64)
+        self.hits = np.empty(0, dtype=np.int64)
+        self.missed = np.empty(0, dtype=np.int64)
+        self.labels = np.empty(0, dtype=np.int64)
+        self.scores = np.empty(0)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def cost_matrix(self, boxes):
+        """assignment cost of every live track against every detection
 
+        Args:
+            boxes (np.ndarray): [N, 4] detections in (xmin, ymin, xmax, ymax) form
 
-class Tracking:
+        Returns:
+            np.ndarray: [tracks, N] costs, with np.inf for pairs that may not be matched
+        """
+        iou = iou_matrix(self.boxes, boxes)
+        centres = (boxes[:, :2] + boxes[:, 2:]) / 2
+        track_centres = (self.boxes[:, :2] + self.boxes[:, 2:]) / 2
+        distance = np.linalg.norm(track_centres[:, None, :] - centres[None, :, :], axis=2)
+        cost = (1 - iou) + self.distance_weight * np.minimum(distance / self.max_distance, 1)
+        return np.where((iou >= self.min_iou) | (distance <= self.max_distance), cost, np.inf)
 
-    def __init__(self, *args):
-        self.fm = FileManager()
+    def update(self, frame_idx, boxes, labels, scores):
+        """match the detections of the next frame to the tracks, and update the tracks
 
-    def diff_fish(self, csv_path):
-        """ Create new columns which compares the iou scores between the boxes within a frame. Discarding all unnecessary columns.
+        Frames must be passed in increasing order. Frames skipped between two updates, e.g. frames that could not be
+        decoded, count as frames in which every track went unmatched.
 
         Args:
-                csv_path (str): path to the detections csv file
+            frame_idx (int): frame number
+            boxes (array-like): [N, 4] detections of the frame in (xmin, ymin, xmax, ymax) form
+            labels (array-like): [N] labels
+            scores (array-like): [N] scores
 
+        Returns:
+            np.ndarray: [N] id of the track each detection belongs to, or 0 for detections of tentative tracks
         """
-        df = pd.read_csv(csv_path)
-        df[['boxes', 'labels', 'scores']] = df[['boxes', 'labels', 'scores']].applymap(lambda x: eval(x))
-        df['map_index'] = df.apply(lambda x: mapper(x.boxes), axis=1)
-        df['sets'] = df.apply(lambda x: combos(x.boxes), axis=1)
-        df['iou'] = df.apply(lambda x: iou(x.boxes, x.Framefile), axis=1)
-        df['n_fish'] = df.apply(lambda x: num_fish(x.sets, x.iou, x.map_index, x.scores), axis=1)
-        df['boxes'] = df.apply(
-            lambda x: update_boxes(x.sets, x.iou, x.map_index, x.scores, x.boxes, x.Framefile),
-            axis=1)
-        df['labels'] = df.apply(
-            lambda x: update_labels(x.sets, x.iou, x.map_index, x.scores, x.labels), axis=1)
-        df['scores'] = df.apply(
-            lambda x: update_scores(x.sets, x.iou, x.map_index, x.scores),
-            axis=1)
-        df.drop(['map_index', 'sets', 'iou'], axis=1, inplace=True)
-        # df.to_csv(join(self.fm.local_files['detection_dir'], 'updated_detections.csv'))
-
-        return df
-
-    def track_fish_row(self, dd):
-        """ Create new columns which compares the iou scores between the corresponding boxes in two different frames.
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        labels = np.asarray(labels, dtype=np.int64)
+        scores = np.asarray(scores, dtype=np.float64)
+        gap = 0 if self.last_frame is None else frame_idx - self.last_frame - 1
+        self.last_frame = frame_idx
+        track_rows = np.empty(0, dtype=np.int64)
+        det_rows = np.empty(0, dtype=np.int64)
+        if len(self) and len(boxes):
+            cost = self.cost_matrix(boxes)
+            # linear_sum_assignment needs finite costs, so forbidden pairs get a cost above any allowed one, and
+            # are discarded after the assignment
+            forbidden = ~np.isfinite(cost)
+            track_rows, det_rows = linear_sum_assignment(np.where(forbidden, 2 + self.distance_weight, cost))
+            allowed = ~forbidden[track_rows, det_rows]
+            track_rows, det_rows = track_rows[allowed], det_rows[allowed]
+
+        matched = np.zeros(len(self), dtype=bool)
+        matched[track_rows] = True
+        self.boxes[track_rows] = boxes[det_rows]
+        self.labels[track_rows] = labels[det_rows]
+        self.scores[track_rows] = scores[det_rows]
+        self.hits = np.where(matched & (gap == 0), self.hits + 1, matched.astype(np.int64))
+        self.missed = np.where(matched, 0, self.missed + gap + 1)
+        # birth: confirmed tentative tracks take the next ids
+        born = (self.ids == 0) & (self.hits >= self.min_hits)
+        self.ids[born] = self.next_id + np.arange(born.sum())
+        self.next_id += int(born.sum())
+
+        det_ids = np.zeros(len(boxes), dtype=np.int64)
+        det_ids[det_rows] = self.ids[track_rows]
+
+        # unmatched detections start new tracks
+        new = np.setdiff1d(np.arange(len(boxes)), det_rows)
+        new_ids = np.zeros(len(new), dtype=np.int64)
+        if self.min_hits <= 1:
+            new_ids = self.next_id + np.arange(len(new))
+            self.next_id += len(new)
+            det_ids[new] = new_ids
+        # death: drop tracks missed for too long, and tentative tracks as soon as they miss a frame
+        alive = (self.missed <= self.max_missed) & ((self.ids > 0) | (self.missed == 0))
+        self.boxes = np.concatenate([self.boxes[alive], boxes[new]])
+        self.ids = np.concatenate([self.ids[alive], new_ids])
+        self.hits = np.concatenate([self.hits[alive], np.ones(len(new), dtype=np.int64)])
+        self.missed = np.concatenate([self.missed[alive], np.zeros(len(new), dtype=np.int64)])
+        self.labels = np.concatenate([self.labels[alive], labels[new]])
+        self.scores = np.concatenate([self.scores[alive], scores[new]])
+        return det_ids
+
+    def track_chunk(self, detections):
+        """track the frames of a detection store or DetectionBuffer chunk, in order
 
         Args:
-                dd: Dataframe containing the updated labels
+            detections (dict): frames in increasing order, in the format of a detection store
 
+        Returns:
+            dict: the same arrays, with a 'track_ids' array holding the track id of each box
         """
-        df = dd
-        df['box_tracking'] = df['boxes'].shift(periods=1)
-        df['box_tracking'] = [list() if x is np.NaN else x for x in df['box_tracking']]
-        df['sets'] = df.apply(lambda x: index_combos(x.boxes, x.box_tracking), axis=1)
-        df['iou'] = df.apply(lambda x: iou_list(x.boxes, x.box_tracking, calc_iou_score=True), axis=1)
-        df['n_fish'] = df.apply(lambda x: len(x.boxes), axis=1) # updating the num of fish
-        df['fish_ID'] = df.apply(lambda x: track_id(x.sets, x.n_fish, x.iou), axis=1)
-        df.to_csv(join(self.fm.local_files['detection_dir'], 'updated_detections.csv'))
-        df.drop(['box_tracking', 'sets', 'iou'], axis=1, inplace=True)
-        return df
\ No newline at end of file
+        offsets = detections['offsets']
+        track_ids = np.zeros(offsets[-1], dtype=np.int64)
+        for i, frame in enumerate(detections['frames'].tolist()):
+            rows = slice(offsets[i], offsets[i + 1])
+            track_ids[rows] = self.update(frame, detections['boxes'][rows], detections['labels'][rows],
+                                          detections['scores'][rows])
+        return dict(detections, track_ids=track_ids)
+
+    def state(self):
+        """the live tracks and id counter, as a json-serializable dict for load_state()"""
+        return {'next_id': self.next_id, 'last_frame': self.last_frame, 'boxes': self.boxes.tolist(),
+                'ids': self.ids.tolist(), 'hits': self.hits.tolist(), 'missed': self.missed.tolist(),
+                'labels': self.labels.tolist(), 'scores': self.scores.tolist()}
+
+    def load_state(self, state):
+        """continue from a state saved by state()"""
+        self.next_id = state['next_id']
+        self.last_frame = state['last_frame']
+        self.boxes = np.asarray(state['boxes'], dtype=np.float64).reshape(-1, 4)
+        self.ids = np.asarray(state['ids'], dtype=np.int64)
+        self.hits = np.asarray(state['hits'], dtype=np.int64)
+        self.missed = np.asarray(state['missed'], dtype=np.int64)
+        self.labels = np.asarray(state['labels'], dtype=np.int64)
+        self.scores = np.asarray(state['scores'], dtype=np.float64)
@@ -1,19 +1,22 @@
 import os
 import time
-import pandas as pd
+import numpy as np
 import torch
-import torchvision
 from torchvision.transforms import functional as F
 from CichlidDetection.Classes.DataSet import DataSet
 from CichlidDetection.Classes.FileManager import FileManager
 from CichlidDetection.Utilities.utils import AverageMeter, Logger
-from CichlidDetection.Utilities.ml_utils import collate_fn, Compose, ToTensor, RandomHorizontalFlip
+from CichlidDetection.Utilities.ml_utils import collate_fn, Compose, ToTensor, RandomHorizontalFlip, build_model, \
+    model_config_file, save_model_config
+from CichlidDetection.Utilities.cpu_profile import load_profile, apply_profile
+from CichlidDetection.Utilities.detection_buffer import DetectionBuffer
+from CichlidDetection.Utilities.detection_store import STORE_EXTENSION, save_detections, concatenate_detections
 
 
 class Trainer:
     """class to coordinate model training and evaluation"""
 
-    def __init__(self, num_epochs, compare_annotations=True):
+    def __init__(self, num_epochs, compare_annotations=True, min_size=None, architecture='resnet50_fpn'):
         """initialize trainer
 
         Args:
@@ -21,10 +24,22 @@ class Trainer:
             compare_annotations: If True, evaluate the model on the test set after each epoch. This does not affect the
                 end result of training, but does produce more data about model performance at each epoch. Setting to
                 True also increases total runtime significantly
+            min_size (int): resolution the model resizes images to, as the length of the shorter side. Should match
+                the min_size the Detector will use. Defaults to None, which uses torchvision's default for the
+                architecture
+            architecture (str): detection architecture to train, from ml_utils.ARCHITECTURES. It is saved in a config
+                file next to the weights, so the Detector rebuilds the same model
         """
         self.compare_annotations = compare_annotations
         self.fm = FileManager()
         self.num_epochs = num_epochs
+        self.min_size = min_size
+        self.architecture = architecture
+        self.epoch_times = []
+        # DataLoader workers and torch threads tuned for this machine by Detector.tune_cpu(), if available. The tuned
+        # batch size is not used, as it would change the optimization rather than just the speed
+        self.profile = load_profile(self.fm.local_files['cpu_profile'])
+        apply_profile(self.profile)
         self._initiate_loaders()
         self._initiate_model()
         self._initiate_loggers()
@@ -32,7 +47,9 @@ class Trainer:
     def train(self):
         """train the model for the specified number of epochs."""
         for epoch in range(self.num_epochs):
+            start = time.time()
             loss = self._train_epoch(epoch)
+            self.epoch_times.append(time.time() - start)
             self.scheduler.step(loss)
             if self.compare_annotations:
                 self._evaluate_epoch(epoch)
@@ -42,14 +59,17 @@ class Trainer:
         """initiate train and test datasets and  dataloaders."""
         self.train_dataset = DataSet(self._get_transform(train=True), 'train')
         self.test_dataset = DataSet(self._get_transform(train=False), 'test')
+        num_workers = self.profile['num_workers']
         self.train_loader = torch.utils.data.DataLoader(
-            self.train_dataset, batch_size=5, shuffle=True, num_workers=8, pin_memory=True, collate_fn=collate_fn)
+            self.train_dataset, batch_size=5, shuffle=True, num_workers=num_workers, pin_memory=True,
+            collate_fn=collate_fn)
         self.test_loader = torch.utils.data.DataLoader(
-            self.test_dataset, batch_size=5, shuffle=False, num_workers=8, pin_memory=True, collate_fn=collate_fn)
+            self.test_dataset, batch_size=5, shuffle=False, num_workers=num_workers, pin_memory=True,
+            collate_fn=collate_fn)
 
     def _initiate_model(self):
         """initiate the model, optimizer, and scheduler."""
-        self.model = torchvision.models.detection.fasterrcnn_resnet50_fpn(num_classes=3, box_detections_per_img=5)
+        self.model = build_model(self.architecture, self.min_size, box_detections_per_img=5)
         self.parameters = self.model.parameters()
         self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
         torch.cuda.empty_cache()
@@ -157,23 +177,33 @@ class Trainer:
         print('evaluating epoch {}'.format(epoch))
         self.model.eval()
         cpu_device = torch.device("cpu")
-        results = {}
+        buffer = DetectionBuffer()
         for i, (images, targets) in enumerate(self.test_loader):
             images = list(img.to(self.device) for img in images)
-            targets = [{k: v.to(self.device) for k, v in t.items()} for t in targets]
             outputs = self.model(images)
-            outputs = [{k: v.to(cpu_device).numpy().tolist() for k, v in t.items()} for t in outputs]
-            results.update({target["image_id"].item(): output for target, output in zip(targets, outputs)})
-        df = pd.DataFrame.from_dict(results, orient='index')
-        df['Framefile'] = [os.path.basename(path) for path in self.test_dataset.img_files]
-        df = df[['Framefile', 'boxes', 'labels', 'scores']].set_index('Framefile')
-        df.to_csv(os.path.join(self.fm.local_files['predictions_dir'], '{}.csv'.format(epoch)))
+            for target, output in zip(targets, outputs):
+                buffer.append(target['image_id'].item(), *(output[k].to(cpu_device).numpy()
+                                                           for k in ['boxes', 'labels', 'scores']))
+        detections = concatenate_detections(list(buffer.iter_chunks()))
+        detections['framefiles'] = np.array([os.path.basename(self.test_dataset.img_files[f])
+                                             for f in detections['frames']], dtype=str)
+        save_detections(os.path.join(self.fm.local_files['predictions_dir'], '{}{}'.format(epoch, STORE_EXTENSION)),
+                        detections)
 
     def _save_model(self):
-        """save the weights file (state dict) for the model."""
+        """save the weights file (state dict) for the model, and the config needed to rebuild it.
+
+        The weights are saved as last.weights, and also as <architecture>.weights so that the most recent model of each
+        architecture stays available to the Detector.
+        """
         dest = self.fm.local_files['weights_file']
         if os.path.exists(dest):
             path = os.path.join(self.fm.local_files['weights_dir'], str(int(os.path.getmtime(dest))) + '.weights')
+            if os.path.exists(model_config_file(dest)):
+                os.rename(model_config_file(dest), model_config_file(path))
             os.rename(dest, path)
-        torch.save(self.model.state_dict(), dest)
+        config = {'architecture': self.architecture, 'min_size': self.min_size}
+        for path in [dest, os.path.join(self.fm.local_files['weights_dir'], '{}.weights'.format(self.architecture))]:
+            torch.save(self.model.state_dict(), path)
+            save_model_config(path, config)
 
@@ -1,17 +1,15 @@
 import os
 import cv2
+import numpy as np
 from os.path import join
-from CichlidDetection.Classes.TrackingFish import Tracking
+from CichlidDetection.Classes.TrackingFish import FishTracker
 from CichlidDetection.Classes.FileManager import FileManager
+from CichlidDetection.Utilities.detection_store import convert_csv
+from CichlidDetection.Utilities.detection_table import DetectionTable
+from CichlidDetection.Utilities.decoders import DECODERS
 # from CichlidDetection.Classes.FileManager import ProjectFileManager
 
 
-def convert_pos(x1, y1, x2, y2):
-    # convert coordinates to desired format for cv2
-    x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
-    return [(x1, y1), (x2, y2)]
-
-
 class VideoAnnotation:
     """ For each video successively plot the predicted boxes and labels to create a new annotated video
 
@@ -19,33 +17,61 @@ class VideoAnnotation:
             pid: Project ID
             video_path: Path specifying the location of the ~10h video
             video: Name of the video
-            csv_file: Name of the csv file containing all the predicted boxes and labels
+            store_file: Name of the detection archive or store containing all the predicted boxes and labels
             *args: Project File Manager function
+            decoder: Name of the video decoding backend (see CichlidDetection.Utilities.decoders)
+            start_frame: First frame of the annotated video
+            end_frame: Frame after the last frame of the annotated video. Defaults to None, the end of the video
+
+    Only the detections of the annotated frames are read, so a short window of a long video starts quickly.
 
     """
 
-    def __init__(self, pid, video_path, video, csv_file, *args):
+    def __init__(self, pid, video_path, video, store_file, *args, decoder='opencv', start_frame=0, end_frame=None):
 
         self.fm = FileManager()
-        self.track = Tracking()
         for i in args:
             self.pfm = i
         self.detection_dir = self.fm.local_files['detection_dir']
         self.video = video_path
         self.video_name = video.split('.')[0]
         self.ann_video_name = 'annotated_' + pid + '_' + self.video_name + '_p2.mp4'
-        self.csv_file_path = join(self.detection_dir, csv_file)
+        self.store_path = join(self.detection_dir, store_file)
+        self.decoder = decoder
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+
+    def read_detections(self, start_frame, end_frame):
+        """ Read the detections of the annotated frames, with the track id of every box
+
+        Detections are filtered by the Detector's postprocessor as they are written, so they are drawn as stored.
+        Archives written with tracking already hold the track ids, and other stores are tracked here.
+
+        Args:
+                start_frame: First frame to read
+                end_frame: Frame after the last frame to read
+
+        Returns:
+                Pandas DataFrame: boxes, labels, scores and track_ids of each frame, indexed by frame number
+
+        """
+        path = self.store_path
+        if path.endswith('.csv'):
+            path = convert_csv(path)
+        table = DetectionTable.load(path, start_frame, end_frame)
+        if table.track_ids is None:
+            table.track_ids = FishTracker().track_chunk(table.to_detections())['track_ids']
+        # rows are indexed by frame number, since frames that could not be decoded during detection have no row
+        return table.to_dataframe().set_index('frame')
 
     def annotate(self):
 
-        dd = self.track.diff_fish(self.csv_file_path)
-        df = self.track.track_fish_row(dd)
+        cap = DECODERS[self.decoder](self.video, rgb=False)
+        vid_len = cap.frame_count if self.end_frame is None else min(self.end_frame, cap.frame_count)
+        size = (cap.width, cap.height)
+        cap.seek(self.start_frame)
 
-        cap = cv2.VideoCapture(self.video)
-        vid_len = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        frame_width = int(cap.get(3))
-        frame_height = int(cap.get(4))
-        size = (frame_width, frame_height)
+        df = self.read_detections(self.start_frame, vid_len)
 
         # font details - add frame name to the video frames
         font = cv2.FONT_HERSHEY_SIMPLEX
@@ -58,26 +84,27 @@ class VideoAnnotation:
                                  10, size)
 
         # count = 0
-        for i in range(vid_len):
-            ret, frame = cap.read()
-            if not ret:
+        for i in range(self.start_frame, vid_len):
+            frame = cap.read()
+            if frame is None:
                 print("VideoError: Couldn't read frame ", i)
                 break
+            elif i not in df.index:
+                result.write(frame)
             else:
-                box_preds = df.boxes[i]
-                box_preds = [convert_pos(*p) for p in box_preds]
+                # integer pixel coordinates for cv2
+                box_preds = np.asarray(df.boxes[i], dtype=np.float64).reshape(-1, 4).astype(int).tolist()
                 label_preds = df.labels[i]
-                scores = df.scores[i]
-                n_fish = df.n_fish[i]
-                fish_ID = df.fish_ID[i]
+                fish_ID = df.track_ids[i]
                 color_lookup = {1: (255, 153, 255), 2: (255, 0, 0)}
                 font_text = 'Frame_{}.jpg'.format(i)
                 cv2.putText(frame, font_text, (x, y), font, font_size, font_color, font_thickness, cv2.LINE_AA)
                 for j in range(len(fish_ID)):
-                    start, end = box_preds[j][0], box_preds[j][1]
+                    start, end = box_preds[j][:2], box_preds[j][2:]
                     cv2.rectangle(frame, (start[0], start[1]), (end[0], end[1]), color_lookup[label_preds[j]], 2)
-                    cv2.putText(frame, 'fish {}'.format(fish_ID[j]), (end[0] + 2, end[1] - 5), font, font_size, (0, 0, 0), 1,
-                                cv2.LINE_AA)
+                    # fish that have not been tracked long enough to be confirmed have id 0
+                    fish_text = 'fish {}'.format(fish_ID[j]) if fish_ID[j] else 'fish ?'
+                    cv2.putText(frame, fish_text, (end[0] + 2, end[1] - 5), font, font_size, (0, 0, 0), 1, cv2.LINE_AA)
                     result.write(frame)
                     print('Completed Annotating Frame {}'.format(i))
                     if cv2.waitKey(1) & 0xFF == ord('q'):
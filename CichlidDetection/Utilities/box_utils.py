@@ -0,0 +1,210 @@
+import numpy as np
+
+
+def pair_iou(boxes_a, boxes_b):
+    """calculate the iou of boxes, broadcasting over all leading dimensions
+
+    This is the single iou routine of the package: iou_matrix and frame_pair_iou call it with broadcast or gathered
+    pairs of boxes.
+
+    Notes:
+        boxes are in pixel-inclusive coordinates, so widths and heights are xmax - xmin + 1 and ymax - ymin + 1
+
+    Args:
+        boxes_a (np.ndarray): [..., 4] boxes in (xmin, ymin, xmax, ymax) form
+        boxes_b (np.ndarray): [..., 4] boxes in (xmin, ymin, xmax, ymax) form, broadcastable against boxes_a
+
+    Returns:
+        np.ndarray: iou of each pair of boxes, with the broadcast shape of the leading dimensions
+    """
+    a = np.asarray(boxes_a, dtype=np.float64)
+    b = np.asarray(boxes_b, dtype=np.float64)
+    width = np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]) + 1
+    height = np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]) + 1
+    intersection = np.clip(width, 0, None) * np.clip(height, 0, None)
+    area_a = (a[..., 2] - a[..., 0] + 1) * (a[..., 3] - a[..., 1] + 1)
+    area_b = (b[..., 2] - b[..., 0] + 1) * (b[..., 3] - b[..., 1] + 1)
+    return intersection / (area_a + area_b - intersection)
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """calculate the iou between every box in boxes_a and every box in boxes_b
+
+    Args:
+        boxes_a (array-like): [N, 4] boxes in (xmin, ymin, xmax, ymax) form
+        boxes_b (array-like): [M, 4] boxes in (xmin, ymin, xmax, ymax) form
+
+    Returns:
+        np.ndarray: [N, M] array, where element [i, j] is the iou of boxes_a[i] and boxes_b[j]
+    """
+    a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+    return pair_iou(a[:, None, :], b[None, :, :])
+
+
+def frame_pairs(starts_a, counts_a, starts_b, counts_b):
+    """enumerate every pair of boxes (one from a, one from b) within each of many frames
+
+    Frame i has boxes starts_a[i]:starts_a[i] + counts_a[i] of a flat array a and starts_b[i]:starts_b[i] + counts_b[i]
+    of a flat array b. The pairs of a frame follow those of the frame before it, and within a frame are ordered as in
+    itertools.product, i.e. by the box of a and then by the box of b, so each box of a has a contiguous run of pairs.
+
+    Args:
+        starts_a, counts_a, starts_b, counts_b (np.ndarray): first row and number of rows of each frame in a and b
+
+    Returns:
+        tuple of np.ndarray: frame index, row in a and row in b of every pair
+    """
+    counts_a = np.asarray(counts_a, dtype=np.int64)
+    counts_b = np.asarray(counts_b, dtype=np.int64)
+    n_pairs = counts_a * counts_b
+    frame = np.repeat(np.arange(len(n_pairs)), n_pairs)
+    k = np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+    width = counts_b[frame]
+    return frame, np.asarray(starts_a)[frame] + k // width, np.asarray(starts_b)[frame] + k % width
+
+
+def frame_pair_iou(boxes_a, starts_a, counts_a, boxes_b, starts_b, counts_b):
+    """calculate the iou of every pair of boxes within each of many frames at once (see frame_pairs)
+
+    Returns:
+        tuple of np.ndarray: frame index, row in boxes_a, row in boxes_b and iou of every pair
+    """
+    frame, rows_a, rows_b = frame_pairs(starts_a, counts_a, starts_b, counts_b)
+    a = np.asarray(boxes_a).reshape(-1, 4)
+    b = np.asarray(boxes_b).reshape(-1, 4)
+    return frame, rows_a, rows_b, pair_iou(a[rows_a], b[rows_b])
+
+
+def match_boxes(iou, threshold=0.3):
+    """greedily pair the rows and columns of an iou matrix, starting from the highest iou
+
+    Args:
+        iou (np.ndarray): [N, M] iou matrix, e.g. from iou_matrix()
+        threshold (float): minimum iou for two boxes to be paired
+
+    Returns:
+        tuple of np.ndarray: row indices and column indices of the matched pairs
+    """
+    rows, cols = [], []
+    for flat in np.argsort(iou, axis=None, kind='stable')[::-1]:
+        row, col = divmod(int(flat), iou.shape[1])
+        if iou[row, col] < threshold:
+            break
+        if row not in rows and col not in cols:
+            rows.append(row)
+            cols.append(col)
+    return np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)
+
+
+def interpolate_detections(prev, nxt, t, iou_threshold=0.3):
+    """estimate the detections for a frame that lies between two frames that were run through the model
+
+    boxes in the two keyframes are paired by iou. The boxes and scores of each pair are linearly interpolated, and the
+    label is taken from the nearer keyframe. Unpaired boxes are kept only from the nearer keyframe.
+
+    Args:
+        prev (dict): 'boxes', 'labels' and 'scores' of the earlier keyframe
+        nxt (dict): 'boxes', 'labels' and 'scores' of the later keyframe
+        t (float): position of the frame between the keyframes, where 0 is prev and 1 is nxt
+        iou_threshold (float): minimum iou for boxes in the two keyframes to be treated as the same fish
+
+    Returns:
+        dict: 'boxes', 'labels' and 'scores' numpy arrays for the frame, sorted by descending score
+    """
+    p_boxes, n_boxes = (np.asarray(d['boxes'], dtype=np.float64).reshape(-1, 4) for d in (prev, nxt))
+    p_labels, n_labels = (np.asarray(d['labels'], dtype=np.int64) for d in (prev, nxt))
+    p_scores, n_scores = (np.asarray(d['scores'], dtype=np.float64) for d in (prev, nxt))
+
+    p_idx, n_idx = match_boxes(iou_matrix(p_boxes, n_boxes), iou_threshold)
+    boxes = (1 - t) * p_boxes[p_idx] + t * n_boxes[n_idx]
+    scores = (1 - t) * p_scores[p_idx] + t * n_scores[n_idx]
+    if t < 0.5:
+        labels = p_labels[p_idx]
+        extra = np.setdiff1d(np.arange(len(p_scores)), p_idx)
+        boxes, labels, scores = (np.concatenate([boxes, p_boxes[extra]]), np.concatenate([labels, p_labels[extra]]),
+                                 np.concatenate([scores, p_scores[extra]]))
+    else:
+        labels = n_labels[n_idx]
+        extra = np.setdiff1d(np.arange(len(n_scores)), n_idx)
+        boxes, labels, scores = (np.concatenate([boxes, n_boxes[extra]]), np.concatenate([labels, n_labels[extra]]),
+                                 np.concatenate([scores, n_scores[extra]]))
+
+    order = np.argsort(-scores, kind='stable')
+    return {'boxes': boxes[order], 'labels': labels[order], 'scores': scores[order]}
+
+
+def frame_iou(actual_boxes, predicted_boxes):
+    """calculate the average iou for a frame, following the same conventions as Plotter._calc_frame_iou
+
+    each ground truth box is scored by its best-matching predicted box, and any predicted boxes in excess of the number
+    of ground truth boxes are scored 0.0. An empty frame with no predictions scores 1.0.
+
+    Args:
+        actual_boxes (array-like): [N, 4] ground truth boxes in (xmin, ymin, xmax, ymax) form
+        predicted_boxes (array-like): [M, 4] predicted boxes in (xmin, ymin, xmax, ymax) form
+
+    Returns:
+        float: mean iou value for the frame
+    """
+    a = np.asarray(actual_boxes, dtype=np.float64).reshape(-1, 4)
+    p = np.asarray(predicted_boxes, dtype=np.float64).reshape(-1, 4)
+    if len(a) == 0 and len(p) == 0:
+        return 1.0
+    if len(a) == 0 or len(p) == 0:
+        return 0.0
+    ious = iou_matrix(a, p).max(axis=1)
+    return float(ious.sum() / max(len(a), len(p)))
+
+
+def xyminmax_to_xywh(boxes):
+    """convert boxes from (xmin, ymin, xmax, ymax) form to (x, y, w, h) form
+
+    Args:
+        boxes (array-like): [N, 4] boxes, or a single box of 4 values
+
+    Returns:
+        np.ndarray: boxes of the same shape in (x, y, w, h) form
+    """
+    boxes = np.array(boxes, dtype=np.float64)
+    boxes[..., 2:] -= boxes[..., :2]
+    return boxes
+
+
+def xywh_to_xyminmax(boxes):
+    """convert boxes from (x, y, w, h) form to (xmin, ymin, xmax, ymax) form
+
+    Args:
+        boxes (array-like): [N, 4] boxes, or a single box of 4 values
+
+    Returns:
+        np.ndarray: boxes of the same shape in (xmin, ymin, xmax, ymax) form
+    """
+    boxes = np.array(boxes, dtype=np.float64)
+    boxes[..., 2:] += boxes[..., :2]
+    return boxes
+
+
+def inside_region(points, region):
+    """test which points lie inside a rectangle or polygon
+
+    Args:
+        points (array-like): [N, 2] (x, y) points
+        region (array-like): (xmin, ymin, xmax, ymax) rectangle, or [K, 2] polygon vertices in order, e.g. the tank
+            corners of a project's video points numpy
+
+    Returns:
+        np.ndarray: [N] boolean array
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    region = np.asarray(region, dtype=np.float64)
+    x, y = points[:, 0], points[:, 1]
+    if region.shape == (4,):
+        return (x >= region[0]) & (x <= region[2]) & (y >= region[1]) & (y <= region[3])
+    # even-odd rule: count the polygon edges crossed by a ray running from each point towards +x
+    x1, y1 = region[:, 0], region[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+    straddles = (y1[None, :] > y[:, None]) != (y2[None, :] > y[:, None])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing = x1[None, :] + (y[:, None] - y1[None, :]) * (x2 - x1)[None, :] / (y2 - y1)[None, :]
+    return np.count_nonzero(straddles & (x[:, None] < crossing), axis=1) % 2 == 1
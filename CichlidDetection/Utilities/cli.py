@@ -0,0 +1,51 @@
+from CichlidDetection.Utilities.ml_utils import ARCHITECTURES
+
+
+def add_detection_arguments(parser):
+    """add the video detection options shared by VideoDetection.py and ProjectDetection.py to an argument parser
+
+    Args:
+        parser (argparse.ArgumentParser): parser of the script
+
+    Returns:
+        argparse.ArgumentParser: parser, with the options added
+    """
+    parser.add_argument('--shard_size', type=int, default=18000, help='Number of frames per detection shard')
+    parser.add_argument('--stride', type=int, default=1,
+                        help='Run the model on every Nth frame only and interpolate the frames in between')
+    parser.add_argument('--gate', action='append', choices=['motion', 'brightness'], dest='gates',
+                        help='Skip the model on frames rejected by this gate. May be given more than once')
+    parser.add_argument('--roi', choices=['crop', 'mask'],
+                        help='Run the model on the tank region only: crop to it, or crop and mask pixels outside the '
+                             'tank')
+    parser.add_argument('--decoder', choices=['opencv', 'ffmpeg'], default='opencv', help='Video decoding backend')
+    parser.add_argument('--decoder_threads', type=int, default=0,
+                        help='Decoding threads per worker. 0 lets the backend decide')
+    parser.add_argument('--ingest', choices=['dataloader', 'ring'], default='dataloader',
+                        help='Pass frames to the model through DataLoader workers or a shared-memory ring buffer')
+    parser.add_argument('--min_size', type=int,
+                        help='Inference resolution (shorter frame side). Should match the resolution used in training')
+    parser.add_argument('--quantize', action='store_true', help='Run an int8 quantized model on the CPU')
+    parser.add_argument('--backend', choices=['torch', 'onnx'], default='torch',
+                        help='Run the model in pytorch, or as an ONNX export with ONNX Runtime on the CPU')
+    parser.add_argument('--min_score', type=float, default=0.4, help='Drop detections scoring below this')
+    parser.add_argument('--nms_iou', type=float, default=0.4,
+                        help='Keep only the highest-scoring of detections overlapping by more than this iou, whatever '
+                             'their sex')
+    parser.add_argument('--max_detections', type=int, help='Keep at most this many detections per frame')
+    parser.add_argument('--inside_tank', action='store_true', help='Drop detections centred outside the tank')
+    parser.add_argument('--architecture', choices=list(ARCHITECTURES),
+                        help='Use the most recent weights trained with this architecture, instead of last.weights')
+    return parser
+
+
+def postprocess_settings(args):
+    """Postprocessor settings given by the options of add_detection_arguments, for the Detector's postprocess argument
+
+    Args:
+        args (argparse.Namespace): parsed arguments
+
+    Returns:
+        dict: min_score, nms_iou and max_detections
+    """
+    return {'min_score': args.min_score, 'nms_iou': args.nms_iou, 'max_detections': args.max_detections}
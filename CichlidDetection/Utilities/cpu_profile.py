@@ -0,0 +1,70 @@
+import os
+import json
+import platform
+import resource
+import torch
+
+#: loader and threading settings used when no profile has been saved for the current machine
+DEFAULT_PROFILE = {'batch_size': 5, 'num_workers': 8, 'torch_threads': None}
+
+
+def available_cpus():
+    """number of cores this process may run on, which on a cluster node is the job's allocation rather than the node"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def machine_key():
+    """key identifying the type of machine a profile was tuned on, e.g. 'x86_64_24cpu'"""
+    return '{}_{}cpu'.format(platform.machine(), available_cpus())
+
+
+def load_profile(path):
+    """load the tuned settings for the current machine, falling back to DEFAULT_PROFILE
+
+    Args:
+        path (str): profile json file, written by save_profile
+
+    Returns:
+        dict: batch_size, num_workers and torch_threads (None leaves torch's default), plus any benchmark results
+    """
+    profile = dict(DEFAULT_PROFILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            profile.update(json.load(f).get(machine_key(), {}))
+    return profile
+
+
+def save_profile(path, settings):
+    """save tuned settings for the current machine, keeping the profiles of other machines in the same file
+
+    Args:
+        path (str): profile json file
+        settings (dict): batch_size, num_workers and torch_threads, plus any benchmark results worth recording
+    """
+    profiles = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            profiles = json.load(f)
+    profiles[machine_key()] = settings
+    with open(path, 'w') as f:
+        json.dump(profiles, f, indent=2, sort_keys=True)
+
+
+def apply_profile(profile):
+    """set the torch intra-op thread count from a profile, if it specifies one"""
+    if profile.get('torch_threads'):
+        torch.set_num_threads(profile['torch_threads'])
+
+
+def peak_rss_mb():
+    """peak resident memory of this process, and of the largest of its finished child processes, in MB
+
+    Returns:
+        tuple of float: peak rss of this process, peak rss of the largest child process
+    """
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    scale = 1 / 2 ** 20 if platform.system() == 'Darwin' else 1 / 2 ** 10
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
@@ -0,0 +1,285 @@
+import os
+import re
+import queue
+import subprocess
+import tempfile
+import threading
+import time
+import cv2
+import numpy as np
+from CichlidDetection.Utilities.ml_utils import resolution_kwargs, scaled_size
+
+
+class VideoDecoder:
+    """base class for sequential video readers that return uint8 frames, optionally cropped and scaled
+
+    Decoders read forward from the position set by seek(). read() returns the next frame as an [H, W, 3] uint8 array,
+    or None if it could not be decoded, and grab() advances past the next frame without returning it.
+    """
+
+    def __init__(self, path, crop=None, size=None, rgb=True, threads=0):
+        """
+        Args:
+            path (str): path to the video file
+            crop (tuple): optional (xmin, ymin, xmax, ymax) region to crop each frame to, in native coordinates
+            size (tuple): optional (width, height) to scale each (cropped) frame to
+            rgb (bool): if True (default) return frames in RGB order, else in OpenCV's BGR order
+            threads (int): number of decoding threads. 0 (default) lets the backend decide
+        """
+        self.path = path
+        self.width, self.height, self.frame_count, self.fps = probe_video(path)
+        self.crop = crop
+        self.size = size
+        self.rgb = rgb
+        self.threads = threads
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def seek(self, frame):
+        raise NotImplementedError
+
+    def read(self):
+        raise NotImplementedError
+
+    def grab(self):
+        return self.read() is not None
+
+    def release(self):
+        pass
+
+
+class OpenCVDecoder(VideoDecoder):
+    """decoder backed by cv2.VideoCapture. Cropping and scaling are applied after decoding
+
+    threads is passed to OpenCV's FFmpeg backend where the installed OpenCV version supports it.
+    """
+
+    def __init__(self, path, crop=None, size=None, rgb=True, threads=0):
+        VideoDecoder.__init__(self, path, crop, size, rgb, threads)
+        if threads > 0 and hasattr(cv2, 'CAP_PROP_N_THREADS'):
+            self.cap = cv2.VideoCapture(path, cv2.CAP_FFMPEG, [cv2.CAP_PROP_N_THREADS, threads])
+        else:
+            self.cap = cv2.VideoCapture(path)
+
+    def seek(self, frame):
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame)
+
+    def read(self):
+        ret, frame = self.cap.read()
+        if not ret:
+            return None
+        if self.crop is not None:
+            xmin, ymin, xmax, ymax = self.crop
+            frame = frame[ymin:ymax, xmin:xmax]
+        if self.size is not None and self.size != (frame.shape[1], frame.shape[0]):
+            frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) if self.rgb else frame
+
+    def grab(self):
+        return self.cap.grab()
+
+    def release(self):
+        self.cap.release()
+
+
+class FFmpegDecoder(VideoDecoder):
+    """decoder that pipes raw frames from an ffmpeg subprocess
+
+    ffmpeg decodes with multiple threads and applies the crop and scale filters before frames leave the subprocess, so
+    only the final pixels are copied into Python. Seeking restarts the subprocess at the frame's timestamp, which
+    assumes a constant frame rate. The nominal frame rate reported by ffmpeg is used rather than the average rate,
+    which missing frames would skew.
+
+    ffmpeg drops frames it cannot decode rather than reporting them, so the frames are numbered by their timestamps,
+    which ffmpeg logs through the showinfo filter while passing them through unchanged (-vsync passthrough). A frame
+    number missing from that sequence is read as None, like an undecodable frame of the OpenCV decoder, so the frames
+    after it keep their numbers.
+    """
+
+    def __init__(self, path, crop=None, size=None, rgb=True, threads=0, executable='ffmpeg'):
+        VideoDecoder.__init__(self, path, crop, size, rgb, threads)
+        self.executable = executable
+        self.frame_rate = _nominal_frame_rate(path, executable) or self.fps
+        if size is not None:
+            self.out_width, self.out_height = size
+        elif crop is not None:
+            self.out_width, self.out_height = crop[2] - crop[0], crop[3] - crop[1]
+        else:
+            self.out_width, self.out_height = self.width, self.height
+        self.frame_bytes = self.out_width * self.out_height * 3
+        self.proc = None
+        self.seek(0)
+
+    def seek(self, frame):
+        # the subprocess is already at the next frame, e.g. after a missing frame was read as None
+        if self.proc is not None and frame == self.position:
+            return
+        self.release()
+        self.position = frame
+        self.pending = None
+        self.frame_numbers = queue.Queue()
+        # showinfo comes first, so it logs every decoded frame before cropping and scaling
+        filters = ['showinfo']
+        if self.crop is not None:
+            xmin, ymin, xmax, ymax = self.crop
+            filters.append('crop={}:{}:{}:{}'.format(xmax - xmin, ymax - ymin, xmin, ymin))
+        if self.size is not None:
+            filters.append('scale={}:{}:flags=area'.format(*self.size))
+        command = [self.executable, '-hide_banner', '-v', 'info', '-threads', str(self.threads)]
+        # seek half a frame early, so that rounding cannot skip the requested frame
+        seek_time = max(frame - 0.5, 0) / self.frame_rate
+        if frame > 0:
+            command.extend(['-ss', '{:.6f}'.format(seek_time)])
+        command.extend(['-i', self.path])
+        command.extend(['-vf', ','.join(filters), '-vsync', 'passthrough'])
+        command.extend(['-f', 'rawvideo', '-pix_fmt', 'rgb24' if self.rgb else 'bgr24', '-'])
+        self.proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                     bufsize=self.frame_bytes * 4)
+        threading.Thread(target=self._read_frame_numbers, args=(self.proc.stderr, self.frame_numbers, seek_time),
+                         daemon=True).start()
+
+    def _read_frame_numbers(self, stderr, frame_numbers, seek_time):
+        """queue the frame number of every frame logged by showinfo, then None once ffmpeg exits
+
+        Timestamps after an input seek start from 0 at the seek position, so they are offset by seek_time.
+        """
+        pts_time = re.compile(rb'Parsed_showinfo.* pts_time:(-?[0-9.]+)')
+        for line in stderr:
+            match = pts_time.search(line)
+            if match:
+                frame_numbers.put(int(round((seek_time + float(match.group(1))) * self.frame_rate)))
+        frame_numbers.put(None)
+
+    def _next_frame(self):
+        """the next frame piped by ffmpeg and its frame number, or None at the end of the video"""
+        buffer = self.proc.stdout.read(self.frame_bytes)
+        if len(buffer) < self.frame_bytes:
+            return None
+        # showinfo logs each frame before it is written to the pipe
+        number = self.frame_numbers.get()
+        if number is None:
+            return None
+        return number, buffer
+
+    def read(self):
+        while True:
+            if self.pending is None:
+                self.pending = self._next_frame()
+                if self.pending is None:
+                    return None
+            number, buffer = self.pending
+            if number < self.position:
+                # a repeated timestamp: the frame number was already read
+                self.pending = None
+                continue
+            self.position += 1
+            if number > self.position - 1:
+                # ffmpeg dropped this frame, and the pending frame belongs to a later one
+                return None
+            self.pending = None
+            return np.frombuffer(buffer, dtype=np.uint8).reshape(self.out_height, self.out_width, 3)
+
+    def release(self):
+        if self.proc is not None:
+            self.proc.stdout.close()
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+
+#: decoders that can be selected by name
+DECODERS = {'opencv': OpenCVDecoder, 'ffmpeg': FFmpegDecoder}
+
+
+def _nominal_frame_rate(path, executable='ffmpeg'):
+    """the frame rate ffmpeg reports for the video stream (tbr), or None if it cannot be read"""
+    result = subprocess.run([executable, '-hide_banner', '-i', path], stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE)
+    match = re.search(rb'Video:.*?([0-9.]+)(k?) tbr', result.stderr)
+    if match is None:
+        return None
+    return float(match.group(1)) * (1000 if match.group(2) else 1)
+
+
+def probe_video(path):
+    """read the dimensions, frame count and frame rate of a video
+
+    Returns:
+        tuple: width, height, frame count and frames per second
+    """
+    cap = cv2.VideoCapture(path)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    cap.release()
+    return width, height, frame_count, fps
+
+
+def make_synthetic_video(path, n_frames=300, size=(1296, 972), fps=30):
+    """write a test video of a few moving rectangles on a noisy background
+
+    Args:
+        path (str): destination .mp4 file
+        n_frames (int): number of frames to write
+        size (tuple): (width, height) of the video
+        fps (int): frame rate of the video
+    """
+    width, height = size
+    rng = np.random.RandomState(0)
+    background = rng.randint(60, 120, (height, width, 3)).astype(np.uint8)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    for i in range(n_frames):
+        frame = background.copy()
+        for j in range(4):
+            x = int((width - 100) * (0.5 + 0.4 * np.sin(0.02 * i + j)))
+            y = int((height - 60) * (0.5 + 0.4 * np.cos(0.03 * i + 2 * j)))
+            cv2.rectangle(frame, (x, y), (x + 100, y + 60), (40 * j, 200, 255 - 40 * j), -1)
+        writer.write(frame)
+    writer.release()
+
+
+def benchmark_decoders(path=None, backends=('opencv', 'ffmpeg'), n_frames=300, threads=(0,), min_sizes=(None,),
+                       crop=None):
+    """measure decoding speed of each backend
+
+    Args:
+        path (str): video to decode. If None, a synthetic 1296x972 video with n_frames frames is generated
+        backends (tuple of str): names of the decoders in DECODERS to compare
+        n_frames (int): maximum number of frames to decode per configuration
+        threads (tuple of int): decoder thread counts to try
+        min_sizes (tuple): output resolutions to try, as the length of the shorter side. None keeps the native size
+        crop (tuple): optional (xmin, ymin, xmax, ymax) region applied in every configuration
+
+    Returns:
+        list of dict: backend, threads, size, number of frames decoded and frames per second for each configuration
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if path is None:
+            path = os.path.join(tmp_dir, 'synthetic.mp4')
+            make_synthetic_video(path, n_frames)
+        width, height = probe_video(path)[:2]
+        if crop is not None:
+            width, height = crop[2] - crop[0], crop[3] - crop[1]
+        results = []
+        for backend in backends:
+            for n_threads in threads:
+                for min_size in min_sizes:
+                    size = None
+                    if min_size is not None:
+                        size = scaled_size(width, height, **resolution_kwargs(min_size))
+                    start = time.time()
+                    with DECODERS[backend](path, crop=crop, size=size, threads=n_threads) as decoder:
+                        count = 0
+                        while count < n_frames and decoder.read() is not None:
+                            count += 1
+                    elapsed = time.time() - start
+                    results.append({'backend': backend, 'threads': n_threads, 'size': size or (width, height),
+                                    'frames': count, 'frames_per_second': count / elapsed})
+                    print('{backend:>8} threads={threads} size={size}: {frames} frames, '
+                          '{frames_per_second:.1f} frames/s'.format(**results[-1]))
+    return results
@@ -0,0 +1,308 @@
+import os
+import json
+import shutil
+import numpy as np
+from CichlidDetection.Utilities.detection_store import BOX_ARRAYS
+
+#: directory extension of detection archives
+ARCHIVE_EXTENSION = '.archive'
+
+# number of values per row of each per-box array
+_WIDTHS = {'boxes': 4, 'labels': 1, 'scores': 1, 'track_ids': 1}
+
+
+class DetectionArchive:
+    """memory-mapped detections of a video, with random access to any frame or range of frames
+
+    An archive is a directory of raw little-endian arrays and a meta.json file that records how much of each array is
+    valid. Frames are numbered consecutively from first_frame, so frame f is slot f - first_frame of the fixed-width
+    per-frame arrays:
+
+    * offsets.bin (int64, slots + 1): the rows of slot i in the per-box arrays are offsets[i]:offsets[i + 1]
+    * present.bin (bool, slots): False for frames with no detections record, e.g. frames that could not be decoded
+    * boxes.bin (float32, [rows, 4]), labels.bin (int64) and scores.bin (float32, absent for ground truth)
+    * track_ids.bin (int64): track id of each box, for detections tracked as they were written
+    * <column>.bin: any other per-frame array, e.g. the 'interpolated' and 'gate' columns of video detections
+
+    Opening an archive only reads meta.json and maps the arrays, so looking up a frame of a 10 hour video costs the same
+    as for the first frame. Frames are appended in order while detection runs. The data is written before meta.json is
+    replaced, so readers never see a partly written frame, and can call refresh() to pick up the frames appended since
+    they opened the archive. Once all frames are in, finish() records the end of the frame range and the frames that
+    could not be decoded, so that a complete archive can be told apart from a truncated one.
+    """
+
+    def __init__(self, path, writable=False):
+        """open an existing archive
+
+        Args:
+            path (str): archive directory
+            writable (bool): if True, open the archive for appending. Data past the extent recorded in meta.json, left
+                by an interrupted writer, is discarded
+        """
+        self.path = path
+        self.writable = writable
+        self.refresh()
+        if writable:
+            for name, dtype, count in self._arrays():
+                with open(self._file(name), 'ab') as f:
+                    f.truncate(count * np.dtype(dtype).itemsize)
+
+    @classmethod
+    def create(cls, path, columns=None, first_frame=0, scores=True, track_ids=False):
+        """create an empty archive, replacing any existing archive at path
+
+        Args:
+            path (str): archive directory
+            columns (dict): dtype of each extra per-frame array, by name, e.g. {'interpolated': bool, 'gate': '<U16'}
+            first_frame (int): number of the first frame of the archive
+            scores (bool): if False, leave out the scores array, as for ground truth
+            track_ids (bool): if True, add a track_ids array
+
+        Returns:
+            DetectionArchive: the archive, open for appending
+        """
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        box_arrays = [key for key in BOX_ARRAYS if (scores or key != 'scores') and (track_ids or key != 'track_ids')]
+        meta = {'first_frame': int(first_frame), 'n_frames': 0, 'n_boxes': 0,
+                'box_arrays': {key: np.dtype(BOX_ARRAYS[key]).str for key in box_arrays},
+                'columns': {key: np.dtype(dtype).str for key, dtype in (columns or {}).items()}}
+        np.zeros(1, np.int64).tofile(os.path.join(path, 'offsets.bin'))
+        for name in ['present'] + box_arrays + list(meta['columns']):
+            open(os.path.join(path, name + '.bin'), 'wb').close()
+        _write_meta(path, meta)
+        return cls(path, writable=True)
+
+    @classmethod
+    def from_detections(cls, path, detections):
+        """write a detection store (see detection_store.save_detections) as an archive
+
+        Returns:
+            DetectionArchive: the archive, open for appending
+        """
+        columns = {key: values.dtype for key, values in detections.items()
+                   if key not in BOX_ARRAYS and key not in ['frames', 'offsets', 'framefiles']}
+        first_frame = detections['frames'][0] if len(detections['frames']) else 0
+        archive = cls.create(path, columns, first_frame, scores='scores' in detections,
+                             track_ids='track_ids' in detections)
+        archive.append(detections)
+        return archive
+
+    def refresh(self):
+        """re-read meta.json and remap the arrays, to see frames appended since the archive was opened"""
+        with open(os.path.join(self.path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.first_frame = self.meta['first_frame']
+        self.n_frames = self.meta['n_frames']
+        self.n_boxes = self.meta['n_boxes']
+        self.columns = {key: np.dtype(dtype) for key, dtype in self.meta['columns'].items()}
+        self.box_arrays = {key: np.dtype(dtype) for key, dtype in self.meta['box_arrays'].items()}
+        self.offsets = self._map('offsets', np.int64, self.n_frames + 1)
+        self.present = self._map('present', bool, self.n_frames)
+        self.arrays = {key: self._map(key, dtype, self.n_boxes, _WIDTHS[key]) for key, dtype in self.box_arrays.items()}
+        self.arrays.update({key: self._map(key, dtype, self.n_frames) for key, dtype in self.columns.items()})
+
+    @property
+    def stop_frame(self):
+        """frame after the last frame of the archive"""
+        return self.first_frame + self.n_frames
+
+    def __len__(self):
+        return int(self.present.sum())
+
+    def __contains__(self, frame):
+        slot = frame - self.first_frame
+        return 0 <= slot < self.n_frames and bool(self.present[slot])
+
+    def __getitem__(self, frame):
+        """boxes, labels and scores of one frame, as views into the mapped arrays
+
+        Raises:
+            KeyError: if the archive has no record of the frame
+        """
+        if frame not in self:
+            raise KeyError(frame)
+        slot = frame - self.first_frame
+        rows = slice(self.offsets[slot], self.offsets[slot + 1])
+        return tuple(self.arrays[key][rows] for key in self.box_arrays)
+
+    def window(self, start=None, stop=None):
+        """the frames in [start, stop) that have a detections record, in the format of a detection store
+
+        Only the requested range is read from disk. The per-box arrays are views into the mapped files.
+
+        Args:
+            start (int): first frame. Defaults to None, the first frame of the archive
+            stop (int): frame after the last frame. Defaults to None, the end of the archive
+
+        Returns:
+            dict: numpy arrays, as described in detection_store.save_detections
+        """
+        lo = 0 if start is None else min(max(start - self.first_frame, 0), self.n_frames)
+        hi = self.n_frames if stop is None else min(max(stop - self.first_frame, lo), self.n_frames)
+        slots = lo + np.flatnonzero(self.present[lo:hi])
+        offsets = np.asarray(self.offsets[lo:hi + 1])
+        first_row, last_row = offsets[0], offsets[-1]
+        detections = {'frames': (self.first_frame + slots).astype(np.int64)}
+        for key in self.box_arrays:
+            detections[key] = self.arrays[key][first_row:last_row]
+        # rows of absent frames are empty, so dropping their slots leaves the offsets of the present frames consistent
+        counts = np.diff(offsets)[slots - lo]
+        detections['offsets'] = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        for key in self.columns:
+            detections[key] = self.arrays[key][slots]
+        return detections
+
+    def append(self, detections):
+        """append frames after the last frame of the archive
+
+        Frames between the end of the archive and the first appended frame are recorded as absent.
+
+        Args:
+            detections (dict): frames in increasing order, in the format of a detection store or a DetectionBuffer chunk
+        """
+        assert self.writable, 'archive {} is not open for appending'.format(self.path)
+        frames = np.asarray(detections['frames'], dtype=np.int64)
+        if not len(frames):
+            return
+        if frames[0] < self.stop_frame or np.any(np.diff(frames) <= 0):
+            raise ValueError('frames must increase and follow frame {} of {}'.format(self.stop_frame - 1, self.path))
+        slots = frames - self.stop_frame
+        n_slots = slots[-1] + 1
+        counts = np.zeros(n_slots, np.int64)
+        counts[slots] = np.diff(detections['offsets'])
+        present = np.zeros(n_slots, bool)
+        present[slots] = True
+        for key in self.box_arrays:
+            self._extend(key, np.asarray(detections[key], dtype=self.box_arrays[key]))
+        for key, dtype in self.columns.items():
+            values = np.zeros(n_slots, dtype)
+            values[slots] = detections[key]
+            self._extend(key, values)
+        self._extend('present', present)
+        self._extend('offsets', self.n_boxes + np.cumsum(counts))
+        self.meta['n_frames'] += int(n_slots)
+        self.meta['n_boxes'] += int(counts.sum())
+        _write_meta(self.path, self.meta)
+        self.refresh()
+
+    def finish(self, stop_frame, skipped_frames=(), tracker=None):
+        """mark the archive as complete
+
+        Args:
+            stop_frame (int): frame after the last frame the archive covers. Frames after the last appended frame are
+                absent
+            skipped_frames (list of int): frames that could not be decoded, and so are absent on purpose
+            tracker (dict): state of the FishTracker that assigned the track ids, at the end of the archive, so that
+                tracking can continue in the archive of the next frames (see FishTracker.state)
+        """
+        assert self.writable, 'archive {} is not open for appending'.format(self.path)
+        if tracker is not None:
+            self.meta['tracker'] = tracker
+        self.meta['stop_frame'] = int(stop_frame)
+        self.meta['skipped_frames'] = sorted(int(f) for f in skipped_frames)
+        _write_meta(self.path, self.meta)
+        self.refresh()
+
+    @property
+    def complete(self):
+        """whether finish() was called"""
+        return 'stop_frame' in self.meta
+
+    @property
+    def skipped_frames(self):
+        """frames recorded as undecodable by finish()"""
+        return self.meta.get('skipped_frames', [])
+
+    def missing_frames(self):
+        """frames of a complete archive that have neither a detections record nor were recorded as skipped
+
+        Returns:
+            np.ndarray: frame numbers
+        """
+        covered = np.zeros(max(self.meta['stop_frame'] - self.first_frame, self.n_frames), bool)
+        covered[:self.n_frames] = self.present
+        covered[np.asarray(self.skipped_frames, dtype=np.int64) - self.first_frame] = True
+        return self.first_frame + np.flatnonzero(~covered)
+
+    def _arrays(self):
+        """name, dtype and valid length of every array file"""
+        arrays = [('offsets', np.int64, self.n_frames + 1), ('present', bool, self.n_frames)]
+        arrays.extend((key, dtype, self.n_boxes * _WIDTHS[key]) for key, dtype in self.box_arrays.items())
+        arrays.extend((key, dtype, self.n_frames) for key, dtype in self.columns.items())
+        return arrays
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.bin')
+
+    def _map(self, name, dtype, count, width=1):
+        shape = (count, width) if width > 1 else (count,)
+        # np.memmap cannot map an empty range
+        if count == 0:
+            return np.empty(shape, dtype)
+        return np.memmap(self._file(name), dtype=dtype, mode='r', shape=shape)
+
+    def _extend(self, name, values):
+        with open(self._file(name), 'ab') as f:
+            np.ascontiguousarray(values).tofile(f)
+
+
+def _write_meta(path, meta):
+    tmp_file = os.path.join(path, 'meta.json.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_file, os.path.join(path, 'meta.json'))
+
+
+def merge_archives(path, parts, chunk_size=10000):
+    """concatenate the archives of consecutive frame ranges into one archive, streaming chunk_size frames at a time
+
+    The parts are validated before anything is written: together they must cover one unbroken range of frames with no
+    overlaps, each must be complete, and each must have a record of every frame of its range that was not skipped as
+    undecodable. The merged archive is built under a temporary name and renamed once complete.
+
+    Args:
+        path (str): destination archive directory
+        parts (list of tuple): (archive path, start frame, stop frame) of each part, in any order
+        chunk_size (int): number of frames copied at once, which bounds the memory used by the merge
+
+    Returns:
+        DetectionArchive: the merged archive, open for reading
+
+    Raises:
+        ValueError: if a part is incomplete, or frames are missing or duplicated
+    """
+    parts = sorted(parts, key=lambda part: part[1])
+    archives = []
+    for i, (part_path, start, stop) in enumerate(parts):
+        if i > 0 and start != parts[i - 1][2]:
+            problem = 'missing' if start > parts[i - 1][2] else 'duplicated'
+            raise ValueError('frames {}-{} are {} between {} and {}'.format(
+                *sorted([parts[i - 1][2], start]), problem, parts[i - 1][0], part_path))
+        archive = DetectionArchive(part_path)
+        if not archive.complete or archive.first_frame != start or archive.meta['stop_frame'] != stop:
+            raise ValueError('{} is not a complete archive of frames {}-{}'.format(part_path, start, stop))
+        missing = archive.missing_frames()
+        if len(missing):
+            raise ValueError('{} frame(s) missing from {}: {}'.format(len(missing), part_path, missing.tolist()[:20]))
+        archives.append(archive)
+
+    tmp_path = path + '.tmp'
+    first = archives[0] if archives else None
+    merged = DetectionArchive.create(tmp_path, first.columns if first else None, parts[0][1] if parts else 0,
+                                     scores='scores' in first.box_arrays if first else True,
+                                     track_ids='track_ids' in first.box_arrays if first else False)
+    for archive in archives:
+        for start in range(archive.first_frame, archive.stop_frame, chunk_size):
+            merged.append(archive.window(start, start + chunk_size))
+    merged.finish(parts[-1][2] if parts else 0, [f for archive in archives for f in archive.skipped_frames])
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return DetectionArchive(path)
+
+
+def is_archive(path):
+    """whether path is a detection archive rather than a detection store file"""
+    return os.path.isfile(os.path.join(path, 'meta.json'))
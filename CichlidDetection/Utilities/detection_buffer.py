@@ -0,0 +1,227 @@
+import threading
+import numpy as np
+
+
+class DetectionBuffer:
+    """append-only store for the detections of many frames, kept as ragged arrays
+
+    The boxes, labels and scores of every frame are packed into flat arrays, and frame i's detections are the rows
+    offsets[i]:offsets[i + 1] of them. The arrays are preallocated and doubled in size when full, so appending a frame
+    costs a slice assignment rather than the creation of Python lists. Frames may be appended in any order.
+
+    Frames that are no longer needed can be dropped with discard_before(), so that a buffer fed by a long video holds
+    only the frames in flight. Appending, reading and discarding are guarded by a lock, so frames can be appended in
+    one thread while they are flushed and discarded in another.
+    """
+
+    def __init__(self, columns=None, frame_capacity=1024, box_capacity=16384):
+        """
+        Args:
+            columns (dict): optional per-frame values to store alongside the detections, as {name: numpy dtype}, e.g.
+                {'interpolated': bool}
+            frame_capacity (int): number of frames to allocate space for initially
+            box_capacity (int): number of boxes to allocate space for initially
+        """
+        self.n_frames = 0
+        self.n_boxes = 0
+        self.frames = np.empty(frame_capacity, dtype=np.int64)
+        self.offsets = np.zeros(frame_capacity + 1, dtype=np.int64)
+        self.boxes = np.empty((box_capacity, 4), dtype=np.float32)
+        self.labels = np.empty(box_capacity, dtype=np.int64)
+        self.scores = np.empty(box_capacity, dtype=np.float32)
+        self.columns = {name: np.zeros(frame_capacity, dtype=dtype) for name, dtype in (columns or {}).items()}
+        # row of each frame in the per-frame arrays
+        self._rows = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self.n_frames
+
+    def __contains__(self, frame):
+        return frame in self._rows
+
+    def __getitem__(self, frame):
+        """detections of a frame
+
+        Returns:
+            tuple of np.ndarray: views of the [N, 4] boxes, [N] labels and [N] scores of the frame
+        """
+        with self._lock:
+            row = self._rows[frame]
+            start, stop = self.offsets[row], self.offsets[row + 1]
+            return self.boxes[start:stop], self.labels[start:stop], self.scores[start:stop]
+
+    def append(self, frame, boxes, labels, scores, **values):
+        """add the detections of a frame
+
+        Args:
+            frame (int): frame number or image id
+            boxes (np.ndarray): [N, 4] boxes in (xmin, ymin, xmax, ymax) form
+            labels (np.ndarray): [N] labels
+            scores (np.ndarray): [N] scores
+            **values: values of the per-frame columns given to the constructor. Unset columns are left at zero
+        """
+        n = len(labels)
+        with self._lock:
+            if self.n_frames == len(self.frames):
+                self._grow_frames()
+            while self.n_boxes + n > len(self.labels):
+                self._grow_boxes()
+            start, stop = self.n_boxes, self.n_boxes + n
+            self.boxes[start:stop] = np.asarray(boxes).reshape(-1, 4)
+            self.labels[start:stop] = labels
+            self.scores[start:stop] = scores
+            row = self.n_frames
+            self.frames[row] = frame
+            self.offsets[row + 1] = stop
+            for name, value in values.items():
+                self.columns[name][row] = value
+            self._rows[frame] = row
+            self.n_frames += 1
+            self.n_boxes = stop
+
+    def iter_chunks(self, chunk_size=10000):
+        """iterate over the buffer in order of frame number
+
+        Args:
+            chunk_size (int): number of frames per chunk
+
+        Yields:
+            dict: chunks of chunk_size frames, as returned by chunk()
+        """
+        with self._lock:
+            frames = np.sort(self.frames[:self.n_frames], kind='stable')
+        for i in range(0, len(frames), chunk_size):
+            yield self.chunk(frames[i:i + chunk_size])
+
+    def chunk(self, frames):
+        """gather the detections of several frames into contiguous arrays
+
+        Args:
+            frames (list of int): frames to gather, in the order they should appear in the chunk
+
+        Returns:
+            dict: 'frames', 'offsets' (starting at 0), 'boxes', 'labels', 'scores' and the per-frame columns, as numpy
+                arrays
+        """
+        with self._lock:
+            rows = np.array([self._rows[frame] for frame in frames], dtype=np.int64)
+            return self._gather(rows)
+
+    def discard_before(self, frame):
+        """drop the frames numbered below frame, and compact the arrays to the frames that remain
+
+        The remaining frames are copied into new arrays, so views returned by __getitem__ stay valid.
+
+        Args:
+            frame (int): first frame to keep
+        """
+        with self._lock:
+            keep = np.flatnonzero(self.frames[:self.n_frames] >= frame)
+            if len(keep) == self.n_frames:
+                return
+            kept = self._gather(keep)
+            self.n_frames = len(keep)
+            self.n_boxes = int(kept['offsets'][-1])
+            frame_capacity = max(len(self.frames) // 2, self.n_frames, 1)
+            box_capacity = max(len(self.labels) // 2, self.n_boxes, 1)
+            self.frames = _padded(kept['frames'], frame_capacity)
+            self.offsets = _padded(kept['offsets'], frame_capacity + 1)
+            self.boxes = _padded(kept['boxes'], box_capacity)
+            self.labels = _padded(kept['labels'], box_capacity)
+            self.scores = _padded(kept['scores'], box_capacity)
+            self.columns = {name: _padded(kept[name], frame_capacity) for name in self.columns}
+            self._rows = {f: row for row, f in enumerate(kept['frames'].tolist())}
+
+    def _gather(self, rows):
+        """gather the detections of the frames in the given rows into contiguous arrays, as described in chunk()"""
+        starts, stops = self.offsets[rows], self.offsets[rows + 1]
+        counts = stops - starts
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        # index of every box in the chunk, gathered frame by frame
+        box_index = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+        chunk = {'frames': self.frames[rows], 'offsets': offsets, 'boxes': self.boxes[box_index],
+                 'labels': self.labels[box_index], 'scores': self.scores[box_index]}
+        chunk.update({name: column[rows] for name, column in self.columns.items()})
+        return chunk
+
+    def _grow_frames(self):
+        capacity = 2 * len(self.frames)
+        self.frames = np.resize(self.frames, capacity)
+        self.offsets = np.resize(self.offsets, capacity + 1)
+        self.columns = {name: _padded(column, capacity) for name, column in self.columns.items()}
+
+    def _grow_boxes(self):
+        capacity = 2 * len(self.labels)
+        self.boxes = np.resize(self.boxes, (capacity, 4))
+        self.labels = np.resize(self.labels, capacity)
+        self.scores = np.resize(self.scores, capacity)
+
+
+def _padded(values, length):
+    """copy of values extended with zeros to length rows, as unset columns are expected to be zero"""
+    padded = np.zeros((length,) + values.shape[1:], dtype=values.dtype)
+    padded[:len(values)] = values
+    return padded
+
+
+class OrderedFlusher:
+    """pass the frames of a DetectionBuffer on to a sink in frame order, as soon as every earlier frame is finished
+
+    Frames may be finished out of order, e.g. when several DataLoader workers decode separate blocks of a video, so
+    finished frames are held back until the frames before them are finished too. Frames that never produce a row, such
+    as unreadable frames, should still be marked as finished so that they do not hold back the frames after them.
+
+    After each flush, the flushed frames are discarded from the buffer, except those that may still be read as the
+    source of a frame that is not finished yet, e.g. a keyframe that later frames are interpolated from.
+    """
+
+    def __init__(self, buffer, sink, first_frame=0, chunk_size=10000, keep_from=None):
+        """
+        Args:
+            buffer (DetectionBuffer): buffer the finished frames were appended to
+            sink (callable): called with each chunk of frames, as returned by DetectionBuffer.chunk
+            first_frame (int): the first frame expected
+            chunk_size (int): number of frames passed to the sink at once, except for the last chunk
+            keep_from (callable): returns the oldest frame that may still be read from the buffer, or None if no
+                earlier frame is needed. Defaults to None, for frames that are never read back
+        """
+        self.buffer = buffer
+        self.sink = sink
+        self.next_frame = first_frame
+        self.chunk_size = chunk_size
+        self.keep_from = keep_from
+        self.finished = set()
+        self.ready = []
+
+    def finish(self, frames):
+        """mark frames as finished, and flush the next chunk if enough frames are ready
+
+        Args:
+            frames (iterable of int): finished frames
+        """
+        self.finished.update(frames)
+        while self.next_frame in self.finished:
+            self.finished.remove(self.next_frame)
+            if self.next_frame in self.buffer:
+                self.ready.append(self.next_frame)
+            self.next_frame += 1
+        if len(self.ready) >= self.chunk_size:
+            self._flush()
+
+    def close(self):
+        """flush the ready frames, followed by any frames still held back, in frame order"""
+        self._flush()
+        remaining = sorted(frame for frame in self.finished if frame in self.buffer)
+        for i in range(0, len(remaining), self.chunk_size):
+            self.ready = remaining[i:i + self.chunk_size]
+            self._flush()
+        self.finished.clear()
+
+    def _flush(self):
+        if self.ready:
+            self.sink(self.buffer.chunk(self.ready))
+            self.ready = []
+            # every frame below next_frame has now been flushed
+            oldest = self.keep_from() if self.keep_from is not None else None
+            self.buffer.discard_before(self.next_frame if oldest is None else min(oldest, self.next_frame))
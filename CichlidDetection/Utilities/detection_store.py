@@ -0,0 +1,186 @@
+import os
+import re
+import ast
+import json
+import numpy as np
+import pandas as pd
+
+#: file extension of detection stores
+STORE_EXTENSION = '.npz'
+
+#: arrays holding one value per box, and their dtypes. 'scores' is absent from ground truth stores, and 'track_ids' from
+#: stores of detections that were not tracked
+BOX_ARRAYS = {'boxes': np.float32, 'labels': np.int64, 'scores': np.float32, 'track_ids': np.int64}
+
+# frame file names of video frames, which are not stored since they follow from the frame number
+_VIDEO_FRAMEFILE = re.compile(r'^Frame_(\d+)\.jpg$')
+
+
+def save_detections(path, detections):
+    """write a detection store
+
+    A store is an uncompressed .npz file of typed arrays. The detections of frame i are rows offsets[i]:offsets[i + 1]
+    of the per-box arrays. The file is written under a temporary name and renamed, so it is never seen half written.
+
+    Args:
+        path (str): destination .npz file
+        detections (dict): numpy arrays
+            'frames' (int64, one per frame): frame numbers, or for image sets the index of each image
+            'offsets' (int64, frames + 1): start of each frame's rows in the per-box arrays, followed by their length
+            'boxes' (float32, [N, 4]), 'labels' (int64, [N]) and optionally 'scores' (float32, [N]): per-box values
+            'track_ids' (int64, [N], optional): id of the fish each box was assigned to by a FishTracker, 0 for boxes
+                of unconfirmed tracks (see Classes/TrackingFish.py)
+            'framefiles' (str, optional): file name of each frame, for image sets. Video frames are named Frame_<n>.jpg
+            any other array with one value per frame, e.g. the 'interpolated' and 'gate' columns of video detections
+    """
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, **detections)
+    os.replace(tmp_file, path)
+
+
+def load_detections(path, start_frame=None, end_frame=None):
+    """read a detection store written by save_detections, or a detection archive (see detection_archive.py)
+
+    Args:
+        path (str): .npz store or archive directory
+        start_frame (int): if given, only read the frames from this frame on
+        end_frame (int): if given, only read the frames before this frame. Archives read only the requested frames
+            from disk, whereas a store is loaded whole and then narrowed
+
+    Returns:
+        dict: numpy arrays, as described in save_detections
+    """
+    if os.path.isdir(path):
+        # imported here, since the archive module builds on this one
+        from CichlidDetection.Utilities.detection_archive import DetectionArchive
+        return {key: np.array(values) for key, values in DetectionArchive(path).window(start_frame, end_frame).items()}
+    with np.load(path, allow_pickle=False) as store:
+        detections = {key: store[key] for key in store.files}
+    if start_frame is None and end_frame is None:
+        return detections
+    frames = detections['frames']
+    keep = (frames >= (frames.min(initial=0) if start_frame is None else start_frame)) & \
+           (frames < (frames.max(initial=0) + 1 if end_frame is None else end_frame))
+    return select_frames(detections, keep)
+
+
+def select_frames(detections, keep):
+    """narrow a store to some of its frames
+
+    Args:
+        detections (dict): numpy arrays, as described in save_detections
+        keep (np.ndarray): boolean mask over the frames of the store
+
+    Returns:
+        dict: the kept frames
+    """
+    offsets = detections['offsets']
+    rows = np.repeat(keep, np.diff(offsets))
+    selected = {key: values[rows] if key in BOX_ARRAYS else values[keep] for key, values in detections.items()
+                if key != 'offsets'}
+    selected['offsets'] = np.concatenate([[0], np.cumsum(np.diff(offsets)[keep])]).astype(np.int64)
+    return selected
+
+
+def empty_detections(scores=True):
+    """a store with no frames
+
+    Args:
+        scores (bool): if False, leave out the scores array, as for ground truth
+    """
+    detections = {'frames': np.empty(0, np.int64), 'offsets': np.zeros(1, np.int64),
+                  'boxes': np.empty((0, 4), np.float32), 'labels': np.empty(0, np.int64)}
+    if scores:
+        detections['scores'] = np.empty(0, np.float32)
+    return detections
+
+
+def concatenate_detections(parts):
+    """join several stores or DetectionBuffer chunks, in the order given
+
+    Args:
+        parts (list of dict): stores with the same arrays
+
+    Returns:
+        dict: the combined store
+    """
+    if not parts:
+        return empty_detections()
+    combined = {key: np.concatenate([part[key] for part in parts]) for key in parts[0] if key != 'offsets'}
+    counts = np.concatenate([np.diff(part['offsets']) for part in parts])
+    combined['offsets'] = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return combined
+
+
+def framefiles(detections):
+    """file name of each frame in a store
+
+    Returns:
+        list of str: the stored framefiles of an image set, or Frame_<n>.jpg for video frames
+    """
+    if 'framefiles' in detections:
+        return detections['framefiles'].tolist()
+    return ['Frame_{}.jpg'.format(frame) for frame in detections['frames']]
+
+
+def to_dataframe(detections):
+    """per-frame table of a store, with the boxes, labels and scores of each frame as python lists
+
+    Intended for code that works through the detections row by row, e.g. plotting individual frames.
+
+    Returns:
+        Pandas DataFrame: 'frame', the per-box arrays as lists and the other per-frame arrays, indexed by Framefile
+    """
+    splits = detections['offsets'][1:-1]
+    df = pd.DataFrame({'frame': detections['frames']}, index=pd.Index(framefiles(detections), name='Framefile'))
+    for key in BOX_ARRAYS:
+        if key in detections:
+            df[key] = [values.tolist() for values in np.split(detections[key], splits)]
+    for key, values in detections.items():
+        if key not in df.columns and key not in BOX_ARRAYS and key not in ['frames', 'offsets', 'framefiles']:
+            df[key] = values
+    return df
+
+
+def _parse_list(cell):
+    """parse a stringified python list from a detections csv, without eval"""
+    try:
+        return json.loads(cell)
+    except ValueError:
+        return ast.literal_eval(cell)
+
+
+def convert_csv(csv_file, store_file=None):
+    """import a detections, predictions or ground truth csv of stringified python lists into a detection store
+
+    Args:
+        csv_file (str): csv with a Framefile column, boxes and labels columns, and optionally scores, interpolated and
+            gate columns
+        store_file (str): destination store. Defaults to None, which replaces the .csv extension with .npz
+
+    Returns:
+        str: path of the store
+    """
+    store_file = store_file or os.path.splitext(csv_file)[0] + STORE_EXTENSION
+    df = pd.read_csv(csv_file, keep_default_na=False)
+    boxes = [np.asarray(_parse_list(cell), dtype=np.float32).reshape(-1, 4) for cell in df.boxes]
+    counts = [len(b) for b in boxes]
+    detections = {'offsets': np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                  'boxes': np.concatenate(boxes) if boxes else np.empty((0, 4), np.float32)}
+    for key in ['labels', 'scores']:
+        if key in df.columns:
+            values = [np.asarray(_parse_list(cell), dtype=BOX_ARRAYS[key]) for cell in df[key]]
+            detections[key] = np.concatenate(values) if values else np.empty(0, BOX_ARRAYS[key])
+    matches = [_VIDEO_FRAMEFILE.match(name) for name in df.Framefile]
+    if matches and all(matches):
+        detections['frames'] = np.array([int(m.group(1)) for m in matches], dtype=np.int64)
+    else:
+        detections['frames'] = np.arange(len(df), dtype=np.int64)
+        detections['framefiles'] = df.Framefile.to_numpy(dtype=str)
+    if 'interpolated' in df.columns:
+        detections['interpolated'] = df.interpolated.astype(str).str.lower().eq('true').to_numpy()
+    if 'gate' in df.columns:
+        detections['gate'] = df.gate.astype(str).to_numpy(dtype='<U16')
+    save_detections(store_file, detections)
+    return store_file
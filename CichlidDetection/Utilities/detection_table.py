@@ -0,0 +1,261 @@
+import numpy as np
+from CichlidDetection.Utilities.box_utils import frame_pair_iou, xyminmax_to_xywh, inside_region
+from CichlidDetection.Utilities.detection_store import BOX_ARRAYS, load_detections, to_dataframe
+
+# keys of a detection store that are not extra per-frame columns
+_STRUCTURE = ['frames', 'offsets', 'framefiles']
+
+
+class DetectionTable:
+    """detections of many frames as ragged arrays, with vectorized operations over all boxes at once
+
+    The boxes, labels and scores of every frame are packed into flat arrays, and the detections of the i-th frame of
+    the table are rows offsets[i]:offsets[i + 1] of them, as in a detection store (see detection_store.py). Operations
+    such as filtering work on the flat arrays and rebuild the offsets, so no per-frame python lists are created. Frames
+    are kept in increasing frame order.
+    """
+
+    def __init__(self, frames, offsets, boxes, labels, scores=None, framefiles=None, columns=None, track_ids=None):
+        """
+        Args:
+            frames (array-like): frame number of each frame, in increasing order
+            offsets (array-like): start of each frame's rows in the per-box arrays, followed by their length
+            boxes (array-like): [N, 4] boxes in (xmin, ymin, xmax, ymax) form
+            labels (array-like): [N] labels
+            scores (array-like): [N] scores, or None for ground truth
+            framefiles (array-like): file name of each frame, for image sets
+            columns (dict): other per-frame arrays, e.g. 'interpolated' and 'gate'
+            track_ids (array-like): [N] track ids, or None for detections that were not tracked
+        """
+        self.frames = np.asarray(frames, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.scores = None if scores is None else np.asarray(scores, dtype=np.float32)
+        self.framefiles = None if framefiles is None else np.asarray(framefiles, dtype=str)
+        self.columns = {key: np.asarray(values) for key, values in (columns or {}).items()}
+        self.track_ids = None if track_ids is None else np.asarray(track_ids, dtype=np.int64)
+
+    @classmethod
+    def from_detections(cls, detections):
+        """build a table from the arrays of a detection store or archive window"""
+        columns = {key: values for key, values in detections.items() if key not in BOX_ARRAYS and key not in _STRUCTURE}
+        return cls(detections['frames'], detections['offsets'], detections['boxes'], detections['labels'],
+                   detections.get('scores'), detections.get('framefiles'), columns, detections.get('track_ids'))
+
+    @classmethod
+    def load(cls, path, start_frame=None, end_frame=None):
+        """read a detection store or archive (see detection_store.load_detections)"""
+        return cls.from_detections(load_detections(path, start_frame, end_frame))
+
+    def to_detections(self):
+        """the arrays of the table, in the format of a detection store"""
+        detections = {'frames': self.frames, 'offsets': self.offsets, 'boxes': self.boxes, 'labels': self.labels}
+        if self.scores is not None:
+            detections['scores'] = self.scores
+        if self.framefiles is not None:
+            detections['framefiles'] = self.framefiles
+        if self.track_ids is not None:
+            detections['track_ids'] = self.track_ids
+        detections.update(self.columns)
+        return detections
+
+    def to_dataframe(self):
+        """per-frame table with python lists, indexed by Framefile (see detection_store.to_dataframe)"""
+        return to_dataframe(self.to_detections())
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def n_boxes(self):
+        return len(self.labels)
+
+    @property
+    def counts(self):
+        """number of boxes in each frame"""
+        return np.diff(self.offsets)
+
+    @property
+    def box_frames(self):
+        """position in the table of the frame of each box"""
+        return np.repeat(np.arange(len(self)), self.counts)
+
+    @property
+    def centres(self):
+        """[N, 2] centre of each box"""
+        return (self.boxes[:, :2] + self.boxes[:, 2:]) / 2
+
+    def xywh(self):
+        """the boxes in (x, y, w, h) form"""
+        return xyminmax_to_xywh(self.boxes)
+
+    def position(self, frame):
+        """position in the table of a frame number
+
+        Raises:
+            KeyError: if the table has no such frame
+        """
+        i = np.searchsorted(self.frames, frame)
+        if i == len(self.frames) or self.frames[i] != frame:
+            raise KeyError(frame)
+        return int(i)
+
+    def locate(self, framefile):
+        """frame number of an image set frame, by file name"""
+        matches = np.flatnonzero(self.framefiles == framefile)
+        if not len(matches):
+            raise KeyError(framefile)
+        return int(self.frames[matches[0]])
+
+    def __getitem__(self, frame):
+        """boxes, labels and scores of a frame number, as views into the flat arrays"""
+        i = self.position(frame)
+        rows = slice(self.offsets[i], self.offsets[i + 1])
+        return self.boxes[rows], self.labels[rows], None if self.scores is None else self.scores[rows]
+
+    def take(self, positions):
+        """select frames by position
+
+        Args:
+            positions (array-like): positions of the frames to keep, in the order to keep them. A position of -1 gives
+                an empty frame, whose frame number and other per-frame values are left at zero
+
+        Returns:
+            DetectionTable: the selected frames
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        valid = positions >= 0
+        counts = np.where(valid, self.counts[np.where(valid, positions, 0)], 0)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        starts = self.offsets[:-1][np.where(valid, positions, 0)]
+        rows = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], counts)
+
+        def per_frame(values):
+            taken = values[np.where(valid, positions, 0)]
+            taken[~valid] = np.zeros(1, values.dtype)
+            return taken
+
+        return DetectionTable(per_frame(self.frames), offsets, self.boxes[rows], self.labels[rows],
+                              None if self.scores is None else self.scores[rows],
+                              None if self.framefiles is None else per_frame(self.framefiles),
+                              {key: per_frame(values) for key, values in self.columns.items()},
+                              None if self.track_ids is None else self.track_ids[rows])
+
+    def slice_frames(self, start=None, stop=None):
+        """the frames numbered start to stop - 1"""
+        lo = 0 if start is None else np.searchsorted(self.frames, start)
+        hi = len(self) if stop is None else np.searchsorted(self.frames, stop)
+        return self.take(np.arange(lo, hi))
+
+    def align(self, other):
+        """the frames of another table, in the order of this table's frames
+
+        Frames are matched by framefile if both tables have framefiles, and by frame number otherwise. Frames missing
+        from the other table are empty, so per-frame results of the two tables line up.
+
+        Returns:
+            DetectionTable: the other table's detections, with this table's frame numbers and framefiles
+        """
+        if self.framefiles is not None and other.framefiles is not None:
+            mine, theirs = self.framefiles, other.framefiles
+        else:
+            mine, theirs = self.frames, other.frames
+        lookup = {key: i for i, key in enumerate(theirs.tolist())}
+        aligned = other.take([lookup.get(key, -1) for key in mine.tolist()])
+        aligned.frames = self.frames
+        aligned.framefiles = self.framefiles
+        return aligned
+
+    def select(self, mask):
+        """keep the boxes where mask is True, and every frame
+
+        Args:
+            mask (np.ndarray): [N] boolean array over the boxes
+
+        Returns:
+            DetectionTable: the selected boxes
+        """
+        counts = np.bincount(self.box_frames[mask], minlength=len(self))
+        return DetectionTable(self.frames, np.concatenate([[0], np.cumsum(counts)]), self.boxes[mask],
+                              self.labels[mask], None if self.scores is None else self.scores[mask], self.framefiles,
+                              self.columns, None if self.track_ids is None else self.track_ids[mask])
+
+    def filter_scores(self, min_score):
+        """keep the boxes scoring at least min_score"""
+        return self.select(self.scores >= min_score)
+
+    def filter_labels(self, labels):
+        """keep the boxes with one of the given labels"""
+        return self.select(np.isin(self.labels, labels))
+
+    def filter_region(self, region):
+        """keep the boxes whose centre lies inside a region
+
+        Args:
+            region (array-like): (xmin, ymin, xmax, ymax) rectangle, or [K, 2] polygon vertices (see
+                box_utils.inside_region)
+        """
+        return self.select(inside_region(self.centres, region))
+
+    def reduce(self, values, ufunc=np.add, empty=0):
+        """reduce a per-box array within each frame
+
+        Args:
+            values (np.ndarray): [N] per-box values, e.g. self.scores
+            ufunc (np.ufunc): reduction, e.g. np.add, np.minimum or np.maximum
+            empty: result for frames with no boxes
+
+        Returns:
+            np.ndarray: one value per frame
+        """
+        out = np.full(len(self), empty, dtype=np.result_type(values, np.asarray(empty)))
+        filled = self.counts > 0
+        # the rows of the non-empty frames are contiguous, so each segment of reduceat covers exactly one frame
+        out[filled] = ufunc.reduceat(values, self.offsets[:-1][filled])
+        return out
+
+    def pairwise_iou(self):
+        """iou of every pair of boxes within each frame
+
+        Returns:
+            list of np.ndarray: for each frame, the ious of its box pairs (i, j), i < j, in the order of
+                itertools.combinations
+        """
+        starts, counts = self.offsets[:-1], self.counts
+        _, rows_a, rows_b, ious = frame_pair_iou(self.boxes, starts, counts, self.boxes, starts, counts)
+        return np.split(ious[rows_a < rows_b], np.cumsum(counts * (counts - 1) // 2)[:-1])
+
+    def frame_iou(self, predicted):
+        """score each frame by how well the boxes of another table cover this table's boxes
+
+        Follows the conventions of box_utils.frame_iou: each box of this table is scored by its best-matching box of
+        the same frame in the other table, boxes of the other table in excess of this table's are scored 0.0, and a
+        frame empty in both tables scores 1.0.
+
+        Args:
+            predicted (DetectionTable): detections of the same frames, e.g. from self.align()
+
+        Returns:
+            tuple of np.ndarray: the average iou of each frame, and for each box of this table the row in the other
+                table of its best match, or -1 if it overlaps no box
+        """
+        counts, predicted_counts = self.counts, predicted.counts
+        _, _, predicted_rows, ious = frame_pair_iou(self.boxes, self.offsets[:-1], counts, predicted.boxes,
+                                                    predicted.offsets[:-1], predicted_counts)
+        # the pairs of each box of this table form a contiguous run, with one pair per box of the same frame in the
+        # other table, so the best match of every box is a segmented reduction over the runs
+        run_lengths = predicted_counts[self.box_frames]
+        paired = run_lengths > 0
+        run_starts = (np.cumsum(run_lengths) - run_lengths)[paired]
+        best = np.zeros(self.n_boxes)
+        matches = np.full(self.n_boxes, -1, dtype=np.int64)
+        if len(ious):
+            best[paired] = np.maximum.reduceat(ious, run_starts)
+            # the first pair of each run that reaches the run's best iou, as argmax would choose
+            candidates = np.where(ious == np.repeat(best, run_lengths), np.arange(len(ious)), len(ious))
+            first = np.minimum.reduceat(candidates, run_starts)
+            matches[paired] = np.where(best[paired] > 0, predicted_rows[first], -1)
+        frame_ious = np.where((counts == 0) | (predicted_counts == 0), (counts == predicted_counts).astype(np.float64),
+                              self.reduce(best, empty=0.0) / np.maximum(np.maximum(counts, predicted_counts), 1))
+        return frame_ious, matches
@@ -0,0 +1,126 @@
+import queue
+import traceback
+import multiprocessing
+import numpy as np
+import torch
+
+
+def _pack(target):
+    """convert the tensors in a target dict to numpy arrays, so it is pickled by value when sent between processes"""
+    return {k: v.numpy() if torch.is_tensor(v) else v for k, v in target.items()}
+
+
+def _unpack(target):
+    """reverse _pack"""
+    return {k: torch.from_numpy(v) if isinstance(v, np.ndarray) else v for k, v in target.items()}
+
+
+def _decode_to_ring(dataset, ring, free_slots, filled):
+    """decoder process: write each frame of the dataset into a free slot of the ring, then announce it on filled
+
+    Args:
+        dataset (DetectVideoDataSet): dataset to decode, with transforms set to None so it yields uint8 arrays
+        ring (torch.Tensor): shared [n_slots, height, width, 3] uint8 tensor
+        free_slots (multiprocessing.Queue): indices of the slots the consumer has finished with
+        filled (multiprocessing.Queue): (slot, (height, width), target) tuples, with slot None for image-less
+            placeholders. None marks the end of the dataset, and a string carries a traceback if decoding failed
+    """
+    try:
+        frames = ring.numpy()
+        for img, target in dataset._read_frames(dataset.start, dataset.stop):
+            if img is None:
+                filled.put((None, None, _pack(target)))
+                continue
+            # blocks when every slot is in use, until the consumer catches up
+            slot = free_slots.get()
+            height, width = img.shape[:2]
+            frames[slot, :height, :width] = img
+            filled.put((slot, (height, width), _pack(target)))
+        filled.put(None)
+    except Exception:
+        filled.put(traceback.format_exc())
+
+
+class FrameRing:
+    """feed the frames of a DetectVideoDataSet to the model through a fixed-size ring of shared-memory slots
+
+    A dedicated decoder process writes uint8 frames into the ring, and only slot numbers and small target dicts travel
+    through queues. The consumer reads each frame in place, converts it straight to a float tensor, and hands the slot
+    back. Memory use is fixed by n_slots regardless of the length of the video, and the decoder blocks whenever the
+    consumer falls behind.
+
+    Iterating yields (images, targets) batches in the same form as a DataLoader using ml_utils.collate_fn, so a
+    FrameRing can be passed to Detector.evaluate in place of a DataLoader. If the decoder process dies without reporting
+    an error, e.g. when it is killed for running out of memory, iteration raises a RuntimeError rather than waiting
+    forever.
+    """
+
+    def __init__(self, dataset, batch_size=5, n_slots=64, poll_interval=1.0):
+        """
+        Args:
+            dataset (DetectVideoDataSet): dataset to decode, created with transforms=None
+            batch_size (int): number of frames (including placeholders) per batch
+            n_slots (int): number of frames the ring can hold
+            poll_interval (float): seconds to wait for the next frame before checking that the decoder is still alive
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.n_slots = n_slots
+        self.poll_interval = poll_interval
+        height, width = dataset.frame_shape
+        self.ring = torch.zeros((n_slots, height, width, 3), dtype=torch.uint8).share_memory_()
+
+    def __iter__(self):
+        free_slots, filled = multiprocessing.Queue(), multiprocessing.Queue()
+        for slot in range(self.n_slots):
+            free_slots.put(slot)
+        decoder = multiprocessing.Process(target=_decode_to_ring, args=(self.dataset, self.ring, free_slots, filled),
+                                          daemon=True)
+        decoder.start()
+        try:
+            images, targets = [], []
+            while True:
+                item = self._next_item(filled, decoder)
+                if item is None:
+                    break
+                if isinstance(item, str):
+                    raise RuntimeError('decoder process failed:\n{}'.format(item))
+                slot, shape, target = item
+                if slot is None:
+                    images.append(None)
+                else:
+                    height, width = shape
+                    images.append(self.ring[slot, :height, :width].permute(2, 0, 1).float().div_(255))
+                    free_slots.put(slot)
+                targets.append(_unpack(target))
+                if len(images) == self.batch_size:
+                    yield tuple(images), tuple(targets)
+                    images, targets = [], []
+            if images:
+                yield tuple(images), tuple(targets)
+        finally:
+            if decoder.is_alive():
+                decoder.terminate()
+            decoder.join()
+
+    def _next_item(self, filled, decoder):
+        """wait for the next item from the decoder process
+
+        Raises:
+            RuntimeError: if the decoder process exited without posting its end marker
+        """
+        while True:
+            try:
+                return filled.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if decoder.is_alive():
+                    continue
+            # the decoder may have posted its last items just before exiting
+            try:
+                return filled.get_nowait()
+            except queue.Empty:
+                raise RuntimeError('decoder process exited with code {} before the end of the video'.format(
+                    decoder.exitcode))
+
+    def __len__(self):
+        return int(np.ceil(len(self.dataset) / self.batch_size))
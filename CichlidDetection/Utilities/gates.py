@@ -0,0 +1,135 @@
+import inspect
+import cv2
+import numpy as np
+
+
+class FrameGate:
+    """base class for cheap pre-inference checks that decide whether a frame needs to be run through the model
+
+    Gates operate on a small grayscale copy of each frame (see GateChain). Subclasses implement check(), and may
+    implement update() and reset() if they keep state between frames.
+    """
+
+    name = 'gate'
+    #: what to do with a rejected frame. 'reuse' copies the detections of the last frame that was run through the
+    #: model, 'empty' records no detections
+    on_reject = 'empty'
+
+    def check(self, small):
+        """return True if the frame should be run through the model
+
+        Args:
+            small (np.ndarray): downsampled grayscale frame
+        """
+        raise NotImplementedError
+
+    def update(self, small):
+        """called with each frame that is run through the model"""
+        pass
+
+    def reset(self):
+        """forget any state carried over from earlier frames"""
+        pass
+
+    def settings(self):
+        """the name of the gate and its constructor parameters, without the state it keeps between frames, e.g. to
+        tell apart runs with different gates. Subclasses store each constructor argument under its own name"""
+        params = [name for name in inspect.signature(type(self).__init__).parameters if name != 'self']
+        return self.name, [(name, getattr(self, name)) for name in params]
+
+
+class MotionGate(FrameGate):
+    """reject frames that are nearly identical to the last frame that was run through the model"""
+
+    name = 'motion'
+    on_reject = 'reuse'
+
+    def __init__(self, pixel_threshold=15, min_fraction=0.001, max_reuse=150):
+        """
+        Args:
+            pixel_threshold (int): minimum absolute difference in gray level for a pixel to count as changed
+            min_fraction (float): minimum fraction of changed pixels for the frame to count as moving
+            max_reuse (int): maximum number of consecutive frames to reject before forcing a new detection
+        """
+        self.pixel_threshold = pixel_threshold
+        self.min_fraction = min_fraction
+        self.max_reuse = max_reuse
+        self.reset()
+
+    def check(self, small):
+        if self.reference is None or self.n_rejected >= self.max_reuse:
+            return True
+        changed = cv2.absdiff(small, self.reference) > self.pixel_threshold
+        if changed.mean() >= self.min_fraction:
+            return True
+        self.n_rejected += 1
+        return False
+
+    def update(self, small):
+        self.reference = small
+        self.n_rejected = 0
+
+    def reset(self):
+        self.reference = None
+        self.n_rejected = 0
+
+
+class BrightnessGate(FrameGate):
+    """reject dark frames, such as those recorded while the tank lights are off"""
+
+    name = 'brightness'
+    on_reject = 'empty'
+
+    def __init__(self, dark_level=30, min_fraction=0.05):
+        """
+        Args:
+            dark_level (int): gray level below which a pixel counts as dark
+            min_fraction (float): minimum fraction of pixels brighter than dark_level for the frame to be run
+        """
+        self.dark_level = dark_level
+        self.min_fraction = min_fraction
+
+    def check(self, small):
+        hist = np.bincount(small.ravel(), minlength=256)
+        return hist[self.dark_level:].sum() >= self.min_fraction * small.size
+
+
+#: gates that can be selected by name from the command line
+GATES = {'motion': MotionGate, 'brightness': BrightnessGate}
+
+
+class GateChain:
+    """apply a sequence of gates to each frame, stopping at the first gate that rejects it"""
+
+    def __init__(self, gates, size=(160, 120)):
+        """
+        Args:
+            gates (list): FrameGate objects, or names of gates in GATES, applied in order
+            size (tuple): (width, height) of the grayscale copy of the frame that the gates operate on
+        """
+        self.gates = [GATES[g]() if isinstance(g, str) else g for g in gates]
+        self.size = size
+
+    def __call__(self, frame):
+        """check an RGB frame against each gate
+
+        Args:
+            frame (np.ndarray): full resolution RGB frame
+
+        Returns:
+            FrameGate: the gate that rejected the frame, or None if the frame should be run through the model
+        """
+        small = cv2.cvtColor(cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA), cv2.COLOR_RGB2GRAY)
+        for gate in self.gates:
+            if not gate.check(small):
+                if gate.on_reject == 'empty':
+                    # detections from before an empty stretch should not be reused after it
+                    self.reset()
+                return gate
+        for gate in self.gates:
+            gate.update(small)
+        return None
+
+    def reset(self):
+        for gate in self.gates:
+            gate.reset()
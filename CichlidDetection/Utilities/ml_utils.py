@@ -1,4 +1,10 @@
+import os
+import json
 import random
+import cv2
+import numpy as np
+import torch
+import torchvision
 from torchvision.transforms import functional as F
 
 
@@ -14,6 +20,85 @@ def collate_fn(batch):
     return tuple(zip(*batch))
 
 
+def resolution_kwargs(min_size):
+    """keyword arguments that set the inference resolution of a torchvision detection model
+
+    Args:
+        min_size (int): target length of the shorter image side. The longer side is capped at the same ratio as
+            torchvision's defaults (800 / 1333). If None, returns an empty dict, leaving torchvision's defaults in place
+
+    Returns:
+        dict: min_size and max_size keyword arguments for the model constructor
+    """
+    if min_size is None:
+        return {}
+    return {'min_size': min_size, 'max_size': int(round(min_size * 1333 / 800))}
+
+
+def scaled_size(width, height, min_size, max_size):
+    """size of an image after scaling its shorter side to min_size, without letting the longer side exceed max_size
+
+    Returns:
+        tuple: (width, height) of the scaled image
+    """
+    scale = min(min_size / min(height, width), max_size / max(height, width))
+    return int(round(width * scale)), int(round(height * scale))
+
+
+#: detection architectures that can be trained and run, keyed by the name stored in the weights config
+ARCHITECTURES = {
+    'resnet50_fpn': torchvision.models.detection.fasterrcnn_resnet50_fpn,
+    'mobilenet_v3_large_fpn': torchvision.models.detection.fasterrcnn_mobilenet_v3_large_fpn,
+    'mobilenet_v3_large_320_fpn': torchvision.models.detection.fasterrcnn_mobilenet_v3_large_320_fpn,
+}
+
+
+def build_model(architecture='resnet50_fpn', min_size=None, **kwargs):
+    """construct a Faster R-CNN model for the three cichlid classes
+
+    Args:
+        architecture (str): name of the architecture in ARCHITECTURES
+        min_size (int): resolution the model resizes images to, as the length of the shorter side. Defaults to None,
+            which keeps the architecture's default (800 for the fpn models, 320 for mobilenet_v3_large_320_fpn)
+        **kwargs: additional keyword arguments for the torchvision constructor, e.g. box_detections_per_img
+
+    Returns:
+        torchvision.models.detection.FasterRCNN: the model, with untrained heads
+    """
+    return ARCHITECTURES[architecture](num_classes=3, **resolution_kwargs(min_size), **kwargs)
+
+
+def model_config_file(weights_file):
+    """path of the json config stored next to a weights file, e.g. last.json for last.weights"""
+    return os.path.splitext(weights_file)[0] + '.json'
+
+
+def save_model_config(weights_file, config):
+    """store the settings needed to rebuild the model next to its weights file
+
+    Args:
+        weights_file (str): path to the weights file
+        config (dict): architecture and min_size the model was trained with
+    """
+    with open(model_config_file(weights_file), 'w') as f:
+        json.dump(config, f, indent=2)
+
+
+def load_model_config(weights_file):
+    """load the config stored next to a weights file by save_model_config
+
+    Weights trained before configs were saved have no config file, and are assumed to be resnet50_fpn.
+
+    Returns:
+        dict: architecture and min_size the model was trained with
+    """
+    config = {'architecture': 'resnet50_fpn', 'min_size': None}
+    if os.path.exists(model_config_file(weights_file)):
+        with open(model_config_file(weights_file)) as f:
+            config.update(json.load(f))
+    return config
+
+
 class Compose(object):
     def __init__(self, transforms):
         self.transforms = transforms
@@ -30,6 +115,29 @@ class ToTensor(object):
         return image, target
 
 
+class Resize(object):
+    """downsample (or upsample) a uint8 image before it is converted to a tensor
+
+    Uses the same rule as the GeneralizedRCNNTransform inside torchvision's detection models: the shorter side is scaled
+    to min_size, unless that would make the longer side exceed max_size. The scale factor is recorded in the target as
+    'box_scale', so that boxes predicted on the resized image can be mapped back to native coordinates by dividing.
+    """
+    def __init__(self, min_size, max_size):
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def __call__(self, image, target):
+        image = np.asarray(image)
+        height, width = image.shape[:2]
+        new_width, new_height = scaled_size(width, height, self.min_size, self.max_size)
+        if (new_width, new_height) != (width, height):
+            interpolation = cv2.INTER_AREA if new_width < width else cv2.INTER_LINEAR
+            image = cv2.resize(image, (new_width, new_height), interpolation=interpolation)
+        sx, sy = new_width / width, new_height / height
+        target['box_scale'] = torch.tensor([sx, sy, sx, sy], dtype=torch.float32)
+        return image, target
+
+
 class RandomHorizontalFlip(object):
     def __init__(self, prob):
         self.prob = prob
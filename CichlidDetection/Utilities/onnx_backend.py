@@ -0,0 +1,94 @@
+import inspect
+import torch
+
+#: names of the graph inputs and outputs written by export_onnx
+INPUT_NAME = 'image'
+OUTPUT_NAMES = ['boxes', 'labels', 'scores']
+
+
+@torch.no_grad()
+def export_onnx(model, path, metadata=None, example_size=(3, 972, 1296), opset_version=11):
+    """export a torchvision Faster R-CNN to ONNX, with dynamic image height and width
+
+    The exported graph includes the model's own resizing, normalization and postprocessing, so it takes a single
+    [3, H, W] float image in [0, 1] and returns boxes in the coordinates of that image. The number of images per run is
+    fixed at one, as torchvision detection models return a separate output list per image.
+
+    Args:
+        model (nn.Module): fp32 torchvision Faster R-CNN on the cpu
+        path (str): destination .onnx file
+        metadata (dict): optional string key-value pairs stored in the model, e.g. the hash of the source weights
+        example_size (tuple): (channels, height, width) of the image used to trace the model
+        opset_version (int): ONNX opset to export
+    """
+    model.eval()
+    dynamic_axes = {INPUT_NAME: {1: 'height', 2: 'width'}}
+    dynamic_axes.update({name: {0: 'detections'} for name in OUTPUT_NAMES})
+    # torch >= 2.5 can export through dynamo, which does not support these detection models. Older versions only
+    # have the TorchScript exporter, and no dynamo argument
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(model, ([torch.rand(example_size)],), path, opset_version=opset_version,
+                      input_names=[INPUT_NAME], output_names=OUTPUT_NAMES, dynamic_axes=dynamic_axes, **kwargs)
+    if metadata:
+        import onnx
+        onnx_model = onnx.load(path)
+        for key, value in metadata.items():
+            onnx_model.metadata_props.add(key=key, value=str(value))
+        onnx.save(onnx_model, path)
+
+
+def read_metadata(path):
+    """read the metadata stored in an ONNX model by export_onnx
+
+    Returns:
+        dict: metadata values, as strings
+    """
+    import onnxruntime
+    return onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider']).get_modelmeta().custom_metadata_map
+
+
+class OnnxModel:
+    """run a model exported by export_onnx with ONNX Runtime's CPU execution provider
+
+    Takes and returns the same types as a torchvision detection model in eval mode, so it can replace the torch model
+    in Detector.evaluate.
+    """
+
+    def __init__(self, path, threads=None):
+        """
+        Args:
+            path (str): .onnx file written by export_onnx
+            threads (int): number of intra-op threads. Defaults to None, which follows torch.get_num_threads() at the
+                time of the first call, so that thread settings applied after construction (e.g. a cpu profile, or a
+                DetectionPool worker's thread count) still take effect. 0 lets ONNX Runtime use every core
+        """
+        self.path = path
+        self.threads = threads
+        self.session = None
+
+    def _start_session(self):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = torch.get_num_threads() if self.threads is None else self.threads
+        self.session = onnxruntime.InferenceSession(self.path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, images):
+        """run detection on a list of [3, H, W] image tensors
+
+        Returns:
+            list of dict: 'boxes', 'labels' and 'scores' tensors for each image
+        """
+        if self.session is None:
+            self._start_session()
+        outputs = []
+        for image in images:
+            values = self.session.run(OUTPUT_NAMES, {INPUT_NAME: image.cpu().numpy()})
+            outputs.append({name: torch.from_numpy(value) for name, value in zip(OUTPUT_NAMES, values)})
+        return outputs
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
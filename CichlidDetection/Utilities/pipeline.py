@@ -0,0 +1,136 @@
+import time
+import queue
+import threading
+import pandas as pd
+
+# end-of-stream marker passed down the queues
+_DONE = object()
+
+
+class Pipeline:
+    """run a chain of processing stages, each in its own thread, connected by bounded queues
+
+    The first stage iterates over a source (e.g. a DataLoader), and each later stage applies a function to the items
+    produced by the stage before it. A stage only waits when its input queue is empty or its output queue is full, so
+    a slow stage never stalls the others for longer than it takes to fill the queues. Each stage records how long it
+    spends working, waiting for input and blocked on output, so the bottleneck is the stage with the highest
+    utilisation.
+    """
+
+    def __init__(self, source, stages, source_name='decode', maxsize=2):
+        """
+        Args:
+            source (iterable): items fed to the first stage. The time spent in next() is recorded as the work of the
+                source stage, so for a DataLoader it covers decoding and any transforms run in its workers
+            stages (list of tuple): (name, function) pairs. Each function takes an item from the previous stage and
+                returns the item to pass on, or None to pass nothing on
+            source_name (str): name of the source stage in the report
+            maxsize (int): capacity of each queue between stages
+        """
+        self.source = source
+        self.names = [source_name] + [name for name, _ in stages]
+        self.functions = [function for _, function in stages]
+        self.queues = [queue.Queue(maxsize) for _ in stages]
+        self.times = {name: {'items': 0, 'busy': 0.0, 'wait_in': 0.0, 'wait_out': 0.0} for name in self.names}
+        self.error = None
+        self.failed = threading.Event()
+
+    def run(self):
+        """run every stage to completion
+
+        Returns:
+            Pandas DataFrame: per stage, the number of items processed, seconds spent working, and the fractions of
+                the run spent working (utilisation), waiting for input, and blocked on a full output queue
+        """
+        threads = [threading.Thread(target=self._run_source, daemon=True)]
+        threads.extend(threading.Thread(target=self._run_stage, args=(i,), daemon=True)
+                       for i in range(len(self.functions)))
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        if self.error is not None:
+            raise self.error
+        report = pd.DataFrame.from_dict(self.times, orient='index')[['items', 'busy', 'wait_in', 'wait_out']]
+        report.index.name = 'stage'
+        for column, fraction in [('utilisation', 'busy'), ('waiting_for_input', 'wait_in'),
+                                 ('blocked_on_output', 'wait_out')]:
+            report[column] = report[fraction] / elapsed if elapsed else 0.0
+        return report.drop(columns=['wait_in', 'wait_out'])
+
+    def _run_source(self):
+        times = self.times[self.names[0]]
+        try:
+            iterator = iter(self.source)
+            while True:
+                t0 = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                t1 = time.time()
+                times['busy'] += t1 - t0
+                times['items'] += 1
+                if not self._put(self.queues[0], item):
+                    return
+                times['wait_out'] += time.time() - t1
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._put(self.queues[0], _DONE)
+
+    def _run_stage(self, i):
+        times = self.times[self.names[i + 1]]
+        inbox = self.queues[i]
+        outbox = self.queues[i + 1] if i + 1 < len(self.queues) else None
+        try:
+            while True:
+                t0 = time.time()
+                item = self._get(inbox)
+                t1 = time.time()
+                times['wait_in'] += t1 - t0
+                if item is _DONE:
+                    return
+                result = self.functions[i](item)
+                t2 = time.time()
+                times['busy'] += t2 - t1
+                times['items'] += 1
+                if outbox is not None and result is not None:
+                    if not self._put(outbox, result):
+                        return
+                    times['wait_out'] += time.time() - t2
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            if outbox is not None:
+                self._put(outbox, _DONE)
+
+    def _fail(self, error):
+        if self.error is None:
+            self.error = error
+        self.failed.set()
+
+    def _get(self, inbox):
+        """get the next item, or _DONE if another stage failed"""
+        while not self.failed.is_set():
+            try:
+                return inbox.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _put(self, outbox, item):
+        """put an item on a queue, giving up if another stage failed
+
+        Returns:
+            bool: True if the item was queued
+        """
+        while not self.failed.is_set():
+            try:
+                outbox.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
@@ -0,0 +1,58 @@
+import torch
+from torchvision.ops import nms
+from CichlidDetection.Utilities.box_utils import inside_region
+
+
+class Postprocessor:
+    """filter the raw detections of the model before they are stored
+
+    The model runs non-maximum suppression for each class separately, so a fish is often reported both as a male and
+    as a female with nearly the same box. The postprocessor works on the output tensors of one image, in order:
+
+    * drop boxes scoring below min_score
+    * drop boxes whose centre lies outside the region, e.g. the tank polygon of a video, if one is given
+    * class-agnostic non-maximum suppression: of boxes overlapping by more than nms_iou, only the highest-scoring box
+      is kept, together with its label
+    * keep at most max_detections boxes, the highest-scoring first
+
+    The surviving boxes are returned in decreasing order of score.
+    """
+
+    def __init__(self, min_score=0.4, nms_iou=0.4, max_detections=None):
+        """
+        Args:
+            min_score (float): minimum score of a box
+            nms_iou (float): iou above which the lower-scoring of two boxes is suppressed, whatever their labels
+            max_detections (int): maximum number of boxes per image. Defaults to None, no limit
+        """
+        self.min_score = min_score
+        self.nms_iou = nms_iou
+        self.max_detections = max_detections
+
+    def settings(self):
+        """the settings of the postprocessor, e.g. to tell apart runs with different settings"""
+        return {'min_score': self.min_score, 'nms_iou': self.nms_iou, 'max_detections': self.max_detections}
+
+    def __call__(self, boxes, labels, scores, region=None):
+        """filter the detections of one image
+
+        Args:
+            boxes (torch.Tensor): [N, 4] boxes in (xmin, ymin, xmax, ymax) form, in the coordinates of the region
+            labels (torch.Tensor): [N] labels
+            scores (torch.Tensor): [N] scores
+            region (array-like): (xmin, ymin, xmax, ymax) rectangle or [K, 2] polygon vertices (see
+                box_utils.inside_region). Defaults to None, which keeps boxes anywhere in the image
+
+        Returns:
+            tuple of torch.Tensor: the kept boxes, labels and scores
+        """
+        keep = scores >= self.min_score
+        if region is not None:
+            centres = ((boxes[:, :2] + boxes[:, 2:]) / 2).detach().cpu().numpy()
+            keep &= torch.from_numpy(inside_region(centres, region)).to(keep.device)
+        index = torch.nonzero(keep).flatten()
+        # nms returns the kept boxes in decreasing order of score
+        index = index[nms(boxes[index].float(), scores[index].float(), self.nms_iou)]
+        if self.max_detections is not None:
+            index = index[:self.max_detections]
+        return boxes[index], labels[index], scores[index]
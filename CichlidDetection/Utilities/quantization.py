@@ -0,0 +1,85 @@
+import torch
+from torch import nn
+from torchvision.ops.misc import FrozenBatchNorm2d
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+#: quantized kernel library used on x86 CPUs
+QUANTIZED_ENGINE = 'fbgemm'
+
+
+def fold_frozen_batchnorm(module):
+    """fold each FrozenBatchNorm2d that follows a Conv2d into the convolution's weights and bias, in place
+
+    The detection backbone uses FrozenBatchNorm2d, which FX quantization cannot fuse with the preceding convolution.
+    Folding it beforehand gives the same output in fp32, and lets each convolution be quantized as a single op.
+
+    Args:
+        module (nn.Module): module to fold, e.g. the ResNet body of a detection backbone
+
+    Returns:
+        nn.Module: the same module, with each folded batchnorm replaced by nn.Identity
+    """
+    previous = None
+    for name, child in list(module.named_children()):
+        if isinstance(child, FrozenBatchNorm2d) and isinstance(previous, nn.Conv2d):
+            scale = child.weight * (child.running_var + child.eps).rsqrt()
+            bias = previous.bias.data if previous.bias is not None else torch.zeros_like(scale)
+            previous.weight.data = previous.weight.data * scale.reshape(-1, 1, 1, 1)
+            previous.bias = nn.Parameter((bias - child.running_mean) * scale + child.bias)
+            setattr(module, name, nn.Identity())
+        else:
+            fold_frozen_batchnorm(child)
+        previous = child
+    return module
+
+
+def _prepare(model):
+    """fold the backbone batchnorms and insert observers into the backbone body"""
+    torch.backends.quantized.engine = QUANTIZED_ENGINE
+    model.eval()
+    fold_frozen_batchnorm(model.backbone.body)
+    example_inputs = (torch.rand(1, 3, 224, 224),)
+    model.backbone.body = prepare_fx(model.backbone.body, get_default_qconfig_mapping(QUANTIZED_ENGINE),
+                                     example_inputs)
+    return model
+
+
+def _convert(model):
+    """convert the observed backbone body to int8, and dynamically quantize the linear layers of the box head"""
+    model.backbone.body = convert_fx(model.backbone.body)
+    return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+@torch.no_grad()
+def quantize_model(model, calibration_batches):
+    """quantize a trained fp32 Faster R-CNN for CPU inference
+
+    The ResNet body is statically quantized with FX graph mode, using activation ranges observed while running the
+    calibration batches through the full model. The linear layers of the box head and predictor are dynamically
+    quantized. The FPN, RPN and RoI pooling stay in fp32.
+
+    Args:
+        model (nn.Module): torchvision Faster R-CNN with trained weights loaded. Modified in place
+        calibration_batches (iterable): lists of image tensors, as passed to the model at inference
+
+    Returns:
+        nn.Module: the quantized model
+    """
+    model = _prepare(model)
+    for images in calibration_batches:
+        model(images)
+    return _convert(model)
+
+
+def quantized_skeleton(model):
+    """build a quantized model with the same structure as quantize_model, but without calibration, so that the state
+    dict of a previously quantized model can be loaded into it
+
+    Args:
+        model (nn.Module): torchvision Faster R-CNN constructed with the same arguments as the quantized model
+
+    Returns:
+        nn.Module: an uncalibrated quantized model
+    """
+    return _convert(_prepare(model))
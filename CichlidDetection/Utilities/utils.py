@@ -1,4 +1,5 @@
 import csv
+import hashlib
 import os, subprocess
 import random
 
@@ -43,14 +44,21 @@ def run(command, fault_tolerant=False):
     return output.stdout
 
 
-def xyminmax_to_xywh(xmin, ymin, xmax, ymax):
-    """convert box coordinates from (xmin, ymin, xmax, ymax) form to (x, y, w , h) form"""
-    return [xmin, ymin, xmax - xmin, ymax - ymin]
+def file_hash(path, chunk_size=2 ** 20):
+    """calculate the sha256 hash of a file, reading it in chunks
 
+    Args:
+        path: path to the file
+        chunk_size: number of bytes to read at a time
 
-def xywh_to_xyminmax(x, y, w, h):
-    """convert box coordinates from (x, y, w , h) form to (xmin, ymin, xmax, ymax) form"""
-    return [x, y, x + w, y + h]
+    Returns:
+        str: hexadecimal digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 class AverageMeter(object):
@@ -0,0 +1,69 @@
+# Example usage: python3 ProjectDetection.py MC6_5 MC9_1 --videos '000[1-4]_vid.mp4' --processes 4
+
+import os, time, argparse
+from time import ctime
+from CichlidDetection.Classes.FileManager import FileManager
+from CichlidDetection.Classes.FileManager import ProjectFileManager
+from CichlidDetection.Classes.Detector import Detector
+from CichlidDetection.Classes.DetectionPool import DetectionPool
+from CichlidDetection.Utilities.cli import add_detection_arguments, postprocess_settings
+
+# parse command line arguments
+parser = argparse.ArgumentParser(description='To Detect Cichlids in Every Video of One or More Projects')
+parser.add_argument('pids', type=str, nargs='+', metavar=' ', help='Project IDs. Ex: MC6_5 MC9_1')
+parser.add_argument('--videos', type=str, default='*.mp4',
+                    help="Only process videos whose names match this pattern. Ex: '000[1-4]_vid.mp4'")
+parser.add_argument('--processes', type=int, default=4, help='Number of videos to process at once')
+parser.add_argument('--threads', type=int,
+                    help='Torch threads per process. Default: the available cores split evenly between processes')
+parser.add_argument('--loader_workers', type=int, default=2, help='DataLoader workers decoding frames per process')
+add_detection_arguments(parser)
+
+"""
+Download the videos of one or more projects and run them all through the model, several videos at a time
+
+Args:
+    pids (list of str): project ids
+    videos (str): rclone filter pattern selecting which videos in each project's Videos directory to process
+    processes (int): number of worker processes, each of which loads the model once and processes whole videos
+    threads (int): torch threads per worker process
+    loader_workers (int): DataLoader worker processes decoding frames for each worker process
+    The remaining arguments are the detection options shared with VideoDetection.py (see Utilities/cli.py), applied
+    to every video
+
+    One merged detection archive is written per video, named as in VideoDetection.py
+
+"""
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    s = ctime(time.time())
+    print("Start Time (Full): ", s)
+
+    # download every matching video up front, so the worker processes only run detection
+    fm = FileManager()
+    jobs = []
+    for pid in args.pids:
+        videos = ProjectFileManager(pid, fm).list_videos(args.videos)
+        pfm = ProjectFileManager(pid, fm, False, True, *videos)
+        if args.roi is not None or args.inside_tank:
+            pfm.download_video_crop()
+        jobs.extend((pfm, os.path.join(pfm.local_files['{}_dir'.format(pid)], v)) for v in videos)
+        print('downloaded {} videos for {}'.format(len(videos), pid))
+
+    if args.quantize or args.backend == 'onnx':
+        # calibrate the int8 model or export the onnx model once, rather than in every worker at the same time
+        Detector(min_size=args.min_size, quantize=args.quantize, backend=args.backend, architecture=args.architecture)
+
+    pool = DetectionPool(args.processes, args.threads, min_size=args.min_size, quantize=args.quantize,
+                         backend=args.backend, architecture=args.architecture, postprocess=postprocess_settings(args))
+    results = pool.run(jobs, args.shard_size, stride=args.stride, gates=args.gates, roi=args.roi,
+                       decoder=args.decoder, decoder_threads=args.decoder_threads, ingest=args.ingest,
+                       num_workers=args.loader_workers, inside_tank=args.inside_tank)
+    failed = [path for path, store_name in results.items() if store_name is None]
+    print('{} of {} videos processed'.format(len(results) - len(failed), len(results)))
+    for path in failed:
+        print('failed: ', path)
+
+    print("Start Time (Full): ", s)
+    print("End Time (Full): ", ctime(time.time()))
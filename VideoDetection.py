@@ -1,12 +1,13 @@
 # Example usage: python3 VideoDetection.py 'MC6_5' '0001_vid.mp4' -v -f -s
 
-import pandas as pd
 from time import ctime
 from os.path import join
 from itertools import chain
-import os, subprocess, cv2, time, argparse
+import os, time, argparse
 from CichlidDetection.Classes.Detector import Detector
-from CichlidDetection.Utilities.utils import run, make_dir
+from CichlidDetection.Classes.DetectionService import DetectionClient
+from CichlidDetection.Utilities.utils import run
+from CichlidDetection.Utilities.cli import add_detection_arguments, postprocess_settings
 from CichlidDetection.Classes.FileManager import FileManager
 from CichlidDetection.Classes.VideoCreator import VideoAnnotation
 from CichlidDetection.Classes.FileManager import ProjectFileManager
@@ -20,7 +21,25 @@ parser.add_argument('-v', '--download_video', action='store_true', help='Downloa
 parser.add_argument('-f', '--full', action='store_true', help='Run complete program')
 parser.add_argument('-a', '--annotate', action='store_true', help='Annotate video')
 parser.add_argument('-s', '--sync', action='store_true', help='Sync detections directory')
+parser.add_argument('--keep_checkpoints', action='store_true',
+                    help='Keep the per-shard checkpoint stores after they are merged')
+add_detection_arguments(parser)
+parser.add_argument('--service', nargs='?', const='',
+                    help='Run detection in a running detection service (python3 core.py serve) listening on this '
+                         'socket, or on the default socket if no path is given. The model and postprocessing options '
+                         '(--min_size, --quantize, --backend, --architecture, --min_score, --nms_iou and '
+                         '--max_detections) are then set when the service is started, and may not be given here')
+parser.add_argument('--no_tracking', action='store_true',
+                    help='Do not track fish while detection runs. Annotation then tracks the annotated frames itself')
+parser.add_argument('--annotate_window', type=int, nargs=2, metavar=('START', 'STOP'),
+                    help='Only annotate the frames in [START, STOP) of the video')
 args = parser.parse_args()
+if args.service is not None:
+    service_options = ['min_size', 'quantize', 'backend', 'architecture', 'min_score', 'nms_iou', 'max_detections']
+    given = ['--' + name for name in service_options if getattr(args, name) != parser.get_default(name)]
+    if given:
+        parser.error('{} cannot be combined with --service, as the service sets them when it starts (see python3 '
+                     'core.py serve)'.format(', '.join(given)))
 
 """
 Download videos from different projects and run them through the model to detect cichlids
@@ -31,87 +50,33 @@ Args:
     download_videos (bool): if True, download the all the mp4 files in Videos directory for the specified project
     video (str): specifies which video to download
     full (bool): if True, run all the processes - video trimming, detections, 
-    sync (bool): if True, upload the final csv and annotated video to the cloud
-
-
-    ~10h video files are too big to be processed on the server. Using calcIntervals() and clipVideos() to trim the 
-    video into manageable chunks 
+    sync (bool): if True, upload the final detection archive and annotated video to the cloud
+    shard_size (int): number of frames in each detection shard
+    keep_checkpoints (bool): if True, keep the per-shard checkpoints in detection/checkpoints after merging
+    stride (int): run the model on every Nth frame only, interpolating detections for the frames in between
+    gates (list of str): cheap checks ('motion', 'brightness') that skip the model on static or dark frames
+    roi (str): if 'crop' or 'mask', run the model on the tank region from the project's video points numpy only
+    min_size (int): inference resolution, as the length of the shorter side of each frame
+    quantize (bool): if True, run an int8 quantized copy of the model. Run 'python3 core.py benchmark_quantization' to
+        compare its speed and accuracy with the fp32 model
+    backend (str): 'torch', or 'onnx' to run the model with ONNX Runtime. Run 'python3 core.py benchmark_onnx' to
+        compare the two
+    architecture (str): use the weights of this architecture (see Trainer._save_model). The model itself is always
+        rebuilt from the config stored with the weights
+    decoder (str): video decoding backend, 'opencv' or 'ffmpeg'. Run 'python3 core.py benchmark_decode' to compare them
+    ingest (str): 'dataloader' decodes in DataLoader workers, 'ring' in one process that fills a shared-memory ring
+    service (str): if given, send the video to a running detection service instead of loading a model in this process
+    annotate_window (list of int): if given, only annotate frames START to STOP - 1, reading only their detections
+
+
+    ~10h video files are processed as shards of the original video. Detector.video_detect() splits the video into
+    (start_frame, end_frame) ranges, streams each range directly from the original file, and merges the results.
+    Each shard is checkpointed once it finishes, so rerunning an interrupted job with the same weights and settings
+    only processes the missing shards
 
 """
 
 
-def calcIntervals(video):
-    """ Create a list of intervals for the video to be trimmed into
-
-    Args:
-            video (str): Path of the original video file
-    """
-
-    cap = cv2.VideoCapture(video)
-    intervals = []
-    length = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-
-    # limit for the number of frames that can be loaded at once: 18000
-    if length > 18000:
-        vid_dir_path = os.path.join(pfm.local_files['{}_dir'.format(args.pid)], video_name)
-        if not os.path.exists(vid_dir_path):
-            pfm.local_files.update({video_name: make_dir(vid_dir_path)})
-        else:
-            pfm.local_files.update({video_name: vid_dir_path})
-
-    for x in range(length):
-        if x % 18000 == 0:
-            intervals.append(x)
-
-    if length % 18000 != 0:
-        intervals.append(length)
-
-    cap.release()
-    return intervals
-
-
-def clipVideos(video, name, begin, end, frame_num):
-    """ Create short 10 min clips of the 6-10h long video
-
-        Args:
-                video (str): Path of the original video file
-                name (str): Name of the cropped video file
-                begin (int): Starting frame number of the cropped video
-                end (int): Final frame number of the cropped video
-                frame_num (int): Tracking the frame numbers
-        """
-
-    cap = cv2.VideoCapture(video)
-    frame_width = int(cap.get(3))
-    frame_height = int(cap.get(4))
-    size = (frame_width, frame_height)
-    vid_name = name + '_{}.mp4'.format(begin)
-
-    # Trimmed video details
-    result = cv2.VideoWriter(os.path.join(pfm.local_files[name], '{}'.format(vid_name)),
-                             cv2.VideoWriter_fourcc(*"mp4v"), 30, size)
-
-    for j in range(begin, end):
-        cap.set(cv2.CAP_PROP_POS_FRAMES, int(j))
-        ret, frame = cap.read()
-        if not ret:
-            print('Bad frame')
-            break
-        else:
-            result.write(frame)
-            if cv2.waitKey(1) & 0xFF == ord('s'):
-                break
-        frame_num += 1
-
-    cap.release()
-    result.release()
-    cv2.destroyAllWindows()
-
-    print("Video: {} was successfully saved".format(vid_name))
-    location = os.path.join(pfm.local_files[name], vid_name)
-    return location, frame_num
-
-
 def sync_detection_dir(exclude=None, quiet=False):
     """ Sync the detection directory bidirectionally, keeping the newer version of each file
 
@@ -142,70 +107,35 @@ fm = FileManager()
 pfm = ProjectFileManager(args.pid, fm, args.download_images, args.download_video, args.video)
 print('downloaded video, created directories!')
 
-# Storing video path. Setting video and final csv file names.
+# Storing video path. Setting video and final detection archive names.
 video_path = os.path.join(pfm.local_files['{}_dir'.format(args.pid)], args.video)
 video_name = args.video.split('.')[0]
-csv_name = '{}_{}_detections.csv'.format(args.pid, video_name)
+store_name = '{}_{}_detections.archive'.format(args.pid, video_name)
 
 if args.full:
     """
-        1. Run all the processes - video trimming, detections, video annotation
-        2. Create intervals list and iterate through them to crop video and feed it into the model
+        1. Run all the processes - detections, video annotation
+        2. Create intervals list and run detection on each shard of the original video
     """
 
-    if 'sample' in video_name:
-        detect = Detector(pfm)
-        print("Start Detect Time: ", ctime(time.time()))
-        detect.frame_detect(args.pid, video_path)
-        print("End Detect Time: ", ctime(time.time()))
+    detect_kwargs = dict(shard_size=args.shard_size, keep_checkpoints=args.keep_checkpoints, stride=args.stride,
+                         gates=args.gates, roi=args.roi, decoder=args.decoder, decoder_threads=args.decoder_threads,
+                         ingest=args.ingest, tracking=False if args.no_tracking else None, inside_tank=args.inside_tank)
+    if args.service is not None:
+        with DetectionClient(args.service) as client:
+            store_name = client.video_detect(args.pid, video_path, **detect_kwargs)
     else:
-        detect = Detector(pfm)
-        interval_list = calcIntervals(video_path)
-        video_list = []
-        count = 0
-        for i in range(len(interval_list) - 1):
-            print('Starting video {}...'.format(i))
-            start = interval_list[i]
-            stop = interval_list[i + 1]
-            vid_location, num = clipVideos(video_path, video_name, start, stop, count)
-            count = num
-            video_list.append(vid_location)
-            print('Attempting detection for video {}'.format(i))
-            print("Start Detect Time: ", ctime(time.time()))
-            detect.frame_detect(args.pid, vid_location)
-            print("End Detect Time: ", ctime(time.time()))
-
-        print('{} was successively split into {} parts'.format(video_name, len(video_list)))
-
-    # Create a consolidated detections csv file
-    csv_list = os.listdir(pfm.local_files['detection_dir'])
-    csv_list.sort(key=lambda x: int(''.join(filter(str.isdigit, x))))
-    df_list = []
-    for i in csv_list:
-        csv_path = os.path.join(pfm.local_files['detection_dir'], i)
-        df = pd.read_csv(csv_path)
-        df_list.append(df)
-
-    final_csv = pd.concat(df_list, axis=0)
-    csv_location = os.path.join(pfm.local_files['detection_dir'], csv_name)
-    final_csv.to_csv(csv_location)
-    print("Final csv: ", csv_name)
-
-    # Getting rid of unnecessary csv
-    print('Deleting the other csv files...')
-    for i in csv_list:
-        if i != csv_name:
-            csv_path = os.path.join(pfm.local_files['detection_dir'], i)
-            subprocess.run(['rm', csv_path])
-
-    # Getting rid of unnecessary video files
-    print('Deleting {} clipped videos...'.format(args.video))
-    subprocess.run(['rm', '-rf', pfm.local_files[video_name]])
+        detect = Detector(pfm, min_size=args.min_size, quantize=args.quantize, backend=args.backend,
+                          architecture=args.architecture, postprocess=postprocess_settings(args))
+        store_name = detect.video_detect(args.pid, video_path, **detect_kwargs)
+    print("Final detection archive: ", store_name)
 
 if args.annotate:
     # Annotating the queried video file using the predicted boxes and labels
     print('Starting the video annotation process...')
-    video_ann = VideoAnnotation(args.pid, video_path, args.video, csv_name, pfm)
+    start_frame, end_frame = args.annotate_window or (0, None)
+    video_ann = VideoAnnotation(args.pid, video_path, args.video, store_name, pfm, decoder=args.decoder,
+                                start_frame=start_frame, end_frame=end_frame)
     video_ann.annotate()
 
 print('Process complete!')
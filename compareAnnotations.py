@@ -7,6 +7,8 @@ import matplotlib.pyplot as plt
 from os.path import join, exists
 import matplotlib.image as mpimg
 from CichlidDetection.Classes.FileManager import FileManager
+from CichlidDetection.Utilities.detection_store import STORE_EXTENSION
+from CichlidDetection.Utilities.detection_table import DetectionTable
 
 class CompareAnnotations:
 
@@ -15,55 +17,36 @@ class CompareAnnotations:
 		self.csv_dir = self.fm.local_files['figure_data_dir']
 		self.file='epoch_99_eval.csv'
 		self.data = os.path.join(self.csv_dir, self.file)
+		self.predictions_file = os.path.join(self.fm.local_files['predictions_dir'], '99' + STORE_EXTENSION)
 		self.img_dir = self.fm.local_files['test_image_dir']
 
-	def compare(dt):
+	def load(self):
+		# boxes and labels come from the detection stores, the per-frame scores from the epoch evaluation
+		self.ground_truth = DetectionTable.load(self.fm.local_files['ground_truth_file'])
+		self.predictions = self.ground_truth.align(DetectionTable.load(self.predictions_file))
+		self.scores = pd.read_csv(self.data, usecols=['Framefile', 'average_iou', 'avg_accuracy'], index_col='Framefile')
 
+	def compare(self):
+		gt, ep = self.ground_truth, self.predictions
+		dt = gt.to_dataframe()[['boxes', 'labels']].join(ep.to_dataframe()[['boxes', 'labels']], lsuffix='_actual',
+														   rsuffix='_predicted').join(self.scores).reset_index()
 		dt.rename(columns={'boxes_actual': 'Box_man', 'labels_actual': 'Sex_man', 'boxes_predicted': 'Box_ml',
 						 'labels_predicted': 'Sex_ml', 'average_iou': 'IOU'}, inplace=True)
 
-		sex_agree = []
-		gender_actual = []
-		gender_pred=[]
-
-		for row in dt.itertuples():
-			ann1 = row.Box_man
-			ann2 = row.Box_ml
-			sex1 = row.Sex_man
-			sex2 = row.Sex_ml
-			iou = row.IOU
-			actual_sex = eval(row.Sex_man)
-			pred_sex = eval(row.Sex_ml)
-
-			try:
-				ann1 = eval(ann1)
-				ann2 = eval(ann2)
-			except TypeError:
-				sex_agree.append(np.nan)
-				continue
-
-			if iou != float(1.0):
-				if sex1 == sex2:
-					sex_agree.append('True')
-				else:
-					sex_agree.append('False')
-			else:
-				sex_agree.append('No fish')
-
-
-			if len(set(pred_sex)) == 0:
-				gender_pred.append(0)
-			elif len(set(pred_sex)) == 1:
-				if pred_sex[0] == 1:
-					gender_pred.append(1)
-				else:
-					gender_pred.append(2)
-			elif len(set(pred_sex)) == 2:
-				gender_pred.append(3)
-
-		dt['SexAgree'] = pd.Series(sex_agree)
-		# dt['Gender_Actual'] = pd.Series(gender_actual)
-		dt['Gender_Predicted'] = pd.Series(gender_pred)
+		# the sexes agree if both frames have the same number of fish and the labels match box for box. Rows of frames
+		# with equal counts line up between the two tables, so the labels can be compared in one pass
+		same_count = gt.counts == ep.counts
+		gt_rows = np.repeat(same_count, gt.counts)
+		ep_rows = np.repeat(same_count, ep.counts)
+		mismatch = gt.labels[gt_rows] != ep.labels[ep_rows]
+		disagree = np.bincount(gt.box_frames[gt_rows][mismatch], minlength=len(gt)) > 0
+		agree = np.where(same_count & ~disagree, 'True', 'False')
+		dt['SexAgree'] = np.where(dt.IOU.to_numpy() != 1.0, agree, 'No fish')
+
+		# 0: no fish, 1: only females, 2: only males, 3: both
+		has_female = ep.reduce(ep.labels == 1, np.logical_or, empty=False)
+		has_male = ep.reduce(ep.labels == 2, np.logical_or, empty=False)
+		dt['Gender_Predicted'] = has_female * 1 + has_male * 2
 
 		dt = dt[['Framefile', 'Box_man', 'Sex_man', 'Box_ml', 'Sex_ml', 'Gender_Predicted', 'SexAgree', 'IOU', 'avg_accuracy']]
 		return dt
@@ -76,9 +59,9 @@ class CompareAnnotations:
 		annotations = dt2[dt2.Framefile == frame]
 
 		for row in annotations.itertuples():
-			if row.Box_man != '[]':
-				box = eval(row.Box_man)
-				sex = eval(row.Sex_man)
+			if len(row.Box_man) > 0:
+				box = row.Box_man
+				sex = row.Sex_man
 				num = len(sex)
 				for i in range(num):
 					if sex[i]==1:
@@ -89,9 +72,9 @@ class CompareAnnotations:
 																  linewidth=1, edgecolor='blue', facecolor='none'))
 
 		for row in annotations.itertuples():
-			if row.Box_ml != '[]':
-				box = eval(row.Box_ml)
-				sex = eval(row.Sex_ml)
+			if len(row.Box_ml) > 0:
+				box = row.Box_ml
+				sex = row.Sex_ml
 				num = len(sex)
 				for i in range(num):
 					if sex[i]==1:
@@ -114,8 +97,8 @@ parser.add_argument('-p', '--plot', action='store_true', help='Use this flag to
 args = parser.parse_args()
 
 comparer = CompareAnnotations()
-dt1 = pd.read_csv(comparer.data)
-dt = CompareAnnotations.compare(dt1)
+comparer.load()
+dt = comparer.compare()
 dt_f = dt[dt['Gender_Predicted'] == 1]
 dt_m = dt[dt['Gender_Predicted'] == 2]
 dt_b = dt[dt['Gender_Predicted'] == 3]
@@ -2,6 +2,7 @@ import argparse
 import subprocess
 import os
 import socket
+from CichlidDetection.Utilities.ml_utils import ARCHITECTURES
 
 """primary command line executable script."""
 
@@ -16,6 +17,10 @@ download_parser = subparsers.add_parser('download')
 
 train_parser = subparsers.add_parser('train')
 train_parser.add_argument('-e', '--Epochs', type=int, default=10, help='number of epochs to train')
+train_parser.add_argument('-m', '--MinSize', type=int,
+                          help="training resolution (shorter image side). Default: the architecture's default")
+train_parser.add_argument('-a', '--Architecture', choices=list(ARCHITECTURES), default='resnet50_fpn',
+                          help='detection architecture to train')
 
 full_auto_parser = subparsers.add_parser('full_auto')
 full_auto_parser.add_argument('-e', '--Epochs', type=int, default=10, help='number of epochs to train')
@@ -27,6 +32,89 @@ detect_parser.add_argument('-t', '--Test', action='store_true', help='run detect
 detect_parser.add_argument('-v', '--Video', action='store_true', help='run detection on complete video')
 detect_parser.add_argument('-i', '--ImgDir', type=str, default='detection/images',
                            help='path, relative to ~/scratch/CichlidDetection, containing the images to analyze')
+detect_parser.add_argument('-m', '--MinSize', type=int,
+                           help="inference resolution (shorter image side). Default: from the architecture's config")
+detect_parser.add_argument('-q', '--Quantize', action='store_true', help='run an int8 quantized model on the cpu')
+detect_parser.add_argument('-a', '--Architecture', choices=list(ARCHITECTURES),
+                           help='use the most recent weights trained with this architecture. Default: last.weights')
+detect_parser.add_argument('-b', '--Backend', choices=['torch', 'onnx'], default='torch',
+                           help='run the model in pytorch, or with ONNX Runtime on the cpu')
+detect_parser.add_argument('-s', '--Service', nargs='?', const='',
+                           help='run detection in a running detection service (see serve), listening on this socket. '
+                                'Default socket if no path is given')
+
+serve_parser = subparsers.add_parser('serve')
+serve_parser.add_argument('-s', '--Socket', type=str, help='Unix socket to listen on. Default data_dir socket')
+serve_parser.add_argument('-n', '--MaxBatch', type=int, help='maximum images per model call. Default cpu profile')
+serve_parser.add_argument('-l', '--MaxLatency', type=float, default=0.05,
+                          help='maximum seconds an image waits for its batch to fill')
+serve_parser.add_argument('-m', '--MinSize', type=int,
+                          help="inference resolution (shorter image side). Default: from the architecture's config")
+serve_parser.add_argument('-q', '--Quantize', action='store_true', help='run an int8 quantized model on the cpu')
+serve_parser.add_argument('-a', '--Architecture', choices=list(ARCHITECTURES),
+                          help='use the most recent weights trained with this architecture. Default: last.weights')
+serve_parser.add_argument('-b', '--Backend', choices=['torch', 'onnx'], default='torch',
+                          help='run the model in pytorch, or with ONNX Runtime on the cpu')
+serve_parser.add_argument('--MinScore', type=float, default=0.4, help='drop detections scoring below this')
+serve_parser.add_argument('--NmsIou', type=float, default=0.4,
+                          help='keep only the highest-scoring of detections overlapping by more than this iou, '
+                               'whatever their sex')
+serve_parser.add_argument('--MaxDetections', type=int, help='keep at most this many detections per image')
+serve_parser.add_argument('--InsideTank', action='store_true',
+                          help='drop detections centred outside the tank in every video request')
+
+service_stats_parser = subparsers.add_parser('service_stats')
+service_stats_parser.add_argument('-s', '--Socket', type=str, help='socket of the service. Default data_dir socket')
+
+stop_service_parser = subparsers.add_parser('stop_service')
+stop_service_parser.add_argument('-s', '--Socket', type=str, help='socket of the service. Default data_dir socket')
+
+export_parser = subparsers.add_parser('export_onnx')
+export_parser.add_argument('-o', '--Output', type=str, help='destination .onnx file. Default weights/last.onnx')
+export_parser.add_argument('-m', '--MinSize', type=int,
+                           help="inference resolution (shorter image side). Default: from the architecture's config")
+
+resolution_parser = subparsers.add_parser('benchmark_resolution')
+resolution_parser.add_argument('-s', '--Sizes', type=int, nargs='+', default=[400, 600, 800],
+                               help='inference resolutions (shorter image side) to compare')
+resolution_parser.add_argument('-n', '--NumImages', type=int, help='number of test images to use. Default all')
+
+quantization_parser = subparsers.add_parser('benchmark_quantization')
+quantization_parser.add_argument('-n', '--NumImages', type=int, help='number of test images to use. Default all')
+quantization_parser.add_argument('-m', '--MinSize', type=int, help='inference resolution (shorter image side)')
+
+onnx_parser = subparsers.add_parser('benchmark_onnx')
+onnx_parser.add_argument('-n', '--NumImages', type=int, help='number of test images to use. Default all')
+onnx_parser.add_argument('-m', '--MinSize', type=int, help='inference resolution (shorter image side)')
+
+architecture_parser = subparsers.add_parser('compare_architectures')
+architecture_parser.add_argument('-a', '--Architectures', nargs='+', choices=list(ARCHITECTURES),
+                                 default=list(ARCHITECTURES),
+                                 help='architectures to train and compare')
+architecture_parser.add_argument('-e', '--Epochs', type=int, default=10, help='number of epochs to train each')
+architecture_parser.add_argument('-m', '--MinSize', type=int, help='training and inference resolution')
+architecture_parser.add_argument('-n', '--NumImages', type=int, help='number of test images to time. Default all')
+
+tune_parser = subparsers.add_parser('tune_cpu')
+tune_parser.add_argument('-b', '--BatchSizes', type=int, nargs='+', default=[1, 2, 5, 8], help='batch sizes to try')
+tune_parser.add_argument('-w', '--Workers', type=int, nargs='+', default=[0, 2, 4, 8],
+                         help='DataLoader worker counts to try')
+tune_parser.add_argument('-t', '--Threads', type=int, nargs='+',
+                         help='torch thread counts to try. Default: 1, half and all available cores')
+tune_parser.add_argument('-n', '--NumImages', type=int, default=40, help='number of test images per configuration')
+tune_parser.add_argument('-m', '--MinSize', type=int,
+                         help="inference resolution (shorter image side). Default: from the architecture's config")
+
+decode_parser = subparsers.add_parser('benchmark_decode')
+decode_parser.add_argument('-p', '--Path', type=str, help='video to decode. Default: a synthetic 1296x972 video')
+decode_parser.add_argument('-n', '--NumFrames', type=int, default=300, help='number of frames to decode')
+decode_parser.add_argument('-t', '--Threads', type=int, nargs='+', default=[0], help='decoder thread counts to try')
+decode_parser.add_argument('-m', '--MinSize', type=int, nargs='+',
+                           help='also benchmark in-decoder scaling to these resolutions (shorter frame side)')
+
+convert_parser = subparsers.add_parser('convert_detections')
+convert_parser.add_argument('Paths', type=str, nargs='+',
+                            help='detections, predictions or ground truth csv files to convert to detection stores')
 
 args = parser.parse_args()
 
@@ -46,6 +134,32 @@ else:
         from CichlidDetection.Classes.FileManager import FileManager
         FileManager().sync_training_dir()
 
+    elif args.command == 'benchmark_decode':
+        from CichlidDetection.Utilities.decoders import benchmark_decoders
+        benchmark_decoders(args.Path, n_frames=args.NumFrames, threads=args.Threads,
+                           min_sizes=[None] + (args.MinSize or []))
+
+    elif args.command == 'convert_detections':
+        from CichlidDetection.Utilities.detection_store import convert_csv
+        for path in args.Paths:
+            print('{} -> {}'.format(path, convert_csv(path)))
+
+    elif args.command in ['service_stats', 'stop_service'] or (args.command == 'detect' and args.Service is not None):
+        # talk to a running service directly, without the FileManager setup that Runner performs. The service's model
+        # was loaded with its own settings (see serve), so the detect options MinSize, Quantize, Architecture and
+        # Backend are unused
+        from CichlidDetection.Classes.DetectionService import DetectionClient
+        with DetectionClient(args.Service if args.command == 'detect' else args.Socket) as client:
+            if args.command == 'service_stats':
+                for key, value in client.stats().items():
+                    print('{}: {}'.format(key, value))
+            elif args.command == 'stop_service':
+                client.shutdown()
+            elif args.Test:
+                print(client.call('test', 5))
+            else:
+                print(client.call('detect', args.ImgDir))
+
     else:
         from CichlidDetection.Classes.Runner import Runner
         runner = Runner()
@@ -60,12 +174,39 @@ else:
 
         elif args.command == 'train':
             runner.prep()
-            runner.train(num_epochs=args.Epochs)
+            runner.train(num_epochs=args.Epochs, min_size=args.MinSize, architecture=args.Architecture)
 
         elif args.command == 'detect':
+            detector_kwargs = {'min_size': args.MinSize, 'quantize': args.Quantize, 'backend': args.Backend,
+                               'architecture': args.Architecture}
             if args.Test:
-                runner.detect('test')
+                runner.detect('test', **detector_kwargs)
             elif args.Video:
-                runner.detect('fullvideo')
+                runner.detect('fullvideo', **detector_kwargs)
             else:
-                runner.detect(args.ImgDir)
+                runner.detect(args.ImgDir, **detector_kwargs)
+
+        elif args.command == 'serve':
+            postprocess = {'min_score': args.MinScore, 'nms_iou': args.NmsIou, 'max_detections': args.MaxDetections}
+            runner.serve(args.Socket, args.MaxBatch, args.MaxLatency, min_size=args.MinSize, quantize=args.Quantize,
+                         backend=args.Backend, architecture=args.Architecture, postprocess=postprocess,
+                         inside_tank=args.InsideTank)
+
+        elif args.command == 'benchmark_resolution':
+            runner.benchmark_resolutions(args.Sizes, args.NumImages)
+
+        elif args.command == 'benchmark_quantization':
+            runner.benchmark_quantization(args.NumImages, args.MinSize)
+
+        elif args.command == 'export_onnx':
+            runner.export_onnx(args.Output, args.MinSize)
+
+        elif args.command == 'benchmark_onnx':
+            runner.benchmark_onnx(args.NumImages, args.MinSize)
+
+        elif args.command == 'compare_architectures':
+            runner.prep()
+            runner.compare_architectures(args.Architectures, args.Epochs, args.MinSize, args.NumImages)
+
+        elif args.command == 'tune_cpu':
+            runner.tune_cpu(args.BatchSizes, args.Workers, args.Threads, args.NumImages, args.MinSize)